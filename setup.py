@@ -23,7 +23,14 @@ setup(
                  'Operating System :: Microsoft :: Windows',
                  'Intended Audience :: Developers'],
     packages=find_packages(),
-    install_requires=['pymoa', 'pybarst', 'ffpyplayer', 'cplcom'],
+    install_requires=['pymoa', 'pybarst', 'ffpyplayer', 'cplcom', 'numpy'],
     package_data={'vet_cond': ['data/*', '*.kv']},
-    entry_points={'console_scripts': ['vet_cond=vet_cond.main:run_app']},
+    entry_points={'console_scripts': [
+        'vet_cond=vet_cond.main:run_app',
+        'vet_cond_analysis=vet_cond.analysis:main',
+        'vet_cond_headless=vet_cond.headless:main',
+        'vet_cond_benchmark=vet_cond.benchmark:main',
+        'vet_cond_chambers=vet_cond.chambers:main',
+        'vet_cond_index=vet_cond.indexer:main',
+        'vet_cond_segments=vet_cond.segments:main']},
 )
@@ -0,0 +1,398 @@
+'''Analysis
+===========
+
+Offline scoring of freezing in the recorded trial videos.
+
+For every video, the motion of each frame is computed as the percentage of
+the pixels of the downsampled grayscale frame that changed by more than
+``pixel_threshold`` grey levels from the previous frame. Runs of frames whose
+motion is below ``motion_threshold`` for at least ``min_freeze`` seconds are
+freezing bouts, and the freezing time is summed for each of the trial's
+epochs (baseline, tone, shock, trial, and post).
+
+The trial event times are read from the video's
+:mod:`~vet_cond.frame_index`, which also maps each video frame to its source
+pts. For videos without an index, the events are read from the trial's row in
+the CSV log, and the video's own timestamps are used as the frame times.
+
+The motion of each video is cached in a ``.motion.json`` file next to the
+video, so that rerunning the analysis, e.g. with a different freezing
+threshold, only decodes new or changed videos. Videos are processed in
+parallel in a process pool.
+
+It can be run from the command line, e.g.::
+
+    python -m vet_cond.analysis --log log.csv --output freezing.csv *.avi
+'''
+
+import csv
+import json
+import argparse
+from time import sleep
+from os.path import splitext, basename, getsize, getmtime, isfile
+from multiprocessing import Pool
+
+import numpy as np
+
+from vet_cond.frame_index import FrameIndex, index_filename
+from vet_cond.trial_log import TRIAL_COLUMNS
+from vet_cond.utils import name_pattern_regex
+
+__all__ = ('DEFAULT_PARAMS', 'EPOCHS', 'read_frames', 'motion_energy',
+           'get_motion', 'freezing_bouts', 'trial_epochs', 'epoch_freezing',
+           'read_log_rows', 'analyze_video', 'analyze_videos',
+           'write_summary', 'main')
+
+DEFAULT_PARAMS = {
+    'width': 160, 'pixel_threshold': 10, 'motion_threshold': .5,
+    'min_freeze': 1., 'baseline': 5., 'post': 5.}
+'''The default analysis parameters. They are:
+
+    `width`: The width, in pixels, to which the frames are downsampled
+        before computing the motion. The height is scaled to keep the aspect
+        ratio.
+    `pixel_threshold`: The minimum change, in grey levels, of a pixel
+        between frames for it to count as moving.
+    `motion_threshold`: A frame is freezing if less than this percentage of
+        its pixels moved.
+    `min_freeze`: The minimum duration, in seconds, of a freezing bout.
+    `baseline`: The duration of the baseline epoch preceding the trial.
+    `post`: The duration of the post epoch following the trial.
+
+``width`` and ``pixel_threshold`` determine the motion and are part of the
+cache key, the others only affect the scoring.
+'''
+
+MOTION_PARAMS = ('width', 'pixel_threshold')
+'''The parameters that affect the cached motion.
+'''
+
+CACHE_VERSION = 1
+'''The version of the motion cache files. Caches with another version are
+ignored.
+'''
+
+EPOCHS = ('baseline', 'tone', 'shock', 'trial', 'post')
+'''The epochs for which the freezing is summarized.
+'''
+
+
+def read_frames(filename, width=0):
+    '''A generator that decodes the video and yields ``(frame, pts)`` for
+    every frame, where frame is a 2-dim uint8 grayscale numpy array.
+
+    If ``width`` is not zero, the frames are downscaled to that width by the
+    decoder.
+    '''
+    from ffpyplayer.player import MediaPlayer
+    player = MediaPlayer(filename, ff_opts={
+        'out_fmt': 'gray', 'an': True, 'sn': True, 'framedrop': False,
+        'sync': 'video'})
+    try:
+        if width:
+            while player.get_metadata()['src_vid_size'] == (0, 0):
+                sleep(.005)
+            player.set_size(width, -1)
+
+        last_pts = None
+        while True:
+            # force_refresh returns frames as soon as they are decoded rather
+            # than at the playback rate
+            frame, val = player.get_frame(force_refresh=True)
+            if val == 'eof':
+                break
+            if frame is None:
+                sleep(.001)
+                continue
+
+            img, pts = frame
+            if last_pts is not None and pts <= last_pts:
+                continue
+            last_pts = pts
+
+            w, h = img.get_size()
+            linesize = img.get_linesizes(keep_align=True)[0]
+            data = np.frombuffer(img.to_bytearray(keep_align=True)[0],
+                                 dtype=np.uint8)
+            yield data.reshape((h, linesize))[:, :w], pts
+    finally:
+        player.close_player()
+
+
+def motion_energy(frames, pixel_threshold=10, chunk=256):
+    '''Computes the motion of each frame from an iterable of ``(frame, pts)``
+    such as returned by :func:`read_frames`.
+
+    Returns a tuple of two 1-dim float arrays, the pts and the motion of the
+    frames. The motion is the percentage of pixels that changed by more than
+    ``pixel_threshold`` from the previous frame, and it's NaN for the first
+    frame. Frames are processed ``chunk`` at a time.
+    '''
+    motion = []
+    times = []
+    buf = None
+    n = 0
+    prev = None
+
+    def process(block):
+        diff = np.abs(np.diff(block.astype(np.int16), axis=0))
+        moved = diff > pixel_threshold
+        return moved.reshape((moved.shape[0], -1)).mean(axis=1) * 100.
+
+    for frame, pts in frames:
+        if buf is None:
+            buf = np.empty((chunk + 1, ) + frame.shape, dtype=np.uint8)
+            motion.append(np.array([np.nan]))
+        elif n == 0:
+            buf[0] = prev
+            n = 1
+
+        buf[n] = frame
+        n += 1
+        times.append(pts)
+        prev = frame
+        if n == chunk + 1:
+            motion.append(process(buf))
+            n = 0
+
+    if n > 1:
+        motion.append(process(buf[:n]))
+    if not times:
+        return np.zeros(0), np.zeros(0)
+    return np.array(times, dtype=np.float64), np.concatenate(motion)
+
+
+def _cache_filename(filename):
+    return '{}.motion.json'.format(splitext(filename)[0])
+
+
+def get_motion(filename, params=None):
+    '''Returns the pts and motion arrays of the video, as computed by
+    :func:`motion_energy`, from the cache if it's valid for the current file
+    and ``params``, otherwise they are computed and cached.
+    '''
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    key = {'version': CACHE_VERSION, 'size': getsize(filename),
+           'mtime': getmtime(filename),
+           'params': {k: params[k] for k in MOTION_PARAMS}}
+
+    cache = _cache_filename(filename)
+    if isfile(cache):
+        try:
+            with open(cache, 'r') as fh:
+                data = json.load(fh)
+        except ValueError:
+            data = {}
+        if data.get('key') == key:
+            return (np.array(data['pts'], dtype=np.float64),
+                    np.array(data['motion'], dtype=np.float64))
+
+    times, motion = motion_energy(
+        read_frames(filename, params['width']), params['pixel_threshold'])
+    with open(cache, 'w') as fh:
+        json.dump({'key': key, 'pts': times.tolist(),
+                   'motion': [None if np.isnan(v) else v for v in motion]},
+                  fh)
+    return times, motion
+
+
+def freezing_bouts(times, motion, motion_threshold, min_freeze):
+    '''Returns a list of ``(start, end)`` times of the freezing bouts, the
+    runs of frames with motion below ``motion_threshold`` lasting at least
+    ``min_freeze`` seconds.
+    '''
+    if not len(times):
+        return []
+    with np.errstate(invalid='ignore'):
+        frozen = np.asarray(motion) < motion_threshold
+    edges = np.flatnonzero(np.diff(np.concatenate(
+        ([0], frozen.astype(np.int8), [0]))))
+    bouts = []
+    for s, e in zip(edges[::2], edges[1::2]):
+        start = times[max(s - 1, 0)]
+        end = times[e - 1]
+        if end - start >= min_freeze:
+            bouts.append((float(start), float(end)))
+    return bouts
+
+
+def trial_epochs(events, baseline=5., post=5.):
+    '''Returns a dict mapping the :attr:`EPOCHS` names to their ``(start,
+    end)`` times, given a dict of the trial event times with the keys of
+    :attr:`~vet_cond.frame_index.EVENT_KEYS`. Epochs whose events did not
+    occur are omitted.
+    '''
+    def get(key):
+        val = events.get(key, -1)
+        return None if val is None or val == -1 else float(val)
+
+    trial_ts, trial_te = get('trial_ts'), get('trial_te')
+    epochs = {}
+    if trial_ts is not None:
+        epochs['baseline'] = trial_ts - baseline, trial_ts
+    if trial_te is not None:
+        epochs['post'] = trial_te, trial_te + post
+    for name, start, end in (
+            ('tone', get('tone_ts'), get('tone_te')),
+            ('shock', get('shock_ts'), get('shock_te')),
+            ('trial', trial_ts, trial_te)):
+        if start is not None and end is not None and end > start:
+            epochs[name] = start, end
+    return epochs
+
+
+def epoch_freezing(bouts, start, end):
+    '''Returns a dict with the `freezing` time, the `fraction` of the epoch
+    spent freezing, and the number of `bouts` overlapping the epoch from
+    ``start`` to ``end``.
+    '''
+    total = 0.
+    count = 0
+    for s, e in bouts:
+        overlap = min(e, end) - max(s, start)
+        if overlap > 0:
+            total += overlap
+            count += 1
+    duration = end - start
+    return {'start': start, 'end': end, 'freezing': total,
+            'fraction': total / duration if duration > 0 else 0.,
+            'bouts': count}
+
+
+def read_log_rows(filename):
+    '''Reads the CSV log written by :class:`~vet_cond.trial_log.TrialLogWriter`
+    and returns a dict mapping ``(animal, trial)`` to a dict of the row's event
+    times, keyed by :attr:`~vet_cond.frame_index.EVENT_KEYS`. If an animal's
+    trial appears more than once, the last row is used.
+    '''
+    rows = {}
+    with open(filename, 'r') as fh:
+        for row in csv.DictReader(fh):
+            events = {}
+            for header, key, typecode in TRIAL_COLUMNS:
+                if typecode == 'd' and row.get(header, ''):
+                    events[key] = float(row[header])
+            rows[(row['ID'], int(row['Trial']))] = events
+    return rows
+
+
+def analyze_video(filename, params=None, log_rows=None, name_regex=None):
+    '''Scores the freezing in the video and returns a dict with its
+    `filename`, `animal`, `trial`, freezing `bouts`, and `epochs`, a dict
+    mapping epoch names to the dicts returned by :func:`epoch_freezing`.
+
+    ``log_rows`` (see :func:`read_log_rows`) and ``name_regex`` (see
+    :func:`~vet_cond.utils.name_pattern_regex`) are used to find the
+    trial's events when the video has no frame index.
+    '''
+    params = dict(DEFAULT_PARAMS, **(params or {}))
+    times, motion = get_motion(filename, params)
+
+    animal = trial = None
+    if name_regex is not None:
+        m = name_regex.match(basename(filename))
+        if m is not None:
+            groups = m.groupdict()
+            animal = groups.get('animal')
+            if groups.get('trial') is not None:
+                trial = int(groups['trial'])
+
+    events = {}
+    fidx = index_filename(filename)
+    if isfile(fidx):
+        with FrameIndex(fidx) as index:
+            events = index.events
+            trial = index.trial
+            n = min(len(index), len(times))
+            if n:
+                # use the source pts in which the events are given
+                src = index.as_array()['pts'][:n]
+                times, motion = np.array(src), motion[:n]
+    elif log_rows is not None:
+        events = log_rows.get((animal, trial), {})
+
+    bouts = freezing_bouts(
+        times, motion, params['motion_threshold'], params['min_freeze'])
+    epochs = trial_epochs(events, params['baseline'], params['post'])
+    return {
+        'filename': filename, 'animal': animal, 'trial': trial,
+        'bouts': bouts, 'epochs': {
+            name: epoch_freezing(bouts, start, end)
+            for name, (start, end) in epochs.items()}}
+
+
+def _analyze_job(args):
+    return analyze_video(*args)
+
+
+def analyze_videos(filenames, params=None, log_filename=None,
+                   name_pattern=None, processes=None):
+    '''Scores the freezing in all the videos using a process pool of
+    ``processes`` workers (the number of CPUs if None) and returns the list
+    of :func:`analyze_video` results in the order of ``filenames``.
+
+    ``log_filename`` is the CSV log and ``name_pattern`` the
+    :attr:`~vet_cond.stages.RootStage.video_name_pat` used for videos without
+    a frame index.
+    '''
+    log_rows = read_log_rows(log_filename) if log_filename else None
+    regex = name_pattern_regex(name_pattern) if name_pattern else None
+    jobs = [(f, params, log_rows, regex) for f in filenames]
+
+    if processes == 1 or len(jobs) < 2:
+        return [_analyze_job(job) for job in jobs]
+
+    pool = Pool(processes)
+    try:
+        return pool.map(_analyze_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def write_summary(results, filename):
+    '''Writes the results of :func:`analyze_videos` to a CSV file with a row
+    for every epoch of every video.
+    '''
+    with open(filename, 'w') as fh:
+        writer = csv.writer(fh, lineterminator='\n')
+        writer.writerow(['Video', 'ID', 'Trial', 'Epoch', 'Start', 'End',
+                         'Freezing', 'Fraction', 'Bouts'])
+        for result in results:
+            for name in EPOCHS:
+                epoch = result['epochs'].get(name)
+                if epoch is None:
+                    continue
+                writer.writerow([
+                    basename(result['filename']), result['animal'],
+                    result['trial'], name, epoch['start'], epoch['end'],
+                    epoch['freezing'], epoch['fraction'], epoch['bouts']])
+
+
+def main(args=None):
+    '''The command line entry point of the analysis.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Scores freezing in the trial videos.')
+    parser.add_argument('videos', nargs='+', help='The trial videos.')
+    parser.add_argument('--log', help='The CSV log of the videos.')
+    parser.add_argument(
+        '--name-pattern', default='{animal}_trial{trial}_%m-%d-%Y_%I-%M-%S_%p'
+        '.avi', help='The pattern used to name the videos.')
+    parser.add_argument('--output', default='freezing.csv',
+                        help='The CSV file to write the results to.')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='The number of worker processes.')
+    for key, value in sorted(DEFAULT_PARAMS.items()):
+        parser.add_argument('--{}'.format(key.replace('_', '-')),
+                            type=type(value), default=value)
+    opts = parser.parse_args(args)
+
+    params = {k: getattr(opts, k) for k in DEFAULT_PARAMS}
+    results = analyze_videos(
+        opts.videos, params, opts.log, opts.name_pattern, opts.processes)
+    write_summary(results, opts.output)
+
+
+if __name__ == '__main__':
+    main()
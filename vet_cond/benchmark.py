@@ -0,0 +1,499 @@
+'''Benchmark
+============
+
+Benchmarks the acquisition, recording, and logging pipeline with synthetic
+frames, so that runs before and after e.g. an ffpyplayer or cplcom upgrade,
+or a config change, can be compared. It measures:
+
+    `encoder`: The throughput of the
+        :class:`~cplcom.moa.device.ffplayer.FFPyWriterDevice` when the frames
+        are passed to it through the
+        :class:`~vet_cond.recording.EncoderPipeline` as fast as possible, and
+        its activation time, for each output pixel format (``ofmt``).
+    `sustained`: The highest frame rate at which frames can be recorded
+        through the :class:`~vet_cond.recording.EncoderPipeline` without the
+        queue overflowing and dropping frames.
+    `session`: A short :mod:`~vet_cond.headless` session, measuring the cost
+        of every :meth:`~vet_cond.stages.RootStage.video_callback` call, the
+        time it takes the writers created from
+        :meth:`~vet_cond.stages.RootStage.configure_animal_settings` to become
+        active, and the cost and latency of
+        :meth:`~vet_cond.stages.RootStage.write_log`, from the trial's end
+        until the row is passed to the log writer.
+
+The frames are the same as the ones generated by
+:class:`~vet_cond.headless.SyntheticVideoDevice`. The results, along with the
+parameters and the versions of the libraries used, are written to a json
+file. From the command line, e.g.::
+
+    python -m vet_cond.benchmark --output benchmark.json --size 640x480
+
+All the durations are in seconds of real time.
+'''
+
+import os
+import sys
+import json
+import shutil
+import platform
+import argparse
+import tempfile
+import traceback
+from time import sleep, strftime
+from collections import deque
+from os.path import join, getsize, exists
+from multiprocessing import Pool
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+from ffpyplayer.pic import SWScale
+
+from cplcom.moa.device.ffplayer import FFPyWriterDevice
+
+from kivy.clock import Clock
+
+from vet_cond.chambers import merge_settings
+from vet_cond.headless import (
+    SyntheticVideoDevice, HeadlessRootStage, HeadlessApp, load_settings,
+    patch_kivy_clock)
+from vet_cond.recording import EncoderPipeline
+from vet_cond.timing import LatencyHistogram, clock
+
+__all__ = ('BenchmarkRootStage', 'make_frames', 'bench_encoder',
+           'bench_sustained', 'bench_session', 'run_benchmarks', 'main')
+
+BENCHMARK_VERSION = 1
+'''The version of the results file format.
+'''
+
+
+class BenchmarkRootStage(HeadlessRootStage):
+    '''The :class:`~vet_cond.headless.HeadlessRootStage` used by
+    :func:`bench_session`, which times its frame, writer, and log methods.
+    '''
+
+    video_callback_times = None
+    '''The :class:`~vet_cond.timing.LatencyHistogram` of the duration of the
+    :meth:`video_callback` calls.
+    '''
+
+    configure_times = None
+    '''The :class:`~vet_cond.timing.LatencyHistogram` of the duration of the
+    :meth:`configure_animal_settings` calls.
+    '''
+
+    writer_activation_times = None
+    '''The :class:`~vet_cond.timing.LatencyHistogram` of the time from the
+    creation of each writer until it's active.
+    '''
+
+    write_log_times = None
+    '''The :class:`~vet_cond.timing.LatencyHistogram` of the duration of the
+    :meth:`write_log` calls.
+    '''
+
+    write_log_latency = None
+    '''The :class:`~vet_cond.timing.LatencyHistogram` of the time from the
+    :meth:`write_log` call until the trial's row is passed to the log writer.
+    '''
+
+    _log_calls = None
+    '''A deque of the times of the :meth:`write_log` calls whose row was not
+    yet written.
+    '''
+
+    _activating = {}
+    '''A dict mapping the writers that are not yet active to their creation
+    time.
+    '''
+
+    def __init__(self, **kwargs):
+        self.video_callback_times = LatencyHistogram(min_value=1e-6)
+        self.configure_times = LatencyHistogram()
+        self.writer_activation_times = LatencyHistogram(max_value=100.)
+        self.write_log_times = LatencyHistogram(min_value=1e-6)
+        self.write_log_latency = LatencyHistogram(max_value=100.)
+        self._log_calls = deque()
+        self._activating = {}
+        super(BenchmarkRootStage, self).__init__(**kwargs)
+
+    def video_callback(self, *largs):
+        ts = clock()
+        super(BenchmarkRootStage, self).video_callback(*largs)
+        self.video_callback_times.add(clock() - ts)
+
+    def configure_animal_settings(self):
+        ts = clock()
+        super(BenchmarkRootStage, self).configure_animal_settings()
+        self.configure_times.add(clock() - ts)
+
+    def _create_writer(self, *largs):
+        writer = super(BenchmarkRootStage, self)._create_writer(*largs)
+        self._activating[writer] = clock()
+        writer.fbind('activation', self._on_writer_activation)
+        return writer
+
+    def _on_writer_activation(self, writer, activation):
+        if activation == 'active' and writer in self._activating:
+            self.writer_activation_times.add(
+                clock() - self._activating.pop(writer))
+
+    def write_log(self):
+        ts = clock()
+        if self.log_writer is not None:
+            self._log_calls.append(ts)
+        super(BenchmarkRootStage, self).write_log()
+        self.write_log_times.add(clock() - ts)
+
+    def _write_log_row(self, *largs):
+        super(BenchmarkRootStage, self)._write_log_row(*largs)
+        if self._log_calls:
+            self.write_log_latency.add(clock() - self._log_calls.popleft())
+
+    def get_results(self):
+        '''Returns a dict with the summaries of all the histograms.
+        '''
+        return {
+            'video_callback': self.video_callback_times.summary(),
+            'configure_animal_settings': self.configure_times.summary(),
+            'writer_activation': self.writer_activation_times.summary(),
+            'write_log': self.write_log_times.summary(),
+            'write_log_latency': self.write_log_latency.summary()}
+
+
+def make_frames(size, count, rate=30., pix_fmt='gray'):
+    '''Returns a list of ``count`` consecutive frames, at ``rate``, generated
+    by :class:`~vet_cond.headless.SyntheticVideoDevice` and converted to
+    ``pix_fmt``.
+    '''
+    device = SyntheticVideoDevice(size=size, rate=rate)
+    frames = [device.make_frame(i / float(rate)) for i in range(count)]
+    if pix_fmt != 'gray':
+        w, h = size
+        sws = SWScale(w, h, 'gray', ofmt=pix_fmt)
+        frames = [sws.scale(frame) for frame in frames]
+    return frames
+
+
+def _tick_until(predicate, timeout=30.):
+    '''Ticks the Kivy clock until ``predicate()`` is true. Returns whether it
+    became true before the timeout.
+    '''
+    end = clock() + timeout
+    while not predicate():
+        if clock() > end:
+            return False
+        Clock.tick()
+        sleep(.001)
+    return True
+
+
+def _open_writer(filename, frame, rate, ofmt):
+    '''Creates and activates a writer for frames like ``frame``, and returns
+    it and the time it took to become active.
+    '''
+    if exists(filename):
+        os.remove(filename)
+    writer = FFPyWriterDevice(
+        filename=filename, rate=rate, size=frame.get_size(),
+        ifmt=frame.get_pixel_format(), ofmt=ofmt)
+    ts = clock()
+    writer.activate('benchmark')
+    if not _tick_until(lambda: writer.activation == 'active'):
+        raise Exception('The writer of "{}" did not activate'.format(
+            filename))
+    return writer, clock() - ts
+
+
+def _close_writer(pipeline, writer):
+    '''Closes the writer once all its frames in the pipeline were written and
+    stops the pipeline. Returns once the writer is inactive.
+    '''
+    pipeline.close_writer(
+        writer, lambda: writer.deactivate('benchmark'))
+    pipeline.stop()
+    if not _tick_until(lambda: writer.activation == 'inactive'):
+        raise Exception('The writer of "{}" did not deactivate'.format(
+            writer.filename))
+
+
+def bench_encoder(frames, ofmt, directory, rate=30., count=300):
+    '''Passes ``count`` frames, cycling through ``frames``, to a writer with
+    output format ``ofmt`` through an
+    :class:`~vet_cond.recording.EncoderPipeline` that never drops frames, as
+    fast as possible. Returns a dict with the writer's `activation` time, the
+    `duration` from the first frame until the video is closed, the resulting
+    `fps`, and the video file's `bytes`.
+    '''
+    filename = join(directory, 'encoder_{}.avi'.format(ofmt or 'default'))
+    writer, activation = _open_writer(filename, frames[0], rate, ofmt)
+
+    pipeline = EncoderPipeline(queue_size=count, overflow='block')
+    pipeline.start()
+    ts = clock()
+    for i in range(count):
+        pipeline.add_frame(writer, frames[i % len(frames)], i / float(rate))
+    _close_writer(pipeline, writer)
+    duration = clock() - ts
+
+    return {
+        'ofmt': ofmt, 'frames': pipeline.frames_written,
+        'activation': activation, 'duration': duration,
+        'fps': pipeline.frames_written / duration if duration else None,
+        'bytes': getsize(filename) if exists(filename) else 0}
+
+
+def bench_sustained(frames, ofmt, directory, rates, duration=3.,
+                    queue_size=90):
+    '''Passes frames to a writer through an
+    :class:`~vet_cond.recording.EncoderPipeline` with a queue of
+    ``queue_size`` frames, paced at each rate in the sorted list ``rates``
+    for ``duration`` seconds, until frames are dropped.
+
+    Returns a dict with the highest rate without dropped frames as
+    `sustained_fps` (None if frames were dropped at the lowest rate) and a
+    list of the results of each rate tried as `rates`.
+    '''
+    filename = join(directory, 'sustained.avi')
+    results = []
+    sustained = None
+
+    for rate in rates:
+        rate = float(rate)
+        writer, _ = _open_writer(filename, frames[0], rate, ofmt)
+        pipeline = EncoderPipeline(
+            queue_size=queue_size, overflow='drop_newest')
+        pipeline.start()
+
+        count = int(rate * duration)
+        ts = clock()
+        for i in range(count):
+            delay = ts + i / rate - clock()
+            if delay > 0:
+                sleep(delay)
+            pipeline.add_frame(writer, frames[i % len(frames)], i / rate)
+        elapsed = clock() - ts
+        dropped = pipeline.frames_dropped
+        max_depth = pipeline.max_queue_depth
+        _close_writer(pipeline, writer)
+
+        results.append({
+            'rate': rate, 'frames': count, 'dropped': dropped,
+            'achieved_rate': count / elapsed if elapsed else None,
+            'max_queue_depth': max_depth})
+        if dropped:
+            break
+        sustained = rate
+
+    return {'ofmt': ofmt, 'queue_size': queue_size,
+            'sustained_fps': sustained, 'rates': results}
+
+
+def _run_session(directory, overrides, warp, max_duration):
+    os.chdir(directory)
+    app = HeadlessApp(
+        animals=[['benchmark', 'benchmark']], warp=warp,
+        max_duration=max_duration, app_settings=load_settings(overrides))
+    app.root_stage_cls = BenchmarkRootStage
+
+    try:
+        result = {'session': app.run_session()}
+        result['session'].pop('timeline', None)
+        result.update(app.root_stage.get_results())
+    except Exception:
+        result = {'error': traceback.format_exc()}
+    return result
+
+
+def bench_session(directory, size, rate=30., trials=3, warp=4.,
+                  overrides=None, max_duration=600.):
+    '''Runs a short headless session with ``trials`` trials of frames of
+    ``size`` at ``rate`` in its own process, writing its logs and videos to
+    ``directory``, and returns a dict with the summaries of the histograms of
+    :meth:`BenchmarkRootStage.get_results` and the session's summary as
+    `session`.
+
+    The settings are the defaults with short habituation periods and ITIs,
+    updated with the nested dict ``overrides``.
+    '''
+    settings = {
+        'experiment': {
+            'prehab': 2, 'posthab': 2, 'prerecord': 1, 'postrecord': 1,
+            'trial_opts': {'benchmark': {
+                'duration': 0, 'iti': [2, 2], 'repeat': trials,
+                'shock': [2, 1], 'tone': [0, 3]}}},
+        'rtv_simulate': {'size': list(size), 'rate': rate}}
+    merge_settings(settings, overrides or {})
+
+    # the clock is replaced for the session, so run it in its own process
+    pool = Pool(1, maxtasksperchild=1)
+    try:
+        return pool.apply(
+            _run_session, (directory, settings, warp, max_duration))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _versions():
+    versions = {'python': sys.version.split()[0]}
+    for name in ('kivy', 'moa', 'cplcom', 'ffpyplayer', 'numpy', 'vet_cond'):
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        versions[name] = getattr(module, '__version__', None)
+    return versions
+
+
+def _run(func, *largs, **kwargs):
+    try:
+        return func(*largs, **kwargs)
+    except Exception:
+        return {'error': traceback.format_exc()}
+
+
+def run_benchmarks(size=(640, 480), rate=30., ofmts=('', ), count=300,
+                   rates=(30, 60, 120, 240, 480), duration=3.,
+                   queue_size=90, trials=3, warp=4., overrides=None,
+                   skip=()):
+    '''Runs the benchmarks and returns a dict with the results, the
+    parameters, and the platform.
+
+    :Parameters:
+
+        `size`: 2-tuple
+            The ``(width, height)`` of the frames.
+        `rate`: float
+            The frame rate of the encoder and session benchmarks.
+        `ofmts`: list
+            The output pixel formats of the writers in the encoder benchmark.
+            The first is also used in the sustained benchmark.
+        `count`: int
+            The number of frames encoded for each format.
+        `rates`: list
+            The frame rates tried in the sustained benchmark.
+        `duration`: float
+            The duration for which each rate is tried.
+        `queue_size`: int
+            The :attr:`~vet_cond.recording.EncoderPipeline.queue_size` of
+            the sustained benchmark.
+        `trials`: int
+            The number of trials of the session benchmark.
+        `warp`: float
+            How much faster than real time the session is run.
+        `overrides`: dict
+            The settings overriding the session's settings.
+        `skip`: list
+            The names of the benchmarks to skip, any of `'encoder'`,
+            `'sustained'`, and `'session'`.
+
+    Errors are reported as the `error` traceback in the result of the
+    benchmark where it occurred.
+    '''
+    params = {
+        'size': list(size), 'rate': rate, 'ofmts': list(ofmts),
+        'count': count, 'rates': sorted(rates), 'duration': duration,
+        'queue_size': queue_size, 'trials': trials, 'warp': warp,
+        'overrides': overrides or {}}
+    results = {}
+    # ticking the clock shouldn't wait for the next frame
+    patch_kivy_clock()
+
+    directory = tempfile.mkdtemp(prefix='vet_cond_benchmark')
+    try:
+        frames = make_frames(size, int(rate * 2), rate)
+        if 'encoder' not in skip:
+            results['encoder'] = [
+                _run(bench_encoder, frames, ofmt, directory, rate, count)
+                for ofmt in ofmts]
+        if 'sustained' not in skip:
+            results['sustained'] = _run(
+                bench_sustained, frames, ofmts[0], directory, sorted(rates),
+                duration, queue_size)
+        if 'session' not in skip:
+            results['session'] = _run(
+                bench_session, directory, size, rate, trials, warp, overrides)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        'version': BENCHMARK_VERSION, 'date': strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': dict(_versions(), system=platform.platform(),
+                         machine=platform.machine(),
+                         processor=platform.processor()),
+        'params': params, 'results': results}
+
+
+def main(args=None):
+    '''The command line entry point of the benchmark. It returns a non-zero
+    exit code if any benchmark failed.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the acquisition and recording pipeline.')
+    parser.add_argument('--output', default='benchmark.json',
+                        help='The json file where the results are written.')
+    parser.add_argument('--size', default='640x480',
+                        help='The frame size as widthxheight.')
+    parser.add_argument('--rate', type=float, default=30.,
+                        help='The frame rate.')
+    parser.add_argument(
+        '--ofmt', action='append', default=[],
+        help='An output pixel format of the encoder benchmark. May be '
+        'repeated. Defaults to the configured video_record ofmt.')
+    parser.add_argument('--count', type=int, default=300,
+                        help='The number of frames encoded for each ofmt.')
+    parser.add_argument('--rates', default='30,60,120,240,480',
+                        help='The comma separated frame rates tried by the '
+                        'sustained benchmark.')
+    parser.add_argument('--duration', type=float, default=3.,
+                        help='The duration each rate is tried.')
+    parser.add_argument('--queue-size', type=int, default=None,
+                        help='The encoder queue size. Defaults to the '
+                        'configured encoder_queue queue_size.')
+    parser.add_argument('--trials', type=int, default=3,
+                        help='The number of trials of the session.')
+    parser.add_argument('--warp', type=float, default=4.,
+                        help='How much faster than real time to run the '
+                        'session.')
+    parser.add_argument('--config', help='A json file with settings '
+                        'overriding the session\'s settings.')
+    parser.add_argument(
+        '--skip', action='append', default=[],
+        choices=['encoder', 'sustained', 'session'],
+        help='A benchmark to skip. May be repeated.')
+    opts = parser.parse_args(args)
+
+    overrides = {}
+    if opts.config:
+        with open(opts.config) as fh:
+            overrides = json.load(fh)
+    settings = load_settings(overrides)
+    ofmts = opts.ofmt or [settings['video_record'].get('ofmt', '')]
+    queue_size = opts.queue_size
+    if queue_size is None:
+        queue_size = settings['encoder_queue'].get('queue_size', 90)
+
+    result = run_benchmarks(
+        size=[int(v) for v in opts.size.split('x')], rate=opts.rate,
+        ofmts=ofmts, count=opts.count,
+        rates=[float(v) for v in opts.rates.split(',')],
+        duration=opts.duration, queue_size=queue_size, trials=opts.trials,
+        warp=opts.warp, overrides=overrides, skip=opts.skip)
+    with open(opts.output, 'w') as fh:
+        json.dump(result, fh, indent=2, sort_keys=True)
+
+    results = result['results']
+    errors = [r['error'] for r in results.get('encoder', []) if 'error' in r]
+    errors += [r['error'] for k, r in results.items()
+               if k != 'encoder' and 'error' in r]
+    session = results.get('session', {}).get('session', {})
+    if session.get('error'):
+        errors.append(session['error'])
+    for error in errors:
+        print(error)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+'''Chambers
+===========
+
+Runs several conditioning chambers from one computer. Each chamber is a
+separate instance of the app, in its own process, with its own RTV port,
+Switch & Sense pins, writers, and log, so the chambers' frame callbacks and
+encoders run on different cores, and the singleton ``knspace`` names, e.g.
+``mcdaq`` and ``player``, don't clash. All the chambers share a single Barst
+server.
+
+The chambers are configured in the ``chambers`` setting of the
+``experiment`` section of the config, a dict mapping each chamber's name to
+the settings that override the rest of the config for that chamber, e.g.::
+
+    "chambers": {
+        "A": {"rtv": {"port": 0},
+              "switch_and_sense_8-8": {"shocker_pin": 4, "tone_pin": 5}},
+        "B": {"rtv": {"port": 1},
+              "switch_and_sense_8-8": {"shocker_pin": 0, "tone_pin": 1}}
+    }
+
+From the command line, e.g.::
+
+    python -m vet_cond.chambers --chamber A --chamber B --output data
+
+starts the Barst server, then an app for chambers `A` and `B`, each run in
+its own directory under ``data``, and closes the server once all the apps
+exited. A chamber's name is also available as ``{chamber}`` in the
+``video_name_pat`` and ``log_name_pat`` settings.
+
+The chambers are read from the app's config file, see :func:`find_config`,
+or from the file given with ``--config``. The config is copied to the
+directory of each chamber that doesn't have its own, so the chambers' apps
+load the same settings as the launcher.
+
+This module doesn't import Kivy, so the launcher itself doesn't open a
+window.
+'''
+
+import os
+import sys
+import json
+import argparse
+import shutil
+import subprocess
+from copy import deepcopy
+from os.path import join, dirname, abspath, isdir, isfile
+
+__all__ = ('CHAMBER_ENV', 'CONFIG_NAME', 'get_chamber', 'find_config',
+           'load_config', 'merge_settings', 'get_chamber_settings',
+           'start_chamber', 'main')
+
+CHAMBER_ENV = 'VET_COND_CHAMBER'
+'''The environment variable holding the name of the chamber run by the app's
+process, if any.
+'''
+
+CONFIG_NAME = 'config.json'
+'''The name of the app's config file.
+'''
+
+
+def get_chamber():
+    '''Returns the name of the chamber run by this process, or ``''`` when
+    it's not run as one of several chambers.
+    '''
+    return os.environ.get(CHAMBER_ENV, '')
+
+
+def find_config(directory='.'):
+    '''Returns the path of the config file the app loads when run from
+    ``directory``; the :attr:`CONFIG_NAME` file in ``directory`` if it
+    exists, otherwise the package's default ``data/config.json``.
+    '''
+    filename = join(directory, CONFIG_NAME)
+    if isfile(filename):
+        return abspath(filename)
+    return join(dirname(__file__), 'data', CONFIG_NAME)
+
+
+def load_config(filename=None):
+    '''Returns the settings of the config file ``filename``, or of the app's
+    config file, see :func:`find_config`, if None.
+    '''
+    with open(filename or find_config()) as fh:
+        return json.load(fh)
+
+
+def merge_settings(dst, src):
+    '''Updates the nested settings dict ``dst`` with ``src``, in place, and
+    returns ``dst``. A dict in ``src`` updates the dict of the same key in
+    ``dst`` rather than replacing it.
+    '''
+    for key, value in src.items():
+        if isinstance(value, dict) and isinstance(dst.get(key), dict):
+            merge_settings(dst[key], value)
+        else:
+            dst[key] = value
+    return dst
+
+
+def get_chamber_settings(settings, chamber):
+    '''Returns a copy of the app's ``settings`` updated with the settings of
+    ``chamber`` from ``settings['experiment']['chambers']``. If ``chamber``
+    is empty, the settings are returned unchanged.
+    '''
+    if not chamber:
+        return settings
+
+    chambers = settings['experiment'].get('chambers', {})
+    if chamber not in chambers:
+        raise ValueError('Chamber "{}" is not listed in the chambers '
+                         'setting'.format(chamber))
+    return merge_settings(deepcopy(settings), chambers[chamber])
+
+
+def _set_affinity(pid, affinity):
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        psutil.Process(pid).cpu_affinity(affinity)
+    elif hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(pid, affinity)
+    else:
+        sys.stderr.write(
+            'Cannot pin the chambers to CPUs, psutil is not installed\n')
+
+
+def start_chamber(chamber, directory, affinity=None, config=None):
+    '''Starts the app of the chamber in a new process, running in
+    ``directory``, and returns the :class:`subprocess.Popen`.
+
+    ``affinity``, if not None, is a list of the CPUs the process may run on.
+    It uses psutil, if installed, which supports Windows and Linux,
+    otherwise :func:`os.sched_setaffinity`, which is not available on
+    Windows, and is otherwise ignored.
+
+    ``config``, if not None, is the config file copied to ``directory`` if
+    it doesn't have its own, for the app to load.
+    '''
+    if not isdir(directory):
+        os.makedirs(directory)
+    if config is not None and not isfile(join(directory, CONFIG_NAME)):
+        shutil.copy(config, join(directory, CONFIG_NAME))
+    env = dict(os.environ)
+    env[CHAMBER_ENV] = chamber
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'vet_cond.main'], cwd=directory, env=env)
+    if affinity:
+        _set_affinity(process.pid, affinity)
+    return process
+
+
+def _open_server(settings):
+    from pybarst.core.server import BarstServer
+    server = BarstServer(barst_path=settings.get('server_path', ''),
+                         pipe_name=settings.get('server_pipe', ''))
+    server.open_server()
+    return server
+
+
+def main(args=None):
+    '''The command line entry point of the launcher. It returns a non-zero
+    exit code if any chamber's app failed.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Runs several chambers, each in its own process.')
+    parser.add_argument(
+        '--chamber', action='append', default=[],
+        help='A chamber to run, as named in the chambers setting. May be '
+        'repeated. Defaults to all the chambers.')
+    parser.add_argument('--config', default=None,
+                        help='The config file listing the chambers. '
+                        'Defaults to the app\'s config file.')
+    parser.add_argument('--output', default='.',
+                        help='The directory under which each chamber is run '
+                        'in a directory of its name.')
+    parser.add_argument('--no-server', action='store_true',
+                        help='Do not start the Barst server, e.g. when '
+                        'simulating or when it is already running.')
+    parser.add_argument('--pin-cpus', action='store_true',
+                        help='Pin each chamber to a different CPU. On '
+                        'Windows, it requires psutil.')
+    opts = parser.parse_args(args)
+
+    config = abspath(opts.config or find_config())
+    settings = load_config(config)
+    chambers = opts.chamber or \
+        sorted(settings['experiment'].get('chambers', {}))
+    if not chambers:
+        parser.error('No chambers are configured')
+    for chamber in chambers:
+        get_chamber_settings(settings, chamber)
+
+    server = None
+    if not opts.no_server:
+        server = _open_server(settings['barst_server'])
+
+    n_cpus = getattr(os, 'cpu_count', lambda: None)() or 1
+    try:
+        processes = [
+            start_chamber(
+                chamber, join(abspath(opts.output), chamber),
+                [i % n_cpus] if opts.pin_cpus else None, config)
+            for i, chamber in enumerate(chambers)]
+        codes = [p.wait() for p in processes]
+    finally:
+        if server is not None:
+            server.close_server()
+
+    for chamber, code in zip(chambers, codes):
+        if code:
+            print('Chamber {} exited with code {}'.format(chamber, code))
+    return 1 if any(codes) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
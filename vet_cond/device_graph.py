@@ -0,0 +1,265 @@
+'''Device Graph
+===============
+
+Activates and deactivates a group of devices according to their
+dependencies, so that independent devices are started and stopped in
+parallel rather than one after the other.
+'''
+
+from functools import partial
+from timeit import default_timer as clock
+
+from kivy.clock import Clock
+from kivy.logger import Logger
+
+__all__ = ('DeviceGraph', )
+
+
+class DeviceGraph(object):
+    '''A dependency graph of devices.
+
+    Devices are added with :meth:`add_device` listing the names of the devices
+    they depend on. :meth:`activate` then activates all the devices without
+    dependencies at once, and every other device as soon as all of its
+    dependencies are active. :meth:`deactivate` does the reverse, a device is
+    deactivated as soon as all the devices that depend on it are inactive.
+    So the total time is the longest dependency path, rather than the sum of
+    the times of all the devices.
+
+    For example::
+
+        graph = DeviceGraph(stage)
+        graph.add_device('server', server)
+        graph.add_device('daq', daq, ['server'])
+        graph.add_device('rtv', rtv, ['server'])
+        graph.activate(callback)
+
+    activates the DAQ and RTV devices in parallel once the server is active,
+    and calls ``callback`` once they are both active.
+
+    The time each device took to activate or deactivate is recorded in
+    :attr:`activation_times` and :attr:`deactivation_times`.
+    '''
+
+    identifier = None
+    '''The identifier used to activate and deactivate the devices.
+    '''
+
+    devices = {}
+    '''A dict mapping device names to the devices.
+    '''
+
+    dependencies = {}
+    '''A dict mapping device names to the list of names of the devices they
+    depend on.
+    '''
+
+    activation_times = {}
+    '''A dict mapping device names to the number of seconds it took them to
+    become active, from the time their activation was started. A device only
+    appears once it's active.
+    '''
+
+    deactivation_times = {}
+    '''Similar to :attr:`activation_times`, but for the deactivation.
+    Devices that timed out are listed with a value of None.
+    '''
+
+    total_time = 0
+    '''The time it took from the start of the last :meth:`activate` or
+    :meth:`deactivate` call until all the devices were done.
+    '''
+
+    _pending = {}
+    '''A dict mapping names of the devices currently being (de)activated to
+    the time it started.
+    '''
+
+    _done = set()
+    '''The names of the devices that finished (de)activating.
+    '''
+
+    _callback = None
+    '''The callback called when done.
+    '''
+
+    _running = False
+    '''Whether we are currently (de)activating the devices.
+    '''
+
+    _state = 'active'
+    '''The activation state the devices are being moved to.
+    '''
+
+    _clear = True
+    '''The ``clear`` value passed to the devices' ``deactivate``.
+    '''
+
+    _timeout = 0
+    '''The deactivation timeout.
+    '''
+
+    _start_time = 0
+    '''The time when the last (de)activation started.
+    '''
+
+    _timeouts = {}
+    '''A dict mapping device names to their scheduled timeout triggers.
+    '''
+
+    def __init__(self, identifier):
+        super(DeviceGraph, self).__init__()
+        self.identifier = identifier
+        self.devices = {}
+        self.dependencies = {}
+        self.activation_times = {}
+        self.deactivation_times = {}
+        self._pending = {}
+        self._done = set()
+        self._timeouts = {}
+
+    def add_device(self, name, device, dependencies=()):
+        '''Adds a device to the graph.
+
+        :Parameters:
+
+            `name`: str
+                A unique name for the device.
+            `device`: :class:`~moa.device.Device`
+                The device.
+            `dependencies`: list
+                The names of the devices this device depends on. They must be
+                added to the graph as well.
+        '''
+        if name in self.devices:
+            raise ValueError('Device "{}" was already added'.format(name))
+        self.devices[name] = device
+        self.dependencies[name] = list(dependencies)
+
+    def _dependents(self, name):
+        return [d for d, deps in self.dependencies.items() if name in deps]
+
+    def _unbind(self):
+        for name, device in self.devices.items():
+            device.funbind('activation', self._on_activation, name)
+        for trigger in self._timeouts.values():
+            trigger.cancel()
+        self._timeouts = {}
+
+    def activate(self, callback=None):
+        '''Activates all the devices, each one once its dependencies are
+        active. ``callback``, if not None, is called with no arguments once
+        all the devices are active.
+        '''
+        for name, deps in self.dependencies.items():
+            for dep in deps:
+                if dep not in self.devices:
+                    raise ValueError(
+                        'Device "{}" depends on unknown device "{}"'.
+                        format(name, dep))
+
+        self._unbind()
+        self._running = True
+        self._state = 'active'
+        self._callback = callback
+        self._pending = {}
+        self._done = set()
+        self.activation_times = {}
+        self._start_time = clock()
+        for name, device in self.devices.items():
+            device.fbind('activation', self._on_activation, name)
+        self._advance()
+
+    def deactivate(self, callback=None, clear=True, timeout=0):
+        '''Deactivates all the devices, each one once all the devices that
+        depend on it are inactive. ``callback``, if not None, is called with no
+        arguments once all the devices are inactive.
+
+        If ``timeout`` is not zero, a device that didn't become inactive
+        within ``timeout`` seconds is considered inactive.
+        '''
+        self._unbind()
+        self._running = True
+        self._state = 'inactive'
+        self._callback = callback
+        self._clear = clear
+        self._timeout = timeout
+        self._pending = {}
+        self._done = set()
+        self.deactivation_times = {}
+        self._start_time = clock()
+        for name, device in self.devices.items():
+            device.fbind('activation', self._on_activation, name)
+        self._advance()
+
+    def _ready(self, name):
+        if self._state == 'active':
+            others = self.dependencies[name]
+        else:
+            others = self._dependents(name)
+        return all(d in self._done for d in others)
+
+    def _advance(self):
+        done = self._done
+        pending = self._pending
+        state = self._state
+
+        for name, device in list(self.devices.items()):
+            if name in done or name in pending or not self._ready(name):
+                continue
+
+            if device.activation == state:
+                self._finish(name, 0.)
+                return self._advance()
+
+            pending[name] = clock()
+            if state == 'active':
+                device.activate(self.identifier)
+            else:
+                if self._timeout:
+                    trigger = self._timeouts[name] = Clock.create_trigger(
+                        partial(self._on_timeout, name), self._timeout)
+                    trigger()
+                device.deactivate(self.identifier, clear=self._clear)
+
+        if len(done) == len(self.devices) and self._running:
+            self._running = False
+            self._unbind()
+            self.total_time = clock() - self._start_time
+            times = (self.activation_times if self._state == 'active' else
+                     self.deactivation_times)
+            Logger.info(
+                'DeviceGraph: all devices {} after {:.3f}s ({})'.format(
+                    self._state, self.total_time, ', '.join(
+                        '{}: {}'.format(k, 'timeout' if v is None else
+                                        '{:.3f}s'.format(v))
+                        for k, v in sorted(times.items()))))
+            callback, self._callback = self._callback, None
+            if callback is not None:
+                callback()
+
+    def _finish(self, name, elapsed):
+        self._pending.pop(name, None)
+        self._done.add(name)
+        trigger = self._timeouts.pop(name, None)
+        if trigger is not None:
+            trigger.cancel()
+
+        if self._state == 'active':
+            self.activation_times[name] = elapsed
+        else:
+            self.deactivation_times[name] = elapsed
+
+    def _on_activation(self, name, instance, value):
+        if value != self._state or name not in self._pending:
+            return
+        self._finish(name, clock() - self._pending[name])
+        self._advance()
+
+    def _on_timeout(self, name, *largs):
+        if name not in self._pending:
+            return
+        Logger.warning('DeviceGraph: "{}" timed out while deactivating'.
+                       format(name))
+        self._finish(name, None)
+        self._advance()
@@ -1,67 +1,152 @@
 '''Devices
 ===========
 
-Defines some of the devices that are used in the experiment.
+Defines some of the devices that are used in the experiment. The device of
+the actual Switch & Sense hardware is in :mod:`~vet_cond.switch_and_sense`, so
+that the hardware libraries are only imported when it's used.
 '''
 
 from moa.device.digital import ButtonPort
 
+from kivy.clock import Clock
 from kivy.properties import (
     ConfigParserProperty, BooleanProperty, ListProperty, ObjectProperty,
     NumericProperty, StringProperty)
 
-from cplcom.moa.device.mcdaq import MCDAQDevice
+from vet_cond.metrics import metrics, timed
+from vet_cond.timing import clock, LatencyHistogram
 
-__all__ = ('DAQOutDeviceBase', 'DAQOutDeviceSim', 'DAQOutDevice')
+__all__ = ('DAQOutDeviceBase', 'DAQOutDeviceSim')
 
 
 class DAQOutDeviceBase(object):
     '''Base class that defines the properties which control the hardware
     devices connected to the Switch and Sense.
+
+    When :attr:`coalesce_writes` is True, the changes requested with
+    :meth:`set_state` are not written immediately, rather, all the changes
+    requested during the same Kivy clock tick are merged and written to the
+    port in a single write at the end of the tick. For each channel the last
+    requested state wins.
+
+    The time from when a change is written until the channel's property
+    reflects the new state is measured in :attr:`write_latency`.
     '''
 
-    shocker = BooleanProperty(False, allownone=True)
-    '''Boolean property that controls the shocker.
+    coalesce_writes = BooleanProperty(True)
+    '''Whether to merge the :meth:`set_state` requests from the same clock
+    tick into a single port write.
     '''
 
-    ir_leds = BooleanProperty(False, allownone=True)
-    '''Boolean property that controls the IR LEDs.
+    write_latency = None
+    '''A :class:`~vet_cond.timing.LatencyHistogram` of the time, in seconds,
+    from when a state change is written until it's acknowledged by the device,
+    i.e. until the channel's property changes to the new state.
     '''
 
-    tone = BooleanProperty(False, allownone=True)
-    '''Boolean property that controls the tone generator.
+    write_count = 0
+    '''The number of writes sent to the device.
     '''
 
+    request_count = 0
+    '''The number of :meth:`set_state` requests.
+    '''
 
-class DAQOutDeviceSim(DAQOutDeviceBase, ButtonPort):
-    '''Device used when simulating a Switch & Sense 8/8 output device,
-    but when none is connected.
+    _pending_state = {}
+    '''A dict mapping channel names to their requested state, for the
+    requests not yet written.
+    '''
+
+    _pending_kwargs = {}
+    '''The other keyword arguments of the requests not yet written.
     '''
-    pass
 
+    _ack_pending = {}
+    '''A dict mapping channel names to ``(state, time)`` of the writes that
+    have not been acknowledged yet.
+    '''
 
-class DAQOutDevice(DAQOutDeviceBase, MCDAQDevice):
-    '''Device used when using the Barst Switch & Sense 8/8 output device.
+    _flush_trigger = None
+    '''The clock trigger that writes the pending requests.
     '''
-    __settings_attrs__ = ('shocker_pin', 'ir_leds_pin', 'tone_pin')
 
     def __init__(self, **kwargs):
-        super(DAQOutDevice, self).__init__(direction='o', **kwargs)
-        self.dev_map = {
-            'shocker': self.shocker_pin, 'ir_leds': self.ir_leds_pin,
-            'tone': self.tone_pin}
-
-    shocker_pin = NumericProperty(4)
-    '''The pin number on the Switch and Sense 8/8 that is connected to and
-    controls the shocker.
+        super(DAQOutDeviceBase, self).__init__(**kwargs)
+        self.write_latency = LatencyHistogram()
+        self._pending_state = {}
+        self._pending_kwargs = {}
+        self._ack_pending = {}
+        self._flush_trigger = Clock.create_trigger(self._flush_state, -1)
+        for name in ('shocker', 'ir_leds', 'tone'):
+            self.fbind(name, self._acknowledge_state, name)
+
+    @timed('daq.set_state')
+    def set_state(self, high=(), low=(), **kwargs):
+        '''Requests that the channels listed in ``high`` be set high and those
+        in ``low`` be set low. See :attr:`coalesce_writes`.
+        '''
+        self.request_count += 1
+        if not self.coalesce_writes:
+            self._write_state(list(high), list(low), kwargs)
+            return
+
+        pending = self._pending_state
+        for name in high:
+            pending[name] = True
+        for name in low:
+            pending[name] = False
+        self._pending_kwargs.update(kwargs)
+        self._flush_trigger()
+
+    def _flush_state(self, *largs):
+        pending = self._pending_state
+        kwargs = self._pending_kwargs
+        if not pending:
+            return
+
+        self._pending_state = {}
+        self._pending_kwargs = {}
+        self._write_state(
+            [name for name, val in pending.items() if val],
+            [name for name, val in pending.items() if not val], kwargs)
+
+    @timed('daq.write')
+    def _write_state(self, high, low, kwargs):
+        ts = clock()
+        ack = self._ack_pending
+        for names, state in ((high, True), (low, False)):
+            for name in names:
+                if getattr(self, name) == state:
+                    ack.pop(name, None)
+                else:
+                    ack[name] = state, ts
+
+        self.write_count += 1
+        super(DAQOutDeviceBase, self).set_state(high=high, low=low, **kwargs)
+
+    def _acknowledge_state(self, name, instance, value):
+        pending = self._ack_pending.get(name)
+        if pending is not None and pending[0] == value:
+            del self._ack_pending[name]
+            latency = clock() - pending[1]
+            self.write_latency.add(latency)
+            metrics.add_time('daq.write_latency', latency)
+
+    shocker = BooleanProperty(False, allownone=True)
+    '''Boolean property that controls the shocker.
     '''
 
-    ir_leds_pin = NumericProperty(6)
-    '''The pin number on the Switch and Sense 8/8 that is connected to and
-    controls the IR LEDs.
+    ir_leds = BooleanProperty(False, allownone=True)
+    '''Boolean property that controls the IR LEDs.
     '''
 
-    tone_pin = NumericProperty(5)
-    '''The pin number on the Switch and Sense 8/8 that is connected to and
-    controls the tone.
+    tone = BooleanProperty(False, allownone=True)
+    '''Boolean property that controls the tone generator.
     '''
+
+
+class DAQOutDeviceSim(DAQOutDeviceBase, ButtonPort):
+    '''Device used when simulating a Switch & Sense 8/8 output device,
+    but when none is connected.
+    '''
+    pass
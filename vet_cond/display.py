@@ -0,0 +1,202 @@
+'''Display
+===========
+
+Controls the live preview of the video, so that showing the frames doesn't
+slow down the experiment or the recording.
+'''
+
+from threading import Thread, Condition
+from functools import partial
+
+from kivy.clock import Clock
+from kivy.event import EventDispatcher
+from kivy.properties import NumericProperty, BooleanProperty
+from kivy.uix.behaviors.knspace import knspace
+
+from cplcom.moa.app import app_error
+
+from vet_cond.metrics import metrics, timed
+from vet_cond.timing import clock
+
+__all__ = ('PreviewController', )
+
+
+class PreviewController(EventDispatcher):
+    '''Passes a throttled, and optionally downscaled, subset of the frames to
+    the preview widget, ``knspace.display``.
+
+    :meth:`add_frame` is called from the Kivy thread for every frame. Only
+    every :attr:`decimation` frame is considered, and frames are further
+    skipped to not show more than :attr:`max_fps` frames per second. When
+    :attr:`scale` is not 1, the frame is downscaled in a worker thread. A new
+    frame is skipped if the previous one was not yet shown, so when the
+    display falls behind frames are skipped rather than queued up.
+
+    The recording is independent of the preview, so none of these settings
+    affect the recorded video.
+    '''
+
+    __settings_attrs__ = ('enabled', 'max_fps', 'decimation', 'scale')
+
+    enabled = BooleanProperty(True)
+    '''Whether to show the frames at all.
+    '''
+
+    max_fps = NumericProperty(15)
+    '''The maximum number of frames per second to show. If zero, the rate is
+    only limited by :attr:`decimation`.
+    '''
+
+    decimation = NumericProperty(1)
+    '''Only every ``decimation`` frame is considered for the preview, e.g. if
+    2, every other frame is skipped.
+    '''
+
+    scale = NumericProperty(1.)
+    '''The factor by which the frames are scaled for the preview, e.g. 0.5
+    halves the width and height. If 1, frames are shown at full size.
+    '''
+
+    frames_shown = 0
+    '''The number of frames shown.
+    '''
+
+    frames_skipped = 0
+    '''The number of frames that were skipped because the previous frame was
+    still being processed or shown.
+    '''
+
+    _count = 0
+    '''The number of frames passed to :meth:`add_frame`.
+    '''
+
+    _last_ts = None
+    '''The time when the last frame was accepted for the preview.
+    '''
+
+    _busy = False
+    '''Whether a frame is currently being scaled or waiting to be shown.
+    '''
+
+    _next_frame = None
+    '''The frame waiting for the worker thread to scale it.
+    '''
+
+    _thread = None
+    '''The worker thread that scales the frames.
+    '''
+
+    _running = False
+    '''Whether the worker thread should keep running.
+    '''
+
+    _cond = None
+    '''The condition guarding :attr:`_next_frame`.
+    '''
+
+    _sws = None
+    '''A tuple of the input size and format and the
+    :class:`ffpyplayer.pic.SWScale` used to scale the frames.
+    '''
+
+    def __init__(self, **kwargs):
+        super(PreviewController, self).__init__(**kwargs)
+        self._cond = Condition()
+
+    def start(self):
+        '''Starts the worker thread, if :attr:`scale` is not 1.
+        '''
+        if self.scale == 1 or self._thread is not None:
+            return
+
+        self._running = True
+        thread = self._thread = Thread(
+            target=self._run_worker, name='PreviewController')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        '''Stops the worker thread.
+        '''
+        if self._thread is None:
+            return
+        self._thread = None
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    @timed('preview.add_frame')
+    def add_frame(self, frame):
+        '''Called with every frame from the Kivy thread, to be possibly shown.
+        '''
+        if not self.enabled:
+            return
+
+        self._count += 1
+        if self._count % max(1, int(self.decimation)):
+            return
+
+        ts = clock()
+        max_fps = self.max_fps
+        if max_fps > 0 and self._last_ts is not None and \
+                ts - self._last_ts < 1. / max_fps:
+            return
+
+        if self._busy:
+            self.frames_skipped += 1
+            metrics.count('preview.frames_skipped')
+            return
+        self._last_ts = ts
+
+        if self._thread is None:
+            self._show_frame(frame)
+            return
+
+        self._busy = True
+        with self._cond:
+            self._next_frame = frame
+            self._cond.notify_all()
+
+    def _show_frame(self, frame, *largs):
+        self._busy = False
+        self.frames_shown += 1
+        ts = clock()
+        knspace.display.update_img(frame)
+        metrics.add_time('display.update_img', clock() - ts)
+
+    @app_error
+    def _report_error(self, e, *largs):
+        self._busy = False
+        raise e
+
+    def _scale_frame(self, frame):
+        size = frame.get_size()
+        fmt = frame.get_pixel_format()
+        sws = self._sws
+        if sws is None or sws[0] != (size, fmt):
+            from ffpyplayer.pic import SWScale
+            scale = self.scale
+            # keep the sizes even for the subsampled pixel formats
+            w = max(2, int(size[0] * scale) // 2 * 2)
+            h = max(2, int(size[1] * scale) // 2 * 2)
+            sws = self._sws = (size, fmt), SWScale(
+                size[0], size[1], fmt, ow=w, oh=h)
+        return sws[1].scale(frame)
+
+    def _run_worker(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while self._running and self._next_frame is None:
+                    cond.wait()
+                if not self._running:
+                    return
+                frame = self._next_frame
+                self._next_frame = None
+
+            try:
+                frame = self._scale_frame(frame)
+            except Exception as e:
+                Clock.schedule_once(partial(self._report_error, e))
+            else:
+                Clock.schedule_once(partial(self._show_frame, frame))
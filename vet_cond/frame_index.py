@@ -0,0 +1,288 @@
+'''Frame Index
+==============
+
+A binary sidecar file written next to each trial video, listing for every
+frame in the video the pts and host time of the source frame and the
+approximate byte offset of the frame in the video file, as well as the trial
+event times. With it, analysis tools can seek directly to e.g. the tone or
+shock window of a video without decoding it from the start.
+
+File format
+-----------
+
+The file starts with a :attr:`HEADER_SIZE` bytes header followed by a
+fixed size record for every frame, all little endian. The header is::
+
+    8 bytes magic (:attr:`INDEX_MAGIC`), uint16 version, uint16 record size,
+    int64 number of frames, int64 trial number, and 6 float64 event times in
+    the order of :attr:`EVENT_KEYS` (-1 if the event didn't occur),
+
+padded with zeros to :attr:`HEADER_SIZE`. Each record is::
+
+    int64 frame number, float64 pts, float64 host time, int64 byte offset
+
+The frame number is the index of the frame in the video. The byte offset is
+the size of the video file when the frame was passed to the encoder, so the
+frame's data is at or after that offset. The number of frames in the header
+is only written when the video is closed, so :class:`FrameIndex` uses the
+file size instead, and an index of a video interrupted by a crash can still
+be read.
+
+The records can be memory mapped directly, e.g. with numpy::
+
+    np.memmap(filename, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE)
+'''
+
+import mmap
+import struct
+from os.path import getsize, splitext
+
+__all__ = ('FrameIndexWriter', 'FrameIndex', 'index_filename',
+           'INDEX_MAGIC', 'HEADER_SIZE', 'EVENT_KEYS', 'RECORD_DTYPE')
+
+INDEX_MAGIC = b'VCFIDX\x00\x01'
+'''The first bytes of the frame index files.
+'''
+
+INDEX_VERSION = 1
+'''The version of the file format.
+'''
+
+HEADER_SIZE = 128
+'''The number of bytes of the header preceding the records.
+'''
+
+EVENT_KEYS = (
+    'trial_ts', 'trial_te', 'tone_ts', 'tone_te', 'shock_ts', 'shock_te')
+'''The names of the trial events stored in the header, in the order they are
+stored. They are the keys used in
+:attr:`~vet_cond.stages.RootStage.trial_stats`.
+'''
+
+RECORD_DTYPE = [('frame', '<i8'), ('pts', '<f8'), ('host', '<f8'),
+                ('offset', '<i8')]
+'''The numpy dtype description of a frame record.
+'''
+
+_header = struct.Struct('<8sHHqq6d')
+_record = struct.Struct('<qddq')
+
+
+def index_filename(video_filename):
+    '''Returns the filename of the frame index of the given video file.
+    '''
+    return '{}.fidx'.format(splitext(video_filename)[0])
+
+
+class FrameIndexWriter(object):
+    '''Writes the frame index of a video.
+
+    It's created when the video's recording starts and all its other methods
+    are called from the encoder thread that writes the frames to the video,
+    see :meth:`~vet_cond.recording.EncoderPipeline.attach_index`. The file
+    is created when the first frame is added.
+    '''
+
+    filename = ''
+    '''The filename of the frame index.
+    '''
+
+    video_filename = ''
+    '''The filename of the video being indexed.
+    '''
+
+    trial = -1
+    '''The trial number stored in the header.
+    '''
+
+    events = {}
+    '''A dict mapping the :attr:`EVENT_KEYS` to the event times, written to
+    the header when the index is closed.
+    '''
+
+    count = 0
+    '''The number of frames added.
+    '''
+
+    _fh = None
+    '''The open file.
+    '''
+
+    def __init__(self, filename, video_filename, trial=-1):
+        super(FrameIndexWriter, self).__init__()
+        self.filename = filename
+        self.video_filename = video_filename
+        self.trial = trial
+        self.events = {}
+
+    def _write_header(self):
+        events = self.events
+        header = _header.pack(
+            INDEX_MAGIC, INDEX_VERSION, _record.size, self.count, self.trial,
+            *[events.get(key, -1) for key in EVENT_KEYS])
+        self._fh.write(header + b'\0' * (HEADER_SIZE - len(header)))
+
+    def _open(self):
+        self._fh = open(self.filename, 'wb')
+        self._write_header()
+
+    def set_events(self, events):
+        '''Sets :attr:`events` from the dict ``events``, which may include
+        other keys too. Must be called before the index is closed.
+        '''
+        self.events = {key: events.get(key, -1) for key in EVENT_KEYS}
+
+    def add_frame(self, pts, host):
+        '''Adds the record of the next frame of the video. It must be called
+        just before or after the frame is passed to the video's encoder.
+        '''
+        if self._fh is None:
+            self._open()
+        try:
+            offset = getsize(self.video_filename)
+        except OSError:
+            offset = -1
+        self._fh.write(_record.pack(self.count, pts, host, offset))
+        self.count += 1
+
+    def close(self):
+        '''Writes the final header and closes the file.
+        '''
+        if self._fh is None:
+            self._open()
+        fh = self._fh
+        fh.seek(0)
+        self._write_header()
+        fh.close()
+        self._fh = None
+
+
+class FrameIndex(object):
+    '''Reads a frame index file by memory mapping it.
+
+    Records are accessed by their frame number, e.g. ``index[10]`` returns
+    the ``(frame, pts, host, offset)`` tuple of the 11th frame of the video.
+    It can be used as a context manager that closes the file on exit.
+    '''
+
+    filename = ''
+    '''The filename of the frame index.
+    '''
+
+    trial = -1
+    '''The trial number of the video.
+    '''
+
+    events = {}
+    '''A dict mapping the :attr:`EVENT_KEYS` to the event times. Events that
+    did not occur have a value of -1.
+    '''
+
+    count = 0
+    '''The number of frames in the index.
+    '''
+
+    _fh = None
+    '''The open file.
+    '''
+
+    _map = None
+    '''The :class:`mmap.mmap` of the file, or None if it has no records.
+    '''
+
+    def __init__(self, filename):
+        super(FrameIndex, self).__init__()
+        self.filename = filename
+        fh = self._fh = open(filename, 'rb')
+        header = fh.read(HEADER_SIZE)
+        if len(header) < _header.size:
+            raise ValueError('"{}" is not a frame index'.format(filename))
+
+        values = _header.unpack_from(header)
+        magic, version, record_size, _, trial = values[:5]
+        if magic != INDEX_MAGIC or record_size != _record.size:
+            raise ValueError('"{}" is not a frame index'.format(filename))
+        if version > INDEX_VERSION:
+            raise ValueError('"{}" has an unsupported version {}'.format(
+                filename, version))
+
+        self.trial = trial
+        self.events = dict(zip(EVENT_KEYS, values[5:]))
+        self.count = (getsize(filename) - HEADER_SIZE) // _record.size
+        if self.count > 0:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *largs):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('Frame {} is out of range'.format(i))
+        return _record.unpack_from(self._map, HEADER_SIZE + i * _record.size)
+
+    def close(self):
+        '''Closes the file.
+        '''
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def get_pts(self, i):
+        '''Returns the pts of frame ``i``.
+        '''
+        return self[i][1]
+
+    def find(self, pts):
+        '''Returns the number of the first frame whose pts is at or after
+        ``pts``, or :attr:`count` if there's none.
+        '''
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_pts(mid) < pts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def window(self, start, end, before=0., after=0.):
+        '''Returns the ``(first, last)`` frame numbers, with ``last``
+        exclusive, of the frames whose pts is within ``start - before`` and
+        ``end + after``. ``start`` and ``end`` are pts or one of
+        :attr:`EVENT_KEYS`, e.g. ``index.window('tone_ts', 'tone_te')``
+        returns the frames during the tone.
+
+        Returns None if an event did not occur.
+        '''
+        if not isinstance(start, (int, float)):
+            start = self.events[start]
+        if not isinstance(end, (int, float)):
+            end = self.events[end]
+        if start == -1 or end == -1:
+            return None
+        return self.find(start - before), self.find(end + after)
+
+    def get_offset(self, i):
+        '''Returns the byte offset in the video at or after which frame ``i``
+        is stored.
+        '''
+        return self[i][3]
+
+    def as_array(self):
+        '''Returns a numpy structured array, with :attr:`RECORD_DTYPE`,
+        memory mapping the records.
+        '''
+        import numpy as np
+        return np.memmap(self.filename, dtype=RECORD_DTYPE, mode='r',
+                         offset=HEADER_SIZE, shape=(self.count, ))
@@ -0,0 +1,601 @@
+'''Headless
+===========
+
+Runs the experiment without the GUI, against a virtual clock that runs
+:attr:`HeadlessApp.warp` times faster than real time and a synthetic video
+source, so that a whole session with its habituation periods and ITIs can be
+checked in seconds. Many sessions can be run in parallel, each in its own
+process.
+
+The experiment is run from the ``RootStage`` rule in ``Experiment.kv``, with
+the hardware simulated as when ``simulate`` is selected in the GUI, except
+that :class:`SyntheticVideoDevice` replaces the video file player. The GUI
+widgets used by the stages are replaced by the minimal stand-ins in this
+module, and the animals are entered automatically from
+:attr:`HeadlessApp.animals`.
+
+From the command line, e.g.::
+
+    python -m vet_cond.headless --animal m1:condition --animal m2:control
+        --warp 100 --sessions 4 --processes 4 --output runs
+
+runs 4 sessions of the two animals in parallel, each in its own directory
+under ``runs``, where the session's logs and videos are written along with
+a ``session.json`` summary.
+
+Note that the host times, e.g. of the log's event stamps, are real times,
+while the video and stage times are virtual times.
+'''
+
+import os
+import sys
+import json
+import argparse
+import traceback
+from time import sleep
+from functools import partial
+from os.path import join, dirname, abspath, isdir
+from multiprocessing import Pool
+
+os.environ.setdefault('KIVY_NO_ARGS', '1')
+
+import numpy as np
+
+from ffpyplayer.pic import Image
+
+from moa.device import Device
+
+import kivy
+import kivy.clock
+from kivy.app import App
+from kivy.clock import Clock
+from kivy.event import EventDispatcher
+from kivy.lang import Builder
+from kivy.logger import Logger
+from kivy.properties import (
+    NumericProperty, ListProperty, StringProperty, OptionProperty,
+    ObjectProperty)
+from kivy.uix.behaviors.knspace import knspace
+
+from vet_cond.chambers import find_config, load_config, merge_settings
+from vet_cond.stages import RootStage
+from vet_cond.timing import clock
+
+__all__ = ('KIVY_CLOCK_VERSIONS', 'patch_kivy_clock', 'VirtualClock',
+           'SyntheticVideoDevice', 'HeadlessRootStage', 'HeadlessApp',
+           'load_settings', 'run_session', 'run_sessions', 'main')
+
+KIVY_CLOCK_VERSIONS = ((1, 9), (2, 3))
+'''The range of the Kivy ``(major, minor)`` versions, inclusive, whose clock
+internals are known to :func:`patch_kivy_clock`.
+'''
+
+
+def patch_kivy_clock(time=None):
+    '''Makes the Kivy :attr:`~kivy.clock.Clock` not limit its frame rate, so
+    that :meth:`~kivy.clock.ClockBase.tick` can be called in a loop, and if
+    ``time`` is not None, makes it use the ``time`` function as its time.
+
+    The clock has no public API for this, so its private attributes are
+    replaced. A warning is logged if the Kivy version is not in
+    :attr:`KIVY_CLOCK_VERSIONS`, and a :class:`RuntimeError` is raised if
+    the attributes don't exist.
+    '''
+    try:
+        version = tuple(int(v) for v in kivy.__version__.split('.')[:2])
+    except ValueError:
+        version = None
+    low, high = KIVY_CLOCK_VERSIONS
+    if version is None or not low <= version <= high:
+        Logger.warning(
+            'Headless: The clock of Kivy {} may not be patched '
+            'correctly'.format(kivy.__version__))
+
+    names = ['_max_fps'] + (['_last_tick'] if time is not None else [])
+    if not all(hasattr(Clock, name) for name in names) or \
+            time is not None and not hasattr(kivy.clock, '_default_time'):
+        raise RuntimeError(
+            'The clock of Kivy {} cannot be patched'.format(kivy.__version__))
+
+    Clock._max_fps = 0
+    if time is not None:
+        kivy.clock._default_time = time
+        Clock.time = time
+        Clock._last_tick = time()
+
+
+class VirtualClock(object):
+    '''A clock that runs :attr:`warp` times faster than real time. Once
+    :meth:`install` is called, the Kivy :attr:`~kivy.clock.Clock` uses it, so
+    all the scheduled events, e.g. the stages' delays, are accelerated.
+    '''
+
+    warp = 1.
+    '''The factor by which the virtual time runs faster than real time.
+    '''
+
+    _real_start = 0
+    '''The real time when the clock was created.
+    '''
+
+    _virtual_start = 0
+    '''The virtual time when the clock was created.
+    '''
+
+    def __init__(self, warp=1.):
+        super(VirtualClock, self).__init__()
+        self.warp = warp
+        self._real_start = self._virtual_start = clock()
+
+    def time(self):
+        '''Returns the current virtual time.
+        '''
+        return self._virtual_start + (clock() - self._real_start) * self.warp
+
+    def install(self):
+        '''Makes the Kivy clock use the virtual time and not limit its frame
+        rate, see :func:`patch_kivy_clock`.
+        '''
+        patch_kivy_clock(self.time)
+
+
+class SyntheticVideoDevice(Device):
+    '''A video device that generates grayscale frames of a bright square
+    moving in a circle on a dark background, at :attr:`rate` frames per second
+    of the Kivy clock's time.
+
+    The square moves for :attr:`move_duration` seconds and then stays still
+    for :attr:`freeze_duration` seconds, in a cycle, so the motion and
+    freezing analysis have something to score.
+
+    It has the properties of the video devices used by
+    :class:`~vet_cond.stages.RootStage`.
+    '''
+
+    __settings_attrs__ = (
+        'rate', 'size', 'move_duration', 'freeze_duration',
+        'max_frames_per_tick')
+
+    rate = NumericProperty(30.)
+    '''The frame rate.
+    '''
+
+    size = ListProperty([320, 240])
+    '''The ``(width, height)`` of the frames.
+    '''
+
+    move_duration = NumericProperty(5.)
+    '''The number of seconds the square moves in each cycle.
+    '''
+
+    freeze_duration = NumericProperty(5.)
+    '''The number of seconds the square stays still in each cycle.
+    '''
+
+    max_frames_per_tick = NumericProperty(10)
+    '''The maximum number of frames generated in a single clock tick. When the
+    clock runs faster than frames can be processed, the remaining frames are
+    skipped, like dropped frames.
+    '''
+
+    display_img_fmt = StringProperty('gray')
+    '''The pixel format of the frames.
+    '''
+
+    last_img = None
+    '''A tuple of the pts and the :class:`ffpyplayer.pic.Image` of the last
+    frame.
+    '''
+
+    frames_generated = 0
+    '''The number of frames generated.
+    '''
+
+    _start = 0
+    '''The clock time when the device was activated.
+    '''
+
+    _count = 0
+    '''The index of the next frame.
+    '''
+
+    _event = None
+    '''The clock event generating the frames.
+    '''
+
+    _background = None
+    '''The background image as a numpy array.
+    '''
+
+    def activate(self, *largs, **kwargs):
+        if not super(SyntheticVideoDevice, self).activate(*largs, **kwargs):
+            return False
+
+        self._start = Clock.get_time()
+        self._count = 0
+        self._event = Clock.schedule_interval(self._generate, 0)
+        self.activation = 'active'
+        return True
+
+    def deactivate(self, *largs, **kwargs):
+        if not super(SyntheticVideoDevice, self).deactivate(*largs, **kwargs):
+            return False
+
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+        self.activation = 'inactive'
+        return True
+
+    def make_frame(self, pts):
+        '''Returns the :class:`ffpyplayer.pic.Image` of the frame at time
+        ``pts``.
+        '''
+        w, h = self.size
+        background = self._background
+        if background is None or background.shape != (h, w):
+            background = self._background = np.full(
+                (h, w), 16, dtype=np.uint8)
+
+        period = self.move_duration + self.freeze_duration
+        cycles, rem = divmod(pts, period) if period > 0 else (0, pts)
+        moving = cycles * self.move_duration + min(rem, self.move_duration)
+
+        side = max(2, h // 6)
+        radius = (min(w, h) - side) // 2 - 1
+        x = int(w // 2 + radius * np.cos(moving) - side // 2)
+        y = int(h // 2 + radius * np.sin(moving) - side // 2)
+
+        img = background.copy()
+        img[max(0, y):y + side, max(0, x):x + side] = 224
+        return Image(plane_buffers=[img.tobytes()], pix_fmt='gray',
+                     size=(w, h), linesize=[w])
+
+    def _generate(self, *largs):
+        elapsed = Clock.get_time() - self._start
+        rate = float(self.rate)
+        due = int(elapsed * rate) + 1 - self._count
+        if due > self.max_frames_per_tick:
+            self._count += due - int(self.max_frames_per_tick)
+
+        while self._count / rate <= elapsed:
+            pts = self._count / rate
+            self._count += 1
+            self.frames_generated += 1
+            self.last_img = pts, self.make_frame(pts)
+            self.dispatch('on_data_update', self)
+
+
+class HeadlessRootStage(RootStage):
+    '''The :class:`~vet_cond.stages.RootStage` used when headless, which
+    uses a :class:`SyntheticVideoDevice` as the simulated video device.
+    '''
+
+    @classmethod
+    def get_config_classes(cls):
+        d = super(HeadlessRootStage, cls).get_config_classes()
+        d['rtv_simulate'] = SyntheticVideoDevice
+        return d
+
+
+class _Switch(EventDispatcher):
+    '''Stands in for the GUI's buttons and switches.
+    '''
+
+    state = OptionProperty('normal', options=['normal', 'down'])
+
+    text = StringProperty('')
+
+
+class _TimeLine(object):
+    '''Stands in for the GUI's time line, recording the slices that become
+    active.
+    '''
+
+    def __init__(self):
+        super(_TimeLine, self).__init__()
+        self.slices = {}
+        self.history = []
+
+    def clear_slices(self):
+        self.slices = {}
+
+    def add_slice(self, name, duration=0, **kwargs):
+        self.slices[name] = dict(kwargs, duration=duration)
+
+    def smear_slices(self):
+        pass
+
+    def update_slice_attrs(self, name, **kwargs):
+        self.slices.setdefault(name, {}).update(kwargs)
+
+    def set_active_slice(self, name, after=None):
+        self.history.append((Clock.get_time(), name))
+
+
+class _Display(object):
+    '''Stands in for the GUI's video display.
+    '''
+
+    frames_shown = 0
+
+    def update_img(self, img):
+        self.frames_shown += 1
+
+
+class HeadlessApp(App):
+    '''Runs a session without the GUI. It's never run as a Kivy app, but it's
+    installed as the running app so that the stages and the error handling
+    can find it.
+    '''
+
+    app_settings = ObjectProperty({})
+    '''The settings, as loaded by :func:`load_settings`.
+    '''
+
+    animals = ListProperty([])
+    '''The list of ``(animal_id, trial_type)`` of the animals to run.
+    '''
+
+    warp = NumericProperty(100.)
+    '''The factor by which the virtual clock runs faster than real time.
+    '''
+
+    max_duration = NumericProperty(24 * 3600.)
+    '''The maximum virtual duration of the session, after which it's stopped
+    and considered failed.
+    '''
+
+    tick_interval = NumericProperty(.001)
+    '''The real time to sleep between clock ticks.
+    '''
+
+    root_stage_cls = HeadlessRootStage
+    '''The class of the root stage, :class:`HeadlessRootStage` or a subclass.
+    '''
+
+    root_stage = None
+    '''The :attr:`root_stage_cls` instance of the session.
+    '''
+
+    error = None
+    '''The traceback of the first error that occurred, or None.
+    '''
+
+    _done = False
+    '''Whether the root stage finished.
+    '''
+
+    _next_animal = 0
+    '''The index in :attr:`animals` of the next animal to run.
+    '''
+
+    _widgets = []
+    '''The GUI stand-ins, kept alive here.
+    '''
+
+    def handle_exception(self, exception, exc_info=None, *largs, **kwargs):
+        '''Records the error and stops the session.
+        '''
+        if self.error is None:
+            if exc_info is not None:
+                self.error = ''.join(traceback.format_exception(*exc_info))
+            else:
+                self.error = repr(exception)
+        self.stop_experiment()
+
+    def stop_experiment(self):
+        '''Stops the session.
+        '''
+        root = self.root_stage
+        if root is not None and root.started and not root.finished:
+            root.step_stage()
+
+    def clean_up_root_stage(self):
+        self._done = True
+
+    def _install_widgets(self):
+        switches = {name: _Switch() for name in (
+            'gui_shocker', 'gui_ir_leds', 'gui_tone', 'gui_simulate',
+            'gui_animal_id', 'gui_trial_type', 'gui_next_animal',
+            'gui_start_stop')}
+        switches['gui_simulate'].state = 'down'
+        objs = dict(switches, time_line=_TimeLine(), display=_Display(),
+                    app=self)
+        for name, obj in objs.items():
+            setattr(knspace, name, obj)
+        self._widgets = list(objs.values())
+
+    def _on_animal_wait(self, instance, started):
+        if not started:
+            return
+        if self._next_animal >= len(self.animals):
+            Clock.schedule_once(lambda *l: self.stop_experiment())
+            return
+
+        animal_id, trial_type = self.animals[self._next_animal]
+        self._next_animal += 1
+        knspace.gui_animal_id.text = animal_id
+        knspace.gui_trial_type.text = trial_type
+        Clock.schedule_once(partial(self._press, knspace.gui_next_animal))
+
+    def _press(self, button, *largs):
+        button.state = 'down'
+        Clock.schedule_once(
+            lambda *l: setattr(button, 'state', 'normal'), .1)
+
+    def run_session(self):
+        '''Runs the session and returns a dict summarizing it.
+        '''
+        vclock = VirtualClock(self.warp)
+        vclock.install()
+        App._running_app = self
+        self._install_widgets()
+
+        Builder.load_file(join(dirname(__file__), 'Experiment.kv'))
+        root = self.root_stage = self.root_stage_cls()
+        knspace.exp_animal_wait.fbind('started', self._on_animal_wait)
+
+        real_start = clock()
+        start = vclock.time()
+        root.step_stage()
+        while not self._done:
+            Clock.tick()
+            if vclock.time() - start > self.max_duration:
+                if self.error is None:
+                    self.error = 'The session timed out'
+                self.stop_experiment()
+                if vclock.time() - start > 2 * self.max_duration:
+                    break
+            sleep(self.tick_interval)
+
+        monitor = root.frame_monitor
+        return {
+            'animals': [list(a) for a in self.animals], 'warp': self.warp,
+            'error': self.error,
+            'animals_run': self._next_animal,
+            'virtual_duration': vclock.time() - start,
+            'real_duration': clock() - real_start,
+            'timeline': [
+                [t - start, name] for t, name in knspace.time_line.history],
+            'frames': monitor.frames if monitor is not None else 0,
+            'frames_dropped': monitor.dropped if monitor is not None else 0,
+            'frames_shown': knspace.display.frames_shown}
+
+
+def load_settings(overrides=None, config=None):
+    '''Returns the settings from the config file ``config``, or the app's
+    config file if None (see :func:`~vet_cond.chambers.find_config`),
+    updated with the nested dict ``overrides``.
+
+    The ``rtv_simulate`` section configures the :class:`SyntheticVideoDevice`
+    instead of the video file player.
+    '''
+    settings = load_config(config)
+    settings['rtv_simulate'] = {}
+    return merge_settings(settings, overrides or {})
+
+
+def run_session(animals, overrides=None, warp=100., output='.',
+                max_duration=24 * 3600., config=None):
+    '''Runs a headless session in the current process and returns its summary,
+    which is also written to ``session.json`` in the ``output`` directory.
+
+    :Parameters:
+
+        `animals`: list
+            The list of ``(animal_id, trial_type)`` of the animals to run.
+        `overrides`: dict
+            The settings overriding the defaults, see :func:`load_settings`.
+        `warp`: float
+            The factor by which the clock runs faster than real time.
+        `output`: str
+            The directory where the logs and videos are written.
+        `max_duration`: float
+            The maximum virtual duration of the session.
+        `config`: str
+            The config file with the settings, see :func:`load_settings`.
+
+    Because the Kivy clock is global, only one session may be run in a
+    process. Use :func:`run_sessions` to run multiple sessions.
+    '''
+    settings = load_settings(overrides, config)
+    output = abspath(output)
+    if not isdir(output):
+        os.makedirs(output)
+    os.chdir(output)
+
+    app = HeadlessApp(
+        animals=animals, warp=warp, max_duration=max_duration,
+        app_settings=settings)
+    try:
+        result = app.run_session()
+    except Exception:
+        result = {'animals': [list(a) for a in animals], 'warp': warp,
+                  'error': traceback.format_exc()}
+
+    with open(join(output, 'session.json'), 'w') as fh:
+        json.dump(result, fh, indent=2, sort_keys=True)
+    return result
+
+
+def _run_session_job(kwargs):
+    return run_session(**kwargs)
+
+
+def run_sessions(sessions, processes=None):
+    '''Runs each session in its own process, using a pool of ``processes``
+    processes, and returns the list of their summaries.
+
+    ``sessions`` is a list of dicts with the keyword arguments of
+    :func:`run_session`.
+    '''
+    pool = Pool(processes, maxtasksperchild=1)
+    try:
+        return pool.map(_run_session_job, sessions, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(args=None):
+    '''The command line entry point of the headless runner. It returns a
+    non-zero exit code if any session failed.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Runs the experiment without the GUI.')
+    parser.add_argument(
+        '--animal', action='append', default=[],
+        help='An animal to run as id:trial_type. May be repeated.')
+    parser.add_argument('--warp', type=float, default=100.,
+                        help='How much faster than real time to run.')
+    parser.add_argument('--config', help='A json file with settings '
+                        'overriding the defaults.')
+    parser.add_argument('--app-config', default=None,
+                        help='The config file with the defaults. Defaults '
+                        'to the app\'s config file.')
+    parser.add_argument('--no-video', action='store_true',
+                        help='Do not record video.')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='The number of sessions to run.')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='The number of sessions to run in parallel.')
+    parser.add_argument('--output', default='.',
+                        help='The directory of the sessions\' output.')
+    parser.add_argument('--max-duration', type=float, default=24 * 3600.,
+                        help='The maximum virtual duration of a session.')
+    opts = parser.parse_args(args)
+
+    animals = [a.split(':', 1) for a in opts.animal] or [['0', 'control']]
+    overrides = {}
+    if opts.config:
+        with open(opts.config) as fh:
+            overrides = json.load(fh)
+    if opts.no_video:
+        merge_settings(overrides, {'experiment': {'record_video': False}})
+
+    sessions = [{
+        'animals': animals, 'overrides': overrides, 'warp': opts.warp,
+        'max_duration': opts.max_duration,
+        'config': abspath(opts.app_config or find_config()),
+        'output': join(opts.output, 'session{}'.format(i))
+        if opts.sessions > 1 else opts.output}
+        for i in range(opts.sessions)]
+    if len(sessions) == 1:
+        results = [run_session(**sessions[0])]
+    else:
+        results = run_sessions(sessions, opts.processes)
+
+    failed = 0
+    for session, result in zip(sessions, results):
+        error = result.get('error')
+        failed += error is not None
+        print('{}: {}'.format(
+            session['output'], 'failed\n{}'.format(error) if error else
+            'done in {:.1f}s ({:.1f}s virtual)'.format(
+                result['real_duration'], result['virtual_duration'])))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,424 @@
+'''Indexer
+==========
+
+A persistent SQLite index of the trials of all the animals, so that e.g. all
+the condition trials of an animal can be found across months of data
+without reading every CSV log.
+
+:meth:`SessionIndex.update` scans directories for the CSV logs written by
+:class:`~vet_cond.trial_log.TrialLogWriter`, recognized by their header, and
+for the trial videos, recognized by the
+:attr:`~vet_cond.stages.RootStage.video_name_pat` pattern. Only files whose
+size or modification time changed since the last scan are read again, and
+files that were removed are dropped from the index.
+
+Each trial row is linked to its video. A video's animal and trial are parsed
+from its filename, and when the video has a :mod:`~vet_cond.frame_index`, it's
+linked to the row with the same trial start time. Otherwise, of the videos
+of that animal and trial, the one modified closest to the time the row was
+logged is used.
+
+From the command line, e.g.::
+
+    python -m vet_cond.indexer --db trials.sqlite --scan data
+        --animal m1 --type condition --output m1.csv
+
+updates the index with the files under ``data`` and writes the condition
+trials of ``m1`` to ``m1.csv``.
+'''
+
+import os
+import csv
+import sys
+import sqlite3
+import argparse
+from time import mktime, strptime
+from os.path import join, dirname, abspath, getsize, getmtime, isfile, \
+    basename
+
+from vet_cond.chambers import load_config
+from vet_cond.frame_index import FrameIndex, index_filename
+from vet_cond.trial_log import TRIAL_COLUMNS
+from vet_cond.utils import name_pattern_regex
+
+__all__ = ('SessionIndex', 'INDEX_VERSION', 'main')
+
+INDEX_VERSION = 1
+'''The version of the index's schema. An index with another version is
+rebuilt.
+'''
+
+DATE_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+'''The format of the dates in the log.
+'''
+
+_sql_types = {'s': 'TEXT', 'q': 'INTEGER', 'd': 'REAL'}
+
+_log_header = [c[0] for c in TRIAL_COLUMNS[:5]]
+'''The first columns of the CSV logs' header, used to recognize them.
+'''
+
+
+def _parse_date(date):
+    try:
+        return mktime(strptime(date, DATE_FORMAT))
+    except (ValueError, OverflowError):
+        return None
+
+
+def _convert(value, typecode):
+    if value is None or value == '':
+        return None
+    try:
+        if typecode == 'q':
+            return int(float(value))
+        if typecode == 'd':
+            return float(value)
+    except ValueError:
+        return None
+    return value
+
+
+class SessionIndex(object):
+    '''An index of the trials logged by the experiment, stored in an SQLite
+    database. It can be used as a context manager that closes the database
+    on exit.
+
+    :Parameters:
+
+        `filename`: str
+            The filename of the database. It's created if it doesn't exist.
+        `video_name_pat`: str
+            The pattern of the video filenames, see
+            :attr:`~vet_cond.stages.RootStage.video_name_pat`.
+        `link_tolerance`: float
+            The maximum number of seconds between the time a row was logged
+            and the modification time of a video without a frame index for
+            the video to be linked to the row.
+    '''
+
+    filename = ''
+    '''The filename of the database.
+    '''
+
+    video_name_pat = '{animal}_trial{trial}_%m-%d-%Y_%I-%M-%S_%p.avi'
+    '''The pattern of the video filenames.
+    '''
+
+    link_tolerance = 3600.
+    '''The maximum time between a row and a video without a frame index for
+    them to be linked.
+    '''
+
+    conn = None
+    '''The :class:`sqlite3.Connection` to the database.
+    '''
+
+    def __init__(self, filename, video_name_pat=None, link_tolerance=3600.):
+        super(SessionIndex, self).__init__()
+        self.filename = filename
+        if video_name_pat is not None:
+            self.video_name_pat = video_name_pat
+        self.link_tolerance = link_tolerance
+        self._video_regex = name_pattern_regex(self.video_name_pat)
+
+        conn = self.conn = sqlite3.connect(filename)
+        conn.row_factory = sqlite3.Row
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != INDEX_VERSION:
+            self._create_tables()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *largs):
+        self.close()
+
+    def close(self):
+        '''Closes the database.
+        '''
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def _create_tables(self):
+        columns = ', '.join(
+            '{} {}'.format(key, _sql_types[typecode])
+            for _, key, typecode in TRIAL_COLUMNS)
+        with self.conn as conn:
+            for table in ('files', 'trials', 'videos'):
+                conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+            conn.execute(
+                'CREATE TABLE files (path TEXT PRIMARY KEY, kind TEXT, '
+                'size INTEGER, mtime REAL)')
+            conn.execute(
+                'CREATE TABLE trials (id INTEGER PRIMARY KEY, log TEXT, '
+                'line INTEGER, timestamp REAL, video TEXT, {})'.format(
+                    columns))
+            conn.execute(
+                'CREATE TABLE videos (path TEXT PRIMARY KEY, animal TEXT, '
+                'trial INTEGER, mtime REAL, trial_ts REAL)')
+            conn.execute('CREATE INDEX trials_animal ON trials (animal, type)')
+            conn.execute('CREATE INDEX trials_type ON trials (type)')
+            conn.execute('CREATE INDEX trials_log ON trials (log)')
+            conn.execute(
+                'CREATE INDEX videos_trial ON videos (animal, trial)')
+            conn.execute('PRAGMA user_version = {}'.format(INDEX_VERSION))
+
+    def _classify(self, path):
+        '''Returns whether the file is a ``'log'``, ``'video'``, or
+        ``'other'`` file.
+        '''
+        if self._video_regex.match(basename(path)):
+            return 'video'
+        if not path.lower().endswith('.csv'):
+            return 'other'
+        try:
+            with open(path, 'r') as fh:
+                header = next(csv.reader(fh), [])
+        except (IOError, OSError, csv.Error):
+            return 'other'
+        return 'log' if header[:len(_log_header)] == _log_header else 'other'
+
+    def _read_log(self, path):
+        rows = []
+        with open(path, 'r') as fh:
+            for line, row in enumerate(csv.DictReader(fh)):
+                values = [_convert(row.get(header), typecode)
+                          for header, _, typecode in TRIAL_COLUMNS]
+                rows.append(
+                    [path, line, _parse_date(row.get('Date') or '')] +
+                    values)
+        columns = ', '.join(key for _, key, _ in TRIAL_COLUMNS)
+        self.conn.executemany(
+            'INSERT INTO trials (log, line, timestamp, {}) VALUES ({})'.format(
+                columns, ', '.join('?' * (3 + len(TRIAL_COLUMNS)))), rows)
+        return set((r[4], r[6]) for r in rows)
+
+    def _read_video(self, path, mtime):
+        groups = self._video_regex.match(basename(path)).groupdict()
+        trial = groups.get('trial')
+        trial_ts = None
+        fidx = index_filename(path)
+        if isfile(fidx):
+            try:
+                with FrameIndex(fidx) as index:
+                    trial_ts = index.events['trial_ts']
+            except (IOError, OSError, ValueError):
+                pass
+        self.conn.execute(
+            'INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?)',
+            (path, groups.get('animal'),
+             int(trial) if trial is not None else None, mtime, trial_ts))
+        return groups.get('animal'), \
+            int(trial) if trial is not None else None
+
+    def _remove(self, path, kind):
+        '''Removes the file from the index and returns the ``(animal,
+        trial)`` whose links may have changed.
+        '''
+        conn = self.conn
+        keys = set()
+        if kind == 'log':
+            keys.update(
+                (r[0], r[1]) for r in conn.execute(
+                    'SELECT animal, trial FROM trials WHERE log = ?',
+                    (path, )))
+            conn.execute('DELETE FROM trials WHERE log = ?', (path, ))
+        elif kind == 'video':
+            keys.update(
+                (r[0], r[1]) for r in conn.execute(
+                    'SELECT animal, trial FROM videos WHERE path = ?',
+                    (path, )))
+            conn.execute('DELETE FROM videos WHERE path = ?', (path, ))
+        conn.execute('DELETE FROM files WHERE path = ?', (path, ))
+        return keys
+
+    def _link(self, keys):
+        '''Links the trials of the ``(animal, trial)`` keys to their videos.
+        '''
+        conn = self.conn
+        tolerance = self.link_tolerance
+        for animal, trial in keys:
+            videos = conn.execute(
+                'SELECT path, mtime, trial_ts FROM videos WHERE animal = ? '
+                'AND trial = ?', (animal, trial)).fetchall()
+            rows = conn.execute(
+                'SELECT id, timestamp, trial_ts FROM trials WHERE animal = ? '
+                'AND trial = ?', (animal, trial)).fetchall()
+
+            for row_id, timestamp, trial_ts in rows:
+                video = None
+                for path, _, video_ts in videos:
+                    if video_ts is not None and video_ts == trial_ts:
+                        video = path
+                        break
+                else:
+                    best = tolerance
+                    for path, mtime, video_ts in videos:
+                        if video_ts is not None or timestamp is None:
+                            continue
+                        if abs(mtime - timestamp) <= best:
+                            best = abs(mtime - timestamp)
+                            video = path
+                conn.execute('UPDATE trials SET video = ? WHERE id = ?',
+                             (video, row_id))
+
+    def update(self, directories, recursive=True):
+        '''Scans the directories and updates the index with the logs and
+        videos that were added, changed, or removed since the last update of
+        these directories. Returns a dict with the number of files
+        `scanned`, `updated`, and `removed`.
+
+        If ``recursive`` is False, only the files directly in the
+        directories are scanned, not their sub-directories.
+        '''
+        conn = self.conn
+        directories = [abspath(d) for d in directories]
+        known = {}
+        for path, kind, size, mtime in conn.execute(
+                'SELECT path, kind, size, mtime FROM files'):
+            if recursive:
+                found = any(path.startswith(join(d, '')) for d in directories)
+            else:
+                found = dirname(path) in directories
+            if found:
+                known[path] = kind, size, mtime
+
+        database = abspath(self.filename)
+        keys = set()
+        scanned = updated = 0
+        with conn:
+            for directory in directories:
+                for root, dirs, files in os.walk(directory):
+                    if not recursive:
+                        del dirs[:]
+                    for name in files:
+                        path = join(root, name)
+                        if path.startswith(database):
+                            continue
+                        try:
+                            size, mtime = getsize(path), getmtime(path)
+                        except OSError:
+                            continue
+                        scanned += 1
+                        old = known.pop(path, None)
+                        if old is not None and old[1:] == (size, mtime):
+                            continue
+
+                        updated += 1
+                        if old is not None:
+                            keys.update(self._remove(path, old[0]))
+                        kind = self._classify(path)
+                        if kind == 'log':
+                            keys.update(self._read_log(path))
+                        elif kind == 'video':
+                            keys.add(self._read_video(path, mtime))
+                        conn.execute(
+                            'INSERT INTO files VALUES (?, ?, ?, ?)',
+                            (path, kind, size, mtime))
+
+            for path, (kind, _, _) in known.items():
+                keys.update(self._remove(path, kind))
+            self._link(keys)
+
+        return {'scanned': scanned, 'updated': updated,
+                'removed': len(known)}
+
+    def query(self, animal=None, trial_type=None, trial=None, start=None,
+              end=None, log=None):
+        '''Returns a list of dicts of the trial rows matching all the given
+        parameters, ordered by the time they were logged.
+
+        :Parameters:
+
+            `animal`, `trial_type`, `trial`: str, str, int
+                The animal ID, experiment type, and trial number.
+            `start`, `end`: float
+                The range of times, in seconds since the epoch, when the rows
+                were logged.
+            `log`: str
+                The filename of the log.
+
+        Each dict has the keys of :attr:`~vet_cond.trial_log.TRIAL_COLUMNS`
+        and `log`, the log's filename, `line`, the row's number in the log,
+        `timestamp`, when it was logged in seconds since the epoch, and
+        `video`, the filename of the trial's video or None.
+        '''
+        conditions = []
+        params = []
+        for column, op, value in (
+                ('animal', '=', animal), ('type', '=', trial_type),
+                ('trial', '=', trial), ('timestamp', '>=', start),
+                ('timestamp', '<', end), ('log', '=', log)):
+            if value is not None:
+                conditions.append('{} {} ?'.format(column, op))
+                params.append(value)
+
+        sql = 'SELECT * FROM trials'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY timestamp, log, line'
+        rows = self.conn.execute(sql, params).fetchall()
+        return [{k: row[k] for k in row.keys() if k != 'id'} for row in rows]
+
+    def get_animals(self):
+        '''Returns a sorted list of the IDs of all the animals in the index.
+        '''
+        return [r[0] for r in self.conn.execute(
+            'SELECT DISTINCT animal FROM trials ORDER BY animal')]
+
+
+def main(args=None):
+    '''The command line entry point of the indexer.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Indexes and queries the trials of the experiment logs.')
+    parser.add_argument('--db', default='trials.sqlite',
+                        help='The index database file.')
+    parser.add_argument('--scan', action='append', default=[],
+                        help='A directory to scan for changes. May be '
+                        'repeated.')
+    parser.add_argument('--video-pattern', default=None,
+                        help='The video filename pattern. Defaults to the '
+                        'video_name_pat of the config.')
+    parser.add_argument('--config', default=None,
+                        help='The config file. Defaults to the app\'s '
+                        'config file.')
+    parser.add_argument('--animal', help='Only list trials of this animal.')
+    parser.add_argument('--type', help='Only list trials of this type.')
+    parser.add_argument('--trial', type=int,
+                        help='Only list trials with this number.')
+    parser.add_argument('--output', help='The CSV file where the trials are '
+                        'written. Defaults to the standard output.')
+    opts = parser.parse_args(args)
+
+    pattern = opts.video_pattern
+    if pattern is None:
+        settings = load_config(opts.config)
+        pattern = settings['experiment']['video_name_pat']
+
+    with SessionIndex(opts.db, video_name_pat=pattern) as index:
+        if opts.scan:
+            stats = index.update(opts.scan)
+            sys.stderr.write(
+                'Scanned {scanned} files, updated {updated}, removed '
+                '{removed}\n'.format(**stats))
+        rows = index.query(
+            animal=opts.animal, trial_type=opts.type, trial=opts.trial)
+
+    headers = [c[0] for c in TRIAL_COLUMNS] + ['Video', 'Log']
+    keys = [c[1] for c in TRIAL_COLUMNS] + ['video', 'log']
+    fh = open(opts.output, 'w') if opts.output else sys.stdout
+    try:
+        writer = csv.writer(fh)
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow(['' if row[k] is None else row[k] for k in keys])
+    finally:
+        if opts.output:
+            fh.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -2,32 +2,107 @@
 ===============
 
 The main module that starts the experiment.
+
+To open quickly, the device classes of the hardware (see
+:mod:`~vet_cond.registry`), the file browser, ffpyplayer, and numpy are not
+imported when the app starts, but only once a session or the replay needs
+them. The time each part of the startup took is logged once the app started,
+see :attr:`ConditioningApp.startup_times`.
+
+When no experiment is running, a recorded session can be replayed from the
+`Replay` button, see :mod:`~vet_cond.replay`.
+
+The experiment can be watched from a browser while it runs when the live
+monitor is enabled, see :mod:`~vet_cond.monitor`.
+
+When the app is closed, it waits up to
+:attr:`ConditioningApp.merge_wait_timeout` for the segmented trial videos to
+be merged, see :mod:`~vet_cond.segments`.
 '''
 
+from timeit import default_timer as clock
+_import_ts = clock()
+
 from functools import partial
 from os.path import join, dirname, isdir
 
 from cplcom.moa.app import ExperimentApp, run_app as run_cpl_app
 
-from kivy.properties import ObjectProperty
+from kivy.properties import ObjectProperty, NumericProperty
 from kivy.resources import resource_add_path
 from kivy.uix.behaviors.knspace import knspace
-from kivy.garden.filebrowser import FileBrowser
+from kivy.factory import Factory
+from kivy.logger import Logger
 from kivy.lang import Builder
 
 import vet_cond.stages
+from vet_cond.monitor import live_monitor
+from vet_cond.registry import import_times, import_class
+from vet_cond.segments import join_mergers
 
 __all__ = ('ConditioningApp', 'run_app')
 
+Factory.register('FileBrowser', module='kivy.garden.filebrowser')
+
 
 class ConditioningApp(ExperimentApp):
     '''The app which runs the experiment.
     '''
 
+    startup_times = {}
+    '''A dict of the number of seconds each part of the startup took:
+    `imports`, importing this module and its dependencies; `init`, creating
+    the app; `kv`, loading the kv files; and `start`, from importing this
+    module until the app started. `lazy_imports` is a dict of the classes
+    imported lazily so far, see :attr:`~vet_cond.registry.import_times`.
+    '''
+
+    replay = ObjectProperty(None, allownone=True)
+    '''The :class:`~vet_cond.replay.ReplayController` replaying a recorded
+    session, created by :meth:`open_replay`, or None.
+    '''
+
+    merge_wait_timeout = NumericProperty(60.)
+    '''The number of seconds to wait, when the app is closed, for the
+    segments of the trial videos to be merged. The segments not merged by
+    then are logged and can be merged later from the command line.
+    '''
+
     def __init__(self, **kwargs):
+        ts = clock()
         super(ConditioningApp, self).__init__(**kwargs)
+        ts_kv = clock()
         Builder.load_file(join(dirname(__file__), 'Experiment.kv'))
         Builder.load_file(join(dirname(__file__), 'display.kv'))
+        self.startup_times = {
+            'imports': ts - _import_ts, 'init': ts_kv - ts,
+            'kv': clock() - ts_kv}
+
+    def on_start(self):
+        super(ConditioningApp, self).on_start()
+        times = self.startup_times
+        times['start'] = clock() - _import_ts
+        times['lazy_imports'] = dict(import_times)
+        Logger.info(
+            'VetCond: Started in {start:.2f}s (imports {imports:.2f}s, app '
+            '{init:.2f}s, kv {kv:.2f}s)'.format(**times))
+
+    def on_stop(self):
+        super(ConditioningApp, self).on_stop()
+        live_monitor.stop()
+        pending = join_mergers(self.merge_wait_timeout)
+        if pending:
+            Logger.warning(
+                'VetCond: The app closed before the segments of {} were '
+                'merged, merge them with "python -m vet_cond.segments"'.format(
+                    ', '.join(pending)))
+
+    def open_replay(self):
+        '''Lets the user select a session log to replay.
+        '''
+        if self.replay is None:
+            self.replay = import_class('vet_cond.replay:ReplayController')()
+        self.replay.browse()
 
     def clean_up_root_stage(self):
         super(ConditioningApp, self).clean_up_root_stage()
@@ -0,0 +1,394 @@
+'''Metrics
+==========
+
+Lightweight instrumentation of the hot paths of the experiment, e.g. the
+per-frame :meth:`~vet_cond.stages.RootStage.video_callback`, so that when a
+session stutters it can be tied to the code that was slow.
+
+The global :attr:`metrics` holds named timers, which are
+:class:`~vet_cond.timing.LatencyHistogram` of durations, and named counters.
+Functions and methods are timed with the :func:`timed` decorator, e.g.::
+
+    @timed('encoder.add_frame')
+    def add_frame(self, writer, frame, pts, host=-1):
+        ...
+
+and events are counted with ``metrics.count('encoder.frames_dropped')``.
+
+:meth:`Metrics.watch_delays` additionally measures how late each
+:class:`~moa.stages.delay.Delay` stage of the experiment ends relative to its
+scheduled delay, along with the load of the frame path during the delay, so
+that e.g. a late shock or tone can be related to slow frames.
+
+Optionally, a :class:`SamplingProfiler` samples the stack of the Kivy thread
+while a session runs.
+
+The metrics of a session are written by
+:meth:`~vet_cond.stages.RootStage.configure_animal_settings` to
+``<log>_metrics.json`` next to the log when the log is closed, and the
+profile, if enabled, to ``<log>_profile.txt``.
+'''
+
+import sys
+import json
+import threading
+from time import sleep
+from functools import wraps
+
+from kivy.clock import Clock
+from kivy.event import EventDispatcher
+from kivy.properties import BooleanProperty, NumericProperty
+
+from moa.stages.delay import Delay
+
+from vet_cond.timing import clock, LatencyHistogram
+
+__all__ = ('Metrics', 'SamplingProfiler', 'metrics', 'timed')
+
+
+class SamplingProfiler(object):
+    '''Samples the call stack of a thread every :attr:`interval` seconds from
+    a background thread and counts how often each stack was seen.
+
+    Unlike a deterministic profiler, the profiled thread is not slowed down
+    by the function calls, only by the sampling itself. The counts are
+    written in the collapsed stack format, one ``func;func;func count`` line
+    per stack, which can be read by flame graph tools.
+    '''
+
+    interval = .005
+    '''The time between samples.
+    '''
+
+    max_depth = 64
+    '''The maximum number of frames of a stack that are recorded, starting
+    from the innermost.
+    '''
+
+    stacks = {}
+    '''A dict mapping the stacks, tuples of ``file:function`` strings from the
+    outermost, to the number of times they were sampled.
+    '''
+
+    samples = 0
+    '''The number of samples taken.
+    '''
+
+    _ident = None
+    '''The ident of the profiled thread.
+    '''
+
+    _thread = None
+    '''The sampling thread.
+    '''
+
+    _running = False
+    '''Whether the sampling thread should keep running.
+    '''
+
+    def __init__(self, interval=.005):
+        super(SamplingProfiler, self).__init__()
+        self.interval = interval
+        self.stacks = {}
+
+    def start(self):
+        '''Starts sampling the calling thread.
+        '''
+        if self._thread is not None:
+            return
+        self._ident = threading.current_thread().ident
+        self._running = True
+        thread = self._thread = threading.Thread(
+            target=self._run, name='SamplingProfiler')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        '''Stops sampling.
+        '''
+        if self._thread is None:
+            return
+        self._running = False
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        stacks = self.stacks
+        ident = self._ident
+        max_depth = self.max_depth
+        while self._running:
+            sleep(self.interval)
+            frame = sys._current_frames().get(ident)
+            stack = []
+            while frame is not None and len(stack) < max_depth:
+                code = frame.f_code
+                stack.append('{}:{}'.format(code.co_filename, code.co_name))
+                frame = frame.f_back
+            if not stack:
+                continue
+
+            stack = tuple(reversed(stack))
+            stacks[stack] = stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def write(self, filename):
+        '''Writes the sampled stacks to the file, most common first.
+        '''
+        items = sorted(self.stacks.items(), key=lambda x: -x[1])
+        with open(filename, 'w') as fh:
+            for stack, count in items:
+                fh.write('{} {}\n'.format(';'.join(stack), count))
+
+
+class Metrics(EventDispatcher):
+    '''The registry of the named timers and counters, and of the
+    :class:`~moa.stages.delay.Delay` lags. Use the global :attr:`metrics`
+    instance.
+
+    When :attr:`enabled` is False, :func:`timed` functions are called
+    without being timed and nothing is recorded.
+    '''
+
+    __settings_attrs__ = (
+        'enabled', 'profile', 'profile_interval', 'max_delay_events')
+
+    enabled = BooleanProperty(True)
+    '''Whether to record the metrics.
+    '''
+
+    profile = BooleanProperty(False)
+    '''Whether to run a :class:`SamplingProfiler` on the Kivy thread during
+    each session.
+    '''
+
+    profile_interval = NumericProperty(.005)
+    '''The time between the samples of the profiler.
+    '''
+
+    max_delay_events = NumericProperty(10000)
+    '''The maximum number of Delay stages listed in :attr:`delay_events`.
+    Later ones are only added to the lag histograms.
+    '''
+
+    timers = {}
+    '''A dict mapping timer names to their
+    :class:`~vet_cond.timing.LatencyHistogram`.
+    '''
+
+    counters = {}
+    '''A dict mapping counter names to their values.
+    '''
+
+    delay_lags = {}
+    '''A dict mapping the names of the Delay stages to the
+    :class:`~vet_cond.timing.LatencyHistogram` of the time they ended after
+    their scheduled delay.
+    '''
+
+    delay_events = []
+    '''A list of dicts describing each Delay stage that ended: its `stage`
+    name, `start` clock time relative to :meth:`start`, scheduled `delay`,
+    `lag`, and the number (`frames`) and mean duration (`frame_time`) of the
+    ``video_callback`` calls during the delay.
+    '''
+
+    profiler = None
+    '''The :class:`SamplingProfiler` of the current session, or None.
+    '''
+
+    _start = 0
+    '''The clock time when the session started.
+    '''
+
+    _watched = []
+    '''The list of ``(stage, event, uid)`` of the Delay stage bindings.
+    '''
+
+    _delay_starts = {}
+    '''A dict mapping the running Delay stages to their start time and the
+    ``video_callback`` count and total at that time.
+    '''
+
+    _lock = None
+    '''The lock guarding :attr:`timers` and :attr:`counters`, which are also
+    updated from other threads, e.g. the encoder's worker thread.
+    '''
+
+    def __init__(self, **kwargs):
+        super(Metrics, self).__init__(**kwargs)
+        self._watched = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Removes all the recorded metrics.
+        '''
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+        self.delay_lags = {}
+        self.delay_events = []
+        self._delay_starts = {}
+        self._start = Clock.get_boottime()
+
+    def add_time(self, name, value):
+        '''Adds the duration ``value`` to the timer ``name``.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = LatencyHistogram(min_value=1e-6)
+            timer.add(value)
+
+    def merge_times(self, name, histogram):
+        '''Adds the values of the
+        :class:`~vet_cond.timing.LatencyHistogram` ``histogram``, e.g. one
+        recorded in another process, to the timer ``name``.
+        '''
+        if not self.enabled:
+            return
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = LatencyHistogram(min_value=1e-6)
+            timer.merge(histogram)
+
+    def count(self, name, n=1):
+        '''Increments the counter ``name`` by ``n``.
+        '''
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def get_counters(self):
+        '''Returns a copy of :attr:`counters`. Unlike copying it directly,
+        it's safe while other threads update the counters.
+        '''
+        with self._lock:
+            return dict(self.counters)
+
+    def start(self):
+        '''Starts a session, resetting the metrics and starting the
+        :attr:`profiler` if :attr:`profile`. Must be called from the Kivy
+        thread.
+        '''
+        self.stop()
+        self.reset()
+        if self.enabled and self.profile:
+            profiler = self.profiler = SamplingProfiler(
+                self.profile_interval)
+            profiler.start()
+
+    def stop(self, filename=None, profile_filename=None):
+        '''Ends the session, stopping the :attr:`profiler`, and writes the
+        metrics to ``filename`` and the profile to ``profile_filename``,
+        if not None.
+        '''
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.stop()
+        if filename and self.enabled:
+            with open(filename, 'w') as fh:
+                json.dump(self.get_summary(), fh, indent=2, sort_keys=True)
+
+        self.profiler = None
+        if profiler is not None and profile_filename:
+            profiler.write(profile_filename)
+
+    def get_summary(self):
+        '''Returns a dict with the summaries of all the metrics.
+        '''
+        with self._lock:
+            timers = {k: v.summary() for k, v in self.timers.items()}
+            counters = dict(self.counters)
+        return {
+            'duration': Clock.get_boottime() - self._start,
+            'timers': timers, 'counters': counters,
+            'delay_lags': {
+                k: v.summary() for k, v in self.delay_lags.items()},
+            'delay_events': list(self.delay_events),
+            'profile_samples':
+                self.profiler.samples if self.profiler is not None else 0}
+
+    def watch_delays(self, stage):
+        '''Measures the lag of all the :class:`~moa.stages.delay.Delay`
+        stages under ``stage``, including itself, until
+        :meth:`unwatch_delays` is called.
+
+        A stage is named by its ``knsname``, or ``'delay'`` if it has none.
+        '''
+        stages = [stage]
+        while stages:
+            s = stages.pop()
+            stages.extend(s.stages)
+            if not isinstance(s, Delay):
+                continue
+            self._watched.append((s, 'on_stage_start', s.fbind(
+                'on_stage_start', self._delay_start, s)))
+            self._watched.append((s, 'on_stage_end', s.fbind(
+                'on_stage_end', self._delay_end, s)))
+
+    def unwatch_delays(self):
+        '''Stops measuring the lag of the stages of :meth:`watch_delays`.
+        '''
+        for stage, event, uid in self._watched:
+            stage.unbind_uid(event, uid)
+        self._watched = []
+        self._delay_starts = {}
+
+    def _delay_start(self, stage, *largs):
+        timer = self.timers.get('video_callback')
+        self._delay_starts[stage] = (
+            Clock.get_boottime(), timer.count if timer else 0,
+            timer.total if timer else 0)
+
+    def _delay_end(self, stage, *largs):
+        start = self._delay_starts.pop(stage, None)
+        if start is None or not self.enabled:
+            return
+
+        ts, count, total = start
+        lag = Clock.get_boottime() - ts - stage.delay
+        if lag < 0:  # it was stopped before the delay was done
+            return
+
+        name = stage.knsname or 'delay'
+        lags = self.delay_lags.get(name)
+        if lags is None:
+            lags = self.delay_lags[name] = LatencyHistogram()
+        lags.add(lag)
+
+        if len(self.delay_events) >= self.max_delay_events:
+            return
+        timer = self.timers.get('video_callback')
+        frames = (timer.count if timer else 0) - count
+        self.delay_events.append({
+            'stage': name, 'start': ts - self._start, 'delay': stage.delay,
+            'lag': lag, 'frames': frames,
+            'frame_time': ((timer.total - total) / frames) if frames else 0})
+
+
+metrics = Metrics()
+'''The global :class:`Metrics` used by :func:`timed`.
+'''
+
+
+def timed(name):
+    '''Decorator that adds the duration of each call of the decorated function
+    to the timer ``name`` of :attr:`metrics`, if it's
+    :attr:`Metrics.enabled`.
+    '''
+    def decorator(f):
+        @wraps(f)
+        def timed_func(*largs, **kwargs):
+            if not metrics.enabled:
+                return f(*largs, **kwargs)
+            ts = clock()
+            try:
+                return f(*largs, **kwargs)
+            finally:
+                metrics.add_time(name, clock() - ts)
+        return timed_func
+    return decorator
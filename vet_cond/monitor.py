@@ -0,0 +1,505 @@
+'''Live Monitor
+===============
+
+An optional local HTTP server, so that the chambers can be checked from
+another computer rather than at each rig. It serves a live, downscaled MJPEG
+stream of the video and the state of the experiment, e.g. the active
+time line slice, the Switch & Sense pins, and the frame rate and dropped
+frames.
+
+The server is configured in the ``monitor`` section of the config and, when
+:attr:`LiveMonitor.enabled`, it's started with the first session and keeps
+serving until the app exits. It serves the following paths:
+
+    ``/``
+        A page showing the stream and the status.
+    ``/stream.mjpg``
+        The MJPEG stream.
+    ``/frame.jpg``
+        The most recent frame, as a JPEG image.
+    ``/status.json``
+        The status of the experiment, see :meth:`LiveMonitor.get_status`.
+
+By default, the server only listens on ``localhost``. To watch from other
+computers, set ``host`` to ``'0.0.0.0'``. When several chambers are run from
+the same computer, each chamber's ``monitor`` settings must use a different
+``port``.
+
+Encoding the frames as JPEG requires Pillow.
+'''
+
+import json
+import socket
+from io import BytesIO
+from time import time
+from threading import Thread, Condition
+from functools import partial
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+from kivy.clock import Clock
+from kivy.event import EventDispatcher
+from kivy.logger import Logger
+from kivy.properties import (
+    BooleanProperty, NumericProperty, StringProperty)
+from kivy.uix.behaviors.knspace import knspace
+
+from cplcom.moa.app import app_error
+
+from vet_cond.chambers import get_chamber
+from vet_cond.metrics import metrics, timed
+from vet_cond.timing import clock
+
+__all__ = ('LiveMonitor', 'live_monitor')
+
+_index_page = b'''<!DOCTYPE html>
+<html>
+<head><title>VetCond</title></head>
+<body>
+<img src="/stream.mjpg">
+<pre id="status"></pre>
+<script>
+function update() {
+    fetch('/status.json').then(function(r) {return r.json();}).then(
+        function(s) {
+            document.getElementById('status').textContent =
+                JSON.stringify(s, null, 2);
+        });
+}
+update();
+setInterval(update, 1000);
+</script>
+</body>
+</html>
+'''
+
+
+def _active_slice(time_line):
+    '''Returns the name of the active slice of the time line, or ``''``.
+    '''
+    names = getattr(time_line, 'slice_names', None) or []
+    i = getattr(time_line, 'current_slice', None)
+    if i is None or not 0 <= i < len(names):
+        return ''
+    return names[i]
+
+
+class _MonitorServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    allow_reuse_address = True
+
+    monitor = None
+    '''The :class:`LiveMonitor` that is served.
+    '''
+
+
+class _MonitorHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        Logger.debug('VetCond: Monitor {} - {}'.format(
+            self.address_string(), format % args))
+
+    def _send(self, data, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        monitor = self.server.monitor
+        path = self.path.split('?')[0]
+        try:
+            if path == '/':
+                self._send(_index_page, 'text/html')
+            elif path == '/status.json':
+                self._send(monitor.status_data, 'application/json')
+            elif path == '/frame.jpg':
+                jpeg = monitor.get_jpeg()
+                if jpeg is None:
+                    self.send_error(503, 'No frames')
+                else:
+                    self._send(jpeg, 'image/jpeg')
+            elif path == '/stream.mjpg':
+                self._stream(monitor)
+            else:
+                self.send_error(404)
+        except (socket.error, IOError):
+            # the client disconnected
+            pass
+
+    def _stream(self, monitor):
+        self.send_response(200)
+        self.send_header(
+            'Content-Type', 'multipart/x-mixed-replace; boundary=frame')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+
+        monitor.add_viewer(1)
+        try:
+            count = 0
+            while monitor.serving:
+                jpeg, count = monitor.wait_jpeg(count, timeout=1.)
+                if jpeg is None:
+                    continue
+                self.wfile.write(
+                    b'--frame\r\nContent-Type: image/jpeg\r\n'
+                    b'Content-Length: ' + str(len(jpeg)).encode('ascii') +
+                    b'\r\n\r\n' + jpeg + b'\r\n')
+        finally:
+            monitor.add_viewer(-1)
+
+
+class LiveMonitor(EventDispatcher):
+    '''Serves the live video and the status of the experiment over HTTP, as
+    described in :mod:`~vet_cond.monitor`.
+
+    :meth:`add_frame` is called from the Kivy thread for every frame. While
+    someone watches the stream or recently requested a frame, at most
+    :attr:`max_fps` frames per second are scaled and encoded in a worker
+    thread. The latest JPEG is shared by all the viewers, so the work doesn't
+    grow with the number of viewers. A new frame is skipped if the worker
+    hasn't finished with the previous one. A slow viewer skips frames rather
+    than delaying the others. So the monitor never delays the acquisition or
+    the recording.
+
+    The status is collected from the Kivy thread every
+    :attr:`status_interval` seconds and served as is to all the requests.
+
+    The global instance is :attr:`live_monitor`.
+    '''
+
+    __settings_attrs__ = (
+        'enabled', 'host', 'port', 'max_fps', 'width', 'quality',
+        'status_interval')
+
+    enabled = BooleanProperty(False)
+    '''Whether to run the server.
+    '''
+
+    host = StringProperty('127.0.0.1')
+    '''The address on which the server listens. ``'127.0.0.1'`` only serves
+    the local computer, ``'0.0.0.0'`` serves all the computers on the
+    network.
+    '''
+
+    port = NumericProperty(8080)
+    '''The port on which the server listens.
+    '''
+
+    max_fps = NumericProperty(5)
+    '''The maximum number of frames per second that are encoded for the
+    stream.
+    '''
+
+    width = NumericProperty(320)
+    '''The width of the streamed frames. The height is scaled to keep the
+    aspect ratio. If zero, the frames are not scaled.
+    '''
+
+    quality = NumericProperty(70)
+    '''The JPEG quality of the streamed frames, from 1 to 95.
+    '''
+
+    status_interval = NumericProperty(.5)
+    '''How often, in seconds, the status served in ``/status.json`` is
+    updated.
+    '''
+
+    serving = False
+    '''Whether the server is running.
+    '''
+
+    status_data = b'{}'
+    '''The JSON encoded status last returned by :meth:`get_status`.
+    '''
+
+    frames_encoded = 0
+    '''The number of frames encoded.
+    '''
+
+    frames_skipped = 0
+    '''The number of frames that were skipped because the previous frame was
+    still being encoded.
+    '''
+
+    viewers = 0
+    '''The number of clients watching the stream.
+    '''
+
+    stage = None
+    '''The :class:`~vet_cond.stages.RootStage` whose status is served, or
+    None.
+    '''
+
+    _server = None
+    '''The :class:`_MonitorServer`.
+    '''
+
+    _address = None
+    '''The ``(host, port)`` on which :attr:`_server` listens.
+    '''
+
+    _threads = []
+    '''The server and the encoder threads.
+    '''
+
+    _cond = None
+    '''The condition guarding :attr:`_next_frame`, :attr:`_jpeg`, and
+    :attr:`_jpeg_count`.
+    '''
+
+    _next_frame = None
+    '''The frame waiting for the worker thread to encode it.
+    '''
+
+    _jpeg = None
+    '''The most recent encoded frame.
+    '''
+
+    _jpeg_count = 0
+    '''The number of frames encoded since the server started, used by the
+    viewers to wait for the next frame.
+    '''
+
+    _last_ts = None
+    '''The time when the last frame was accepted for encoding.
+    '''
+
+    _request_ts = None
+    '''The time when a single frame was last requested.
+    '''
+
+    _status_event = None
+    '''The clock event updating :attr:`status_data`.
+    '''
+
+    _sws = None
+    '''A tuple of the input size and format and the
+    :class:`ffpyplayer.pic.SWScale` used to scale the frames.
+    '''
+
+    def __init__(self, **kwargs):
+        super(LiveMonitor, self).__init__(**kwargs)
+        self._cond = Condition()
+        self._threads = []
+
+    def start(self, stage=None):
+        '''Starts the server, if :attr:`enabled`, and serves the status of
+        ``stage``. If the server is already running on the same address, it
+        keeps running. Must be called from the Kivy thread.
+        '''
+        self.stage = stage
+        address = self.host, int(self.port)
+        if self.serving and (not self.enabled or address != self._address):
+            self.stop()
+        if not self.enabled or self.serving:
+            return
+
+        try:
+            import PIL.Image
+        except ImportError:
+            raise ImportError('The live monitor requires Pillow')
+
+        server = self._server = _MonitorServer(address, _MonitorHandler)
+        server.monitor = self
+        self._address = address
+        self.serving = True
+        self._jpeg = self._next_frame = self._last_ts = None
+        self._request_ts = None
+        self._threads = []
+        for target, name in ((server.serve_forever, 'LiveMonitorServer'),
+                             (self._run_encoder, 'LiveMonitorEncoder')):
+            thread = Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        self._update_status()
+        self._status_event = Clock.schedule_interval(
+            self._update_status, self.status_interval)
+        Logger.info('VetCond: Serving the live monitor at http://{}:{}/'.
+                    format(*address))
+
+    def stop(self):
+        '''Stops the server. Must be called from the Kivy thread.
+        '''
+        if not self.serving:
+            return
+        if self._status_event is not None:
+            self._status_event.cancel()
+            self._status_event = None
+        with self._cond:
+            self.serving = False
+            self._cond.notify_all()
+        server = self._server
+        self._server = None
+        server.shutdown()
+        server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    @timed('monitor.add_frame')
+    def add_frame(self, frame):
+        '''Called with every frame from the Kivy thread, to be possibly
+        streamed.
+        '''
+        if not self.serving:
+            return
+
+        ts = clock()
+        if not self.viewers and (
+                self._request_ts is None or ts - self._request_ts > 5.):
+            return
+        max_fps = self.max_fps
+        if max_fps > 0 and self._last_ts is not None and \
+                ts - self._last_ts < 1. / max_fps:
+            return
+
+        if self._next_frame is not None:
+            self.frames_skipped += 1
+            metrics.count('monitor.frames_skipped')
+            return
+        self._last_ts = ts
+
+        with self._cond:
+            self._next_frame = frame
+            self._cond.notify_all()
+
+    def add_viewer(self, n):
+        '''Called from the server threads when a viewer starts, ``n = 1``, or
+        stops, ``n = -1``, watching the stream.
+        '''
+        with self._cond:
+            self.viewers += n
+
+    def wait_jpeg(self, count, timeout=None):
+        '''Waits until a frame newer than the ``count`` encoded frame is
+        available and returns a tuple of the frame and its count. If there's
+        no newer frame once ``timeout`` elapsed, the frame is None.
+        '''
+        end = None if timeout is None else clock() + timeout
+        with self._cond:
+            # the condition is also notified when a frame is passed to the
+            # worker thread
+            while self._jpeg_count == count and self.serving:
+                remaining = None if end is None else end - clock()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._jpeg_count == count:
+                return None, count
+            return self._jpeg, self._jpeg_count
+
+    def get_jpeg(self):
+        '''Returns the most recent frame as a JPEG, waiting for a new frame to
+        be encoded if the stream is not being watched. Returns None if there
+        are no frames.
+        '''
+        self._request_ts = clock()
+        jpeg, count = self._jpeg, self._jpeg_count
+        if self.viewers and jpeg is not None:
+            return jpeg
+        new_jpeg, _ = self.wait_jpeg(count, timeout=1.)
+        return new_jpeg if new_jpeg is not None else jpeg
+
+    def get_status(self):
+        '''Returns a dict with the status of the experiment. It's called from
+        the Kivy thread every :attr:`status_interval` seconds.
+        '''
+        status = {
+            'time': time(), 'chamber': get_chamber(), 'running': False,
+            'viewers': self.viewers, 'frames_encoded': self.frames_encoded,
+            'frames_skipped': self.frames_skipped}
+        stage = self.stage
+        if stage is None:
+            return status
+
+        trial_root = knspace.exp_trial_root
+        status.update({
+            'running': bool(stage.started and not stage.finished),
+            'animal': stage.animal_id, 'trial_type': stage.trial_type,
+            'trial': trial_root.count if trial_root else -1,
+            'slice': _active_slice(knspace.time_line),
+            'frame_rate': stage.frame_rate,
+            'frames_dropped': stage.frames_dropped,
+            'encoder_frames_dropped': stage.encoder_frames_dropped,
+            'counters': metrics.get_counters()})
+
+        daq = stage.mcdaq
+        if daq is not None:
+            status['pins'] = {
+                name: getattr(daq, name)
+                for name in ('shocker', 'ir_leds', 'tone')}
+        analyzer = stage.analyzer
+        if analyzer is not None and analyzer.enabled:
+            status['motion'] = analyzer.motion
+            status['freezing'] = analyzer.freezing
+        return status
+
+    @app_error
+    def _update_status(self, *largs):
+        self.status_data = json.dumps(
+            self.get_status(), sort_keys=True).encode('utf8')
+
+    @app_error
+    def _report_error(self, e, *largs):
+        raise e
+
+    def _encode_frame(self, frame):
+        from ffpyplayer.pic import SWScale
+        import PIL.Image
+
+        size = frame.get_size()
+        fmt = frame.get_pixel_format()
+        sws = self._sws
+        if sws is None or sws[0] != (size, fmt):
+            w = int(self.width) or size[0]
+            h = max(2, int(round(size[1] * w / float(size[0]) / 2.)) * 2)
+            sws = self._sws = (size, fmt), SWScale(
+                size[0], size[1], fmt, ow=w, oh=h, ofmt='rgb24')
+        img = sws[1].scale(frame)
+
+        data = BytesIO()
+        PIL.Image.frombytes(
+            'RGB', img.get_size(), bytes(img.to_bytearray()[0])).save(
+            data, 'JPEG', quality=int(self.quality))
+        return data.getvalue()
+
+    def _run_encoder(self):
+        cond = self._cond
+        while True:
+            with cond:
+                while self.serving and self._next_frame is None:
+                    cond.wait()
+                if not self.serving:
+                    return
+                frame = self._next_frame
+
+            try:
+                jpeg = self._encode_frame(frame)
+            except Exception as e:
+                # stop encoding, rather than report the error for every frame
+                Clock.schedule_once(partial(self._report_error, e))
+                return
+
+            with cond:
+                self._next_frame = None
+                self._jpeg = jpeg
+                self._jpeg_count += 1
+                self.frames_encoded += 1
+                cond.notify_all()
+
+
+live_monitor = LiveMonitor()
+'''The global :class:`LiveMonitor` that serves the experiment.
+'''
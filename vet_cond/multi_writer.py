@@ -0,0 +1,407 @@
+'''Multi Writer
+===============
+
+Records each trial to several videos at once, one for each encoder profile,
+e.g. a lossless archive for the automated scoring and a small compressed
+copy at a lower resolution for reviewing the trials.
+
+:class:`MultiWriter` passes the frames to the profiles' processes by their
+number in the :attr:`~vet_cond.stages.RootStage.frame_ring`, into which each
+frame was already copied once, and every profile's video is encoded by a
+separate process that reads the frames from the ring, so the profiles are
+encoded in parallel, on different cores. Only the frames that are not in
+that ring, e.g. the prerecorded frames, are copied into the writer's own
+ring.
+
+The writer only becomes active once all the profiles opened their video. If
+any of them fails, the writer's activation fails and the error is reported.
+
+The profiles are configured in the ``profiles`` setting of the
+``video_profiles`` section of the config, a dict mapping each profile's name
+to a dict with the following optional keys:
+
+    `suffix`: str
+        Appended to the trial's video filename, before the extension, to get
+        the profile's filename. Defaults to ``''``, i.e. the video filename
+        itself, which at most one profile may use.
+    `ext`: str
+        The extension of the profile's video, e.g. ``'.mp4'``. Defaults to the
+        extension of the trial's video filename.
+    `codec`: str
+        The ffmpeg codec, e.g. ``'rawvideo'`` (the default) or ``'mpeg4'``.
+    `ofmt`: str
+        The pixel format of the video. Defaults to the writer's ``ofmt``.
+    `width`: int
+        The width of the video. If zero (the default), the frames are not
+        scaled, otherwise the height is scaled to keep the aspect ratio.
+    `lib_opts`: dict
+        The codec options, e.g. ``{"b": "500000"}`` for the bit rate.
+
+Once a trial's videos are closed, the number of frames, the frames dropped,
+and the encoding time of each profile are logged and added to the session's
+:attr:`~vet_cond.metrics.metrics`, as the ``profiles.<name>.frames`` and
+``profiles.<name>.dropped`` counters and the ``profiles.<name>.encode``
+timer, so the throughput of each profile can be compared with the frame
+rate.
+'''
+
+import traceback
+import ctypes
+from time import sleep
+from multiprocessing import Process, Queue
+from multiprocessing.sharedctypes import RawValue
+from os.path import splitext, exists
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from kivy.clock import Clock
+from kivy.logger import Logger
+from kivy.properties import NumericProperty, StringProperty, ObjectProperty
+
+from moa.device import Device
+
+from cplcom.moa.app import app_error
+
+from vet_cond.metrics import metrics, timed
+from vet_cond.shared_frames import SharedFrameRing
+from vet_cond.timing import clock, LatencyHistogram
+
+__all__ = ('MultiWriter', 'profile_filename')
+
+
+def profile_filename(filename, profile):
+    '''Returns the filename of the profile's video for the trial video
+    ``filename``.
+    '''
+    root, ext = splitext(filename)
+    return '{}{}{}'.format(
+        root, profile.get('suffix', ''), profile.get('ext', ext))
+
+
+def _run_profile(rings, requests, results, consumed, filename, rate, ofmt,
+                 profile):
+    '''The main loop of a profile's encoding process. ``rings`` is the
+    ``(source ring, writer's ring)``, where the source ring may be None.
+    '''
+    try:
+        ring = rings[1]
+        from ffpyplayer.writer import MediaWriter
+        from vet_cond.segments import _frame_rate
+        w, h = ring.size
+        width = int(profile.get('width', 0)) or w
+        height = int(round(h * width / float(w) / 2.)) * 2 if width != w \
+            else h
+        writer = MediaWriter(filename, [{
+            'pix_fmt_in': ring.pix_fmt, 'width_in': w, 'height_in': h,
+            'pix_fmt_out': profile.get('ofmt', ofmt) or ring.pix_fmt,
+            'width_out': width, 'height_out': height,
+            'codec': profile.get('codec', 'rawvideo'),
+            'frame_rate': _frame_rate(rate)}],
+            lib_opts=profile.get('lib_opts', {}))
+        results.put(('ready', ))
+
+        times = LatencyHistogram(min_value=1e-6)
+        frames = dropped = 0
+        first = None
+        while True:
+            msg = requests.get()
+            if msg[0] == 'frame':
+                ring, n = rings[msg[1]], msg[2]
+                pts = ring.get_pts(n)
+                img = None if pts is None else ring.get_image(n)
+                if img is None:
+                    dropped += 1
+                else:
+                    if first is None:
+                        first = pts
+                    ts = clock()
+                    writer.write_frame(img=img, pts=pts - first)
+                    times.add(clock() - ts)
+                    frames += 1
+                if msg[1]:
+                    consumed.value = n + 1
+            elif msg[0] == 'exit':
+                ts = clock()
+                writer.close()
+                results.put(('done', {
+                    'frames': frames, 'dropped': dropped,
+                    'close_time': clock() - ts}, times))
+                return
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+class MultiWriter(Device):
+    '''A video writer with the same interface as
+    :class:`~cplcom.moa.device.ffplayer.FFPyWriterDevice`, which writes each
+    frame to the videos of all the :attr:`profiles`, each encoded in its own
+    process, as described in :mod:`~vet_cond.multi_writer`.
+
+    The processes are started when the writer is activated, e.g. by the
+    :class:`~vet_cond.recording.WriterPool` during the preceding ITI, and it
+    becomes active once all of them opened their video.
+    :meth:`add_ring_frame` and :meth:`add_frame` are called from the
+    :class:`~vet_cond.recording.EncoderPipeline` worker thread.
+
+    The frames in :attr:`source_ring` are read by the processes from there,
+    and a frame that was overwritten in it before a process read it is
+    dropped by that profile. The other frames are copied into the writer's
+    ring, and when a profile falls :attr:`ring_slots` frames behind in it,
+    :meth:`add_frame` waits, up to :attr:`max_wait`, for it to catch up, so
+    the frames back up in the encoder's queue rather than being overwritten.
+    '''
+
+    __settings_attrs__ = ('profiles', 'ring_slots', 'max_wait')
+
+    filename = StringProperty('')
+    '''The filename of the trial's video. The profiles' filenames are
+    derived from it with :func:`profile_filename`.
+    '''
+
+    rate = NumericProperty(30.)
+    '''The frame rate of the videos.
+    '''
+
+    size = (0, 0)
+    '''The ``(width, height)`` of the frames.
+    '''
+
+    ifmt = ''
+    '''The pixel format of the frames passed to :meth:`add_frame`.
+    '''
+
+    ofmt = ''
+    '''The default pixel format of the profiles' videos.
+    '''
+
+    source_ring = None
+    '''The :class:`~vet_cond.shared_frames.SharedFrameRing`, e.g.
+    :attr:`~vet_cond.stages.RootStage.frame_ring`, from which the processes
+    read the frames passed to :meth:`add_ring_frame`, or None.
+    '''
+
+    profiles = ObjectProperty({
+        'archive': {'suffix': '', 'codec': 'rawvideo'},
+        'review': {'suffix': '_review', 'codec': 'mpeg4', 'ofmt': 'yuv420p',
+                   'width': 320}})
+    '''A dict mapping the names of the encoder profiles to their options, as
+    described in :mod:`~vet_cond.multi_writer`.
+    '''
+
+    ring_slots = NumericProperty(60)
+    '''The number of frames that the writer's own ring holds, i.e. how far a
+    profile may fall behind before :meth:`add_frame` waits for it.
+    '''
+
+    max_wait = NumericProperty(1.)
+    '''The maximum amount of time :meth:`add_frame` waits for a profile that
+    fell behind, after which the frame overwrites the oldest frame in the
+    ring, which that profile then drops.
+    '''
+
+    stats = {}
+    '''A dict mapping the names of the profiles to a dict with the `frames`
+    written and `dropped`, and the `encode` summary of the time spent
+    encoding the frames, once the videos are closed.
+    '''
+
+    _ring = None
+    '''The writer's own :class:`~vet_cond.shared_frames.SharedFrameRing`
+    holding the frames not in :attr:`source_ring`.
+    '''
+
+    _processes = {}
+    '''A dict mapping the names of the profiles to a ``(process, requests,
+    results, consumed)`` tuple, where `consumed` is the shared number of the
+    frames the process is done with.
+    '''
+
+    _waiting = set()
+    '''The names of the profiles whose process hasn't replied yet.
+    '''
+
+    _ready = set()
+    '''The names of the profiles whose process opened its video.
+    '''
+
+    _poll_event = None
+    '''The clock event polling the results of the processes.
+    '''
+
+    def __init__(self, filename='', rate=30., size=(0, 0), ifmt='',
+                 ofmt='', source_ring=None, **kwargs):
+        super(MultiWriter, self).__init__(
+            filename=filename, rate=rate, **kwargs)
+        self.size = tuple(size)
+        self.ifmt = ifmt
+        self.ofmt = ofmt
+        self.source_ring = source_ring
+        self.stats = {}
+        self._processes = {}
+        self._waiting = set()
+        self._ready = set()
+
+    def activate(self, *largs, **kwargs):
+        if self.activation == 'inactive':
+            filenames = [profile_filename(self.filename, p)
+                         for p in self.profiles.values()]
+            if len(set(filenames)) != len(filenames):
+                raise ValueError('The video profiles have the same filename')
+            for fname in filenames:
+                if exists(fname):
+                    raise Exception('"{}" already exists'.format(fname))
+        if not super(MultiWriter, self).activate(*largs, **kwargs):
+            return False
+
+        from ffpyplayer.pic import Image
+        ring = self._ring = SharedFrameRing.from_frame(
+            Image(pix_fmt=self.ifmt, size=self.size), max(1, self.ring_slots))
+        self.stats = {}
+        processes = self._processes = {}
+        for name, profile in self.profiles.items():
+            requests, results = Queue(), Queue()
+            consumed = RawValue(ctypes.c_longlong, 0)
+            process = Process(
+                target=_run_profile, name='MultiWriter-{}'.format(name),
+                args=((self.source_ring, ring), requests, results, consumed,
+                      profile_filename(self.filename, profile), self.rate,
+                      self.ofmt, dict(profile)))
+            process.daemon = True
+            process.start()
+            processes[name] = process, requests, results, consumed
+
+        self._waiting = set(processes)
+        self._ready = set()
+        self._poll_event = Clock.schedule_interval(self._poll, .02)
+        return True
+
+    def deactivate(self, *largs, **kwargs):
+        if not super(MultiWriter, self).deactivate(*largs, **kwargs):
+            return False
+        self._waiting = set(self._processes)
+        for _, requests, _, _ in self._processes.values():
+            requests.put(('exit', ))
+        if self._poll_event is None:
+            self._poll_event = Clock.schedule_interval(self._poll, .02)
+        return True
+
+    @timed('multi_writer.add_frame')
+    def add_ring_frame(self, ring, n, frame, pts):
+        '''Passes the frame number ``n`` of ``ring``, the ``frame`` with
+        ``pts``, on to the profiles' processes. If ``ring`` is not
+        :attr:`source_ring` or the frame is not in it anymore, the frame is
+        copied with :meth:`add_frame` instead.
+        '''
+        if ring is None or ring is not self.source_ring or \
+                not ring.is_valid(n):
+            self.add_frame(frame, pts)
+            return
+        for _, requests, _, _ in self._processes.values():
+            requests.put(('frame', 0, n))
+
+    @timed('multi_writer.add_frame')
+    def add_frame(self, frame, pts):
+        '''Copies the frame into the writer's ring and passes it on to the
+        profiles' processes.
+        '''
+        ring = self._ring
+        n = ring.frame_count
+        processes = list(self._processes.values())
+        ts = clock()
+        while processes and n - min(
+                c.value for _, _, _, c in processes) >= ring.count:
+            if clock() - ts >= self.max_wait:
+                break
+            sleep(.001)
+
+        n = ring.put(frame, pts)
+        for _, requests, _, _ in processes:
+            requests.put(('frame', 1, n))
+
+    def _log_stats(self, name, stats, times):
+        encode = stats['encode'] = times.summary()
+        metrics.count('profiles.{}.frames'.format(name), stats['frames'])
+        metrics.count('profiles.{}.dropped'.format(name), stats['dropped'])
+        metrics.merge_times('profiles.{}.encode'.format(name), times)
+
+        fps = times.count / times.total if times.total else 0
+        Logger.info(
+            'VetCond: Profile "{}" of "{}" wrote {} frames ({} dropped), '
+            'encoding at {:.1f} fps ({:.1f}x real time)'.format(
+                name, self.filename, stats['frames'], stats['dropped'], fps,
+                fps / self.rate if self.rate else 0))
+
+    @app_error
+    def _report_error(self, name, error):
+        raise Exception('Video profile "{}" failed:\n{}'.format(name, error))
+
+    def _remove_process(self, name):
+        processes = dict(self._processes)
+        process = processes.pop(name)[0]
+        self._processes = processes
+        self._waiting.discard(name)
+        process.join(1.)
+
+    def _stop_processes(self):
+        '''Makes the processes close their video and exit, and waits for
+        them.
+        '''
+        for _, requests, _, _ in self._processes.values():
+            requests.put(('exit', ))
+        for process, _, _, _ in self._processes.values():
+            process.join(1.)
+        self._processes = {}
+        self._ring = None
+
+    def _poll(self, *largs):
+        for name, (process, _, results, _) in list(self._processes.items()):
+            while True:
+                try:
+                    msg = results.get_nowait()
+                except Empty:
+                    break
+
+                self._waiting.discard(name)
+                if msg[0] == 'ready':
+                    self._ready.add(name)
+                elif msg[0] == 'done':
+                    self.stats[name] = msg[1]
+                    self._log_stats(name, msg[1], msg[2])
+                elif msg[0] == 'error':
+                    # the process exited, so don't wait for it anymore
+                    self._remove_process(name)
+                    self._report_error(name, msg[1])
+                    break
+
+            if name in self._waiting and not process.is_alive():
+                # e.g. it crashed or was killed without reporting an error
+                self._remove_process(name)
+                self._report_error(name, 'The process exited unexpectedly '
+                                   '(exit code {})'.format(process.exitcode))
+
+        if self._waiting:
+            return
+        self._poll_event.cancel()
+        self._poll_event = None
+        if self.activation == 'activating':
+            failed = set(self.profiles) - self._ready
+            if not failed:
+                self.activation = 'active'
+                return
+            # don't record the trial into only some of the profiles. The
+            # failed profiles' errors were already reported
+            self._stop_processes()
+            self.activation = 'inactive'
+            Logger.error(
+                'MultiWriter: Not activated, the video profiles {} failed'.
+                format(', '.join(sorted(failed))))
+        elif self.activation == 'deactivating':
+            for process, _, _, _ in self._processes.values():
+                # they exit once they report that they're done
+                process.join(1.)
+            self._processes = {}
+            self._ring = None
+            self.activation = 'inactive'
@@ -0,0 +1,462 @@
+'''Online Analysis
+==================
+
+Scores the animal's motion and freezing while the experiment runs, in a
+separate process that reads the frames from the
+:class:`~vet_cond.shared_frames.SharedFrameRing`, so that it doesn't delay the
+acquisition, preview, or recording.
+
+The motion is computed the same way as in :mod:`~vet_cond.analysis`, but only
+for the region of interest of every :attr:`OnlineAnalyzer.decimation` frame,
+with the region subsampled by :attr:`OnlineAnalyzer.step` pixels.
+'''
+
+import traceback
+from collections import deque
+from multiprocessing import Process, Queue
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from kivy.clock import Clock
+from kivy.logger import Logger
+from kivy.event import EventDispatcher
+from kivy.properties import NumericProperty, BooleanProperty, ListProperty
+
+from cplcom.moa.app import app_error
+
+from vet_cond.metrics import metrics, timed
+from vet_cond.timing import clock
+
+__all__ = ('OnlineAnalyzer', 'FreezingState')
+
+
+class FreezingState(object):
+    '''Computes the motion of consecutive grayscale frames and tracks whether
+    the animal is freezing and the freezing bouts.
+
+    The animal is freezing while the motion of all the frames in the last
+    :attr:`window` seconds is below :attr:`motion_threshold`.
+    '''
+
+    pixel_threshold = 10
+    '''The minimum change, in grey levels, of a pixel between frames for it to
+    count as moving.
+    '''
+
+    motion_threshold = .5
+    '''The percentage of moving pixels below which a frame is still.
+    '''
+
+    window = 1.
+    '''The number of seconds of still frames after which the animal is
+    freezing.
+    '''
+
+    motion = 0.
+    '''The motion of the last frame, in percent of the pixels.
+    '''
+
+    freezing = False
+    '''Whether the animal is currently freezing.
+    '''
+
+    bouts = []
+    '''The list of ``(start, end)`` pts of the freezing bouts since the last
+    :meth:`reset_bouts`. The end of an ongoing bout is the pts of the last
+    frame.
+    '''
+
+    _prev = None
+    '''The previous frame.
+    '''
+
+    _history = None
+    '''A deque of the ``(pts, motion)`` of the frames in the last
+    :attr:`window` seconds.
+    '''
+
+    _bout_start = None
+    '''The start pts of the ongoing freezing bout, or None.
+    '''
+
+    def __init__(self, pixel_threshold=10, motion_threshold=.5, window=1.):
+        super(FreezingState, self).__init__()
+        self.pixel_threshold = pixel_threshold
+        self.motion_threshold = motion_threshold
+        self.window = window
+        self._history = deque()
+        self.bouts = []
+
+    def reset_bouts(self):
+        '''Clears :attr:`bouts`, except for the ongoing bout, if any.
+        '''
+        self.bouts = [b for b in self.bouts[-1:] if b[0] == self._bout_start]
+
+    def add_frame(self, pts, frame):
+        '''Adds the next frame, a 2-dim uint8 numpy array, and returns its
+        motion.
+        '''
+        import numpy as np
+        prev = self._prev
+        self._prev = frame
+        if prev is None or prev.shape != frame.shape:
+            return 0.
+
+        moved = np.abs(frame.astype(np.int16) - prev) > self.pixel_threshold
+        motion = self.motion = float(moved.mean()) * 100.
+
+        history = self._history
+        history.append((pts, motion))
+        while history and history[0][0] < pts - self.window:
+            history.popleft()
+        # the window is only full once it spans window seconds
+        full = len(history) > 1 and \
+            history[0][0] <= pts - self.window * .9
+        self.freezing = full and \
+            max(m for _, m in history) < self.motion_threshold
+
+        if self.freezing:
+            if self._bout_start is None:
+                self._bout_start = history[0][0]
+                self.bouts.append((self._bout_start, pts))
+            else:
+                self.bouts[-1] = self._bout_start, pts
+        else:
+            self._bout_start = None
+        return motion
+
+
+def _get_gray(ring, n, roi, step):
+    '''Returns a copy of the subsampled region of interest of the first
+    channel of frame ``n`` of the ring, or None if it's not available.
+    '''
+    import numpy as np
+    arr = ring.get_array(n)
+    if arr is None:
+        return None
+
+    w, h = ring.size
+    bpp = max(1, ring.linesizes[0] // w)
+    x, y, rw, rh = roi
+    if rw <= 0 or rh <= 0:
+        x, y, rw, rh = 0, 0, w, h
+    sub = np.array(
+        arr[y:y + rh:step, x * bpp:(x + rw) * bpp:bpp * step], copy=True)
+    if not ring.is_valid(n):
+        return None
+    return sub
+
+
+def _run_analyzer(ring, requests, results, roi, step, pixel_threshold,
+                  motion_threshold, window):
+    '''The analysis process's main loop.
+    '''
+    try:
+        state = FreezingState(pixel_threshold, motion_threshold, window)
+        step = max(1, int(step))
+        while True:
+            msg = requests.get()
+            cmd = msg[0]
+            if cmd == 'frame':
+                n = msg[1]
+                pts = ring.get_pts(n)
+                frame = None if pts is None else \
+                    _get_gray(ring, n, roi, step)
+                if frame is None:
+                    results.put(('skipped', ))
+                    continue
+                state.add_frame(pts, frame)
+                results.put(('state', pts, state.motion, state.freezing))
+            elif cmd == 'trial_start':
+                state.reset_bouts()
+            elif cmd == 'trial_end':
+                results.put(('bouts', list(state.bouts)))
+            elif cmd == 'exit':
+                return
+    except Exception:
+        results.put(('error', traceback.format_exc()))
+
+
+class OnlineAnalyzer(EventDispatcher):
+    '''Computes the motion and freezing state of the animal in a separate
+    process, from the frames in the
+    :attr:`~vet_cond.stages.RootStage.frame_ring`.
+
+    :meth:`add_frame` is called from the Kivy thread for every frame put in
+    the ring and only passes the frame number to the process. If the process
+    falls behind by :attr:`max_pending` frames, new frames are skipped until
+    it catches up, so it never delays the caller. The results are polled
+    from the Kivy thread and update :attr:`motion` and :attr:`freezing`.
+
+    :meth:`start_trial` and :meth:`end_trial` delimit a trial, and
+    :meth:`end_trial` returns the freezing bouts that occurred during the
+    trial. Requires :attr:`~vet_cond.stages.RootStage.frame_ring_slots` to not
+    be zero.
+    '''
+
+    __settings_attrs__ = (
+        'enabled', 'decimation', 'roi', 'step', 'pixel_threshold',
+        'motion_threshold', 'window', 'max_pending', 'end_trial_timeout')
+
+    enabled = BooleanProperty(True)
+    '''Whether to analyze the frames.
+    '''
+
+    decimation = NumericProperty(2)
+    '''Only every ``decimation`` frame is analyzed.
+    '''
+
+    roi = ListProperty([0, 0, 0, 0])
+    '''The ``(x, y, width, height)`` region of interest, in pixels, of the
+    frames that is analyzed. If the width or height is zero, the whole frame
+    is analyzed. It's relative to the frames as reduced by
+    :attr:`~vet_cond.stages.RootStage.reducer`.
+    '''
+
+    step = NumericProperty(2)
+    '''Only every ``step`` pixel of the region of interest, horizontally and
+    vertically, is analyzed.
+    '''
+
+    pixel_threshold = NumericProperty(10)
+    '''The minimum change, in grey levels, of a pixel between frames for it to
+    count as moving.
+    '''
+
+    motion_threshold = NumericProperty(.5)
+    '''The percentage of moving pixels below which a frame is still.
+    '''
+
+    window = NumericProperty(1.)
+    '''The number of seconds of still frames after which the animal is
+    considered freezing.
+    '''
+
+    max_pending = NumericProperty(8)
+    '''The maximum number of frames passed to the process that it hasn't
+    analyzed yet. Additional frames are skipped.
+    '''
+
+    end_trial_timeout = NumericProperty(5.)
+    '''The maximum amount of time, in seconds, to wait for the freezing bouts
+    of a trial from the process, after which the :meth:`end_trial` callback
+    is called with None, so that e.g. the trial is still logged.
+    '''
+
+    motion = NumericProperty(0.)
+    '''The motion, in percent of the pixels, of the last analyzed frame.
+    '''
+
+    freezing = BooleanProperty(False)
+    '''Whether the animal is currently freezing.
+    '''
+
+    frames_analyzed = 0
+    '''The number of frames analyzed.
+    '''
+
+    frames_skipped = 0
+    '''The number of frames skipped because the process fell behind or the
+    frame was overwritten in the ring before it was analyzed.
+    '''
+
+    _ring = None
+    '''The ring the process reads from.
+    '''
+
+    _process = None
+    '''The analysis process.
+    '''
+
+    _requests = None
+    '''The queue of messages to the process.
+    '''
+
+    _results = None
+    '''The queue of messages from the process.
+    '''
+
+    _pending = 0
+    '''The number of frames passed to the process not yet analyzed.
+    '''
+
+    _count = 0
+    '''The number of frames passed to :meth:`add_frame`.
+    '''
+
+    _callbacks = []
+    '''The ``(deadline, trial, callback)`` of the callbacks waiting for the
+    bouts of a trial from the process.
+    '''
+
+    _timed_out = 0
+    '''The number of trials whose bouts timed out and will be ignored when
+    the process eventually sends them.
+    '''
+
+    _after = []
+    '''The callbacks to call once :attr:`_callbacks` is empty.
+    '''
+
+    _poll_event = None
+    '''The clock event polling the results.
+    '''
+
+    def __init__(self, **kwargs):
+        super(OnlineAnalyzer, self).__init__(**kwargs)
+        self._callbacks = []
+        self._after = []
+
+    def _start_process(self, ring):
+        self._stop_process()
+        self._ring = ring
+        self._pending = 0
+        requests = self._requests = Queue()
+        results = self._results = Queue()
+        process = self._process = Process(
+            target=_run_analyzer, name='OnlineAnalyzer', args=(
+                ring, requests, results, list(self.roi), self.step,
+                self.pixel_threshold, self.motion_threshold, self.window))
+        process.daemon = True
+        process.start()
+        if self._poll_event is None:
+            self._poll_event = Clock.schedule_interval(self._poll, .05)
+
+    def _stop_process(self):
+        if self._process is None:
+            return
+        self._requests.put(('exit', ))
+        self._process = self._ring = None
+        self._timed_out = 0
+        self._flush_callbacks()
+
+    def stop(self):
+        '''Stops the analysis process. Callbacks still waiting for the
+        process are called with None.
+        '''
+        self._stop_process()
+        if self._poll_event is not None:
+            self._poll_event.cancel()
+            self._poll_event = None
+        self.motion = 0
+        self.freezing = False
+
+    @timed('analyzer.add_frame')
+    def add_frame(self, ring, n):
+        '''Called from the Kivy thread with the ring and the number of every
+        frame put in the ring.
+        '''
+        if not self.enabled:
+            return
+
+        self._count += 1
+        if self._count % max(1, int(self.decimation)):
+            return
+
+        if ring is not self._ring:
+            self._start_process(ring)
+        if self._pending >= self.max_pending:
+            self.frames_skipped += 1
+            metrics.count('analyzer.frames_skipped')
+            return
+        self._pending += 1
+        self._requests.put(('frame', n))
+
+    def start_trial(self):
+        '''Starts collecting the freezing bouts of a trial.
+        '''
+        if self._process is not None:
+            self._requests.put(('trial_start', ))
+
+    def end_trial(self, trial, callback):
+        '''Ends the trial number ``trial``. ``callback`` is called from the
+        Kivy thread with ``trial`` and the list of ``(start, end)`` pts of the
+        freezing bouts since :meth:`start_trial`, once all the frames added
+        before were analyzed, or with None instead of the list if nothing is
+        analyzed.
+        '''
+        if self._process is None:
+            callback(trial, None)
+            return
+        self._callbacks.append(
+            (clock() + self.end_trial_timeout, trial, callback))
+        self._requests.put(('trial_end', ))
+
+    def call_when_done(self, callback):
+        '''Calls ``callback`` with no arguments once the callbacks of all the
+        trials ended with :meth:`end_trial` were called. If there are none,
+        it's called immediately.
+        '''
+        if self._callbacks:
+            self._after.append(callback)
+        else:
+            callback()
+
+    def _flush_callbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for _, trial, callback in callbacks:
+            callback(trial, None)
+        self._call_after()
+
+    def _call_after(self):
+        if self._callbacks:
+            return
+        after, self._after = self._after, []
+        for callback in after:
+            callback()
+
+    @app_error
+    def _poll(self, *largs):
+        results = self._results
+        if results is None:
+            return
+
+        state = None
+        while True:
+            try:
+                msg = results.get_nowait()
+            except Empty:
+                break
+
+            cmd = msg[0]
+            if cmd == 'state':
+                self._pending -= 1
+                self.frames_analyzed += 1
+                state = msg
+            elif cmd == 'skipped':
+                self._pending -= 1
+                self.frames_skipped += 1
+            elif cmd == 'bouts':
+                if self._timed_out:
+                    self._timed_out -= 1
+                elif self._callbacks:
+                    _, trial, callback = self._callbacks.pop(0)
+                    callback(trial, msg[1])
+                self._call_after()
+            elif cmd == 'error':
+                self._stop_process()
+                raise Exception(
+                    'The online analysis failed:\n{}'.format(msg[1]))
+
+        process = self._process
+        if process is not None and not process.is_alive():
+            # e.g. it crashed or was killed without reporting an error
+            self._stop_process()
+            raise Exception('The online analysis process exited unexpectedly '
+                            '(exit code {})'.format(process.exitcode))
+
+        callbacks = self._callbacks
+        while callbacks and callbacks[0][0] <= clock():
+            Logger.warning('VetCond: Timed out waiting for the freezing '
+                           'bouts of the trial')
+            self._timed_out += 1
+            _, trial, callback = callbacks.pop(0)
+            callback(trial, None)
+            self._call_after()
+
+        if state is not None:
+            self.motion = state[2]
+            self.freezing = state[3]
@@ -0,0 +1,661 @@
+'''Recording
+============
+
+Classes that handle the recording of the video frames to disk, away from the
+Kivy main thread that runs the experiment stages.
+'''
+
+from threading import Thread, Condition
+from collections import deque
+from functools import partial
+
+from moa.utils import ObjectStateTracker
+
+from kivy.clock import Clock
+from kivy.event import EventDispatcher
+from kivy.properties import (
+    NumericProperty, OptionProperty, ListProperty, BooleanProperty)
+
+from cplcom.moa.app import app_error
+
+from vet_cond.metrics import metrics, timed
+from vet_cond.shared_frames import frame_planes
+from vet_cond.timing import clock
+
+__all__ = ('EncoderPipeline', 'PrerecordBuffer', 'WriterPool',
+           'FrameReducer')
+
+_luma_fmts = (
+    'gray', 'yuv420p', 'yuvj420p', 'yuv422p', 'yuvj422p', 'yuv444p',
+    'yuvj444p', 'yuv410p', 'yuv411p', 'yuv440p', 'yuvj440p', 'nv12', 'nv21')
+'''Pixel formats whose first plane is the full size 8-bit luma, so the gray
+frame is just the first plane.
+'''
+
+
+class EncoderPipeline(EventDispatcher):
+    '''A bounded frame queue with a worker thread that passes the frames on to
+    the :class:`~cplcom.moa.device.ffplayer.FFPyWriterDevice` of the current
+    trial.
+
+    :meth:`add_frame` is called from the Kivy thread for each frame and
+    only adds the frame to the queue, while the worker thread is the one that
+    calls the writer's ``add_frame``. So when the encoder or the disk stalls,
+    the queue fills up instead of the experiment stages being delayed. When
+    the queue is full, :attr:`overflow` determines what happens.
+
+    The queue is ordered, so frames and writer changes are processed in the
+    order they were added. E.g. :meth:`close_writer` only calls its callback
+    once all the frames previously added for that writer were passed on.
+
+    Frames may be added for a writer that is still being activated, in which
+    case the worker waits, up to :attr:`writer_timeout`, for it to become
+    active before passing the frames on. In the meantime, the frames are held
+    in the queue.
+
+    A :class:`~vet_cond.frame_index.FrameIndexWriter` may be attached to a
+    writer with :meth:`attach_index`, in which case every frame passed to the
+    writer is also recorded in the index.
+
+    A frame may be added with its number in a
+    :class:`~vet_cond.shared_frames.SharedFrameRing`, e.g.
+    :attr:`~vet_cond.stages.RootStage.frame_ring`. Writers that encode in
+    other processes, such as :class:`~vet_cond.multi_writer.MultiWriter`,
+    have an ``add_ring_frame(ring, n, frame, pts)`` method, which is called
+    instead of ``add_frame`` so that they read the frame from the ring rather
+    than copying it again. The writers encoding in this process get the frame
+    itself, which is already shared with the worker thread without a copy.
+    '''
+
+    __settings_attrs__ = ('queue_size', 'overflow', 'block_timeout')
+
+    queue_size = NumericProperty(90)
+    '''The maximum number of frames that may be waiting in the queue for the
+    worker thread before :attr:`overflow` takes effect.
+    '''
+
+    overflow = OptionProperty(
+        'drop_oldest', options=['block', 'drop_oldest', 'drop_newest'])
+    '''What to do when a frame is added while the queue already holds
+    :attr:`queue_size` frames. It can be one of:
+
+        `block`: Wait, up to :attr:`block_timeout`, for the worker to make
+            room in the queue. Note, this delays the caller and therefore
+            the experiment stages.
+        `drop_oldest`: Drop the oldest frame of the same writer in the
+            queue to make room for the new frame. Frames added with
+            :meth:`add_frames` are never dropped, so if there's no other
+            frame of the writer in the queue, the new frame is dropped.
+        `drop_newest`: Drop the new frame.
+    '''
+
+    block_timeout = NumericProperty(1.)
+    '''When :attr:`overflow` is `'block'`, the maximum amount of time to wait
+    for room in the queue before dropping the new frame.
+    '''
+
+    writer_timeout = 10.
+    '''The maximum amount of time the worker waits for a writer to become
+    active before passing on its frames anyway.
+    '''
+
+    queue_depth = 0
+    '''The number of frames currently waiting in the queue.
+    '''
+
+    max_queue_depth = 0
+    '''The largest :attr:`queue_depth` seen since the pipeline was started.
+    '''
+
+    frames_dropped = 0
+    '''The number of frames that were dropped because the queue was full.
+    '''
+
+    frames_written = 0
+    '''The number of frames passed on to the writers.
+    '''
+
+    _queue = None
+    '''The deque holding the frames and commands for the worker thread.
+    '''
+
+    _cond = None
+    '''The :class:`~threading.Condition` guarding :attr:`_queue`.
+    '''
+
+    _thread = None
+    '''The worker thread.
+    '''
+
+    _writers = None
+    '''The set of the writers whose activation is bound to wake up the worker
+    thread waiting for them to become active.
+    '''
+
+    def start(self):
+        '''Starts the worker thread. Must be called before frames are added.
+        '''
+        if self._thread is not None:
+            raise Exception('The encoder pipeline was already started')
+
+        self._queue = deque()
+        self._cond = Condition()
+        self._writers = set()
+        self.queue_depth = self.max_queue_depth = 0
+        self.frames_dropped = self.frames_written = 0
+        thread = self._thread = Thread(
+            target=self._run_worker, name='EncoderPipeline')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self, callback=None):
+        '''Stops the worker thread once all the frames already in the queue
+        were passed on to their writers.
+
+        :Parameters:
+
+            `callback`: callable
+                If not None, it's called from the Kivy thread, with no
+                arguments, once the worker is done.
+        '''
+        if self._thread is None:
+            if callback is not None:
+                callback()
+            return
+        self._thread = None
+        self._put(('exit', callback))
+
+    @timed('encoder.add_frame')
+    def add_frame(self, writer, frame, pts, host=-1, ring=None, number=-1):
+        '''Adds a frame to be passed to the writer by the worker thread.
+
+        :Parameters:
+
+            `writer`: :class:`~cplcom.moa.device.ffplayer.FFPyWriterDevice`
+                The writer to which the frame should be passed.
+            `frame`: :class:`ffpyplayer.pic.Image`
+                The frame.
+            `pts`: float
+                The frame's presentation time stamp.
+            `host`: float
+                The host time when the frame was received. It's only used for
+                the writer's frame index.
+            `ring`: :class:`~vet_cond.shared_frames.SharedFrameRing`
+                If not None, the ring holding the frame as frame number
+                ``number``.
+        '''
+        cond = self._cond
+        queue = self._queue
+        size = max(1, int(self.queue_size))
+        self._bind_writer(writer)
+
+        with cond:
+            if self.queue_depth >= size:
+                overflow = self.overflow
+                if overflow == 'block':
+                    cond.wait(self.block_timeout)
+                    if self.queue_depth >= size:
+                        self.frames_dropped += 1
+                        metrics.count('encoder.frames_dropped')
+                        return
+                elif overflow == 'drop_newest':
+                    self.frames_dropped += 1
+                    metrics.count('encoder.frames_dropped')
+                    return
+                else:
+                    self.frames_dropped += 1
+                    metrics.count('encoder.frames_dropped')
+                    for i, item in enumerate(queue):
+                        if item[0] == 'frame' and item[1] is writer and \
+                                not item[5]:
+                            del queue[i]
+                            self.queue_depth -= 1
+                            break
+                    else:
+                        return
+
+            queue.append(
+                ('frame', writer, frame, pts, host, False, ring, number))
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            cond.notify_all()
+
+    def add_frames(self, writer, frames):
+        '''Adds a list of ``(frame, pts, host)`` tuples to be passed to the
+        writer by the worker thread.
+
+        Unlike :meth:`add_frame`, the frames are added even if the queue is
+        full, because they are already held in memory (e.g. from a
+        :class:`PrerecordBuffer`), so that they are not lost.
+        '''
+        if not frames:
+            return
+
+        self._bind_writer(writer)
+        with self._cond:
+            self._queue.extend(
+                ('frame', writer, frame, pts, host, True, None, -1)
+                for frame, pts, host in frames)
+            self.queue_depth += len(frames)
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            self._cond.notify_all()
+
+    def close_writer(self, writer, callback):
+        '''Schedules ``callback`` to be called from the Kivy thread, with no
+        arguments, once all the frames added so far for ``writer`` were passed
+        on to it. Typically, the callback deactivates the writer.
+
+        The writer's frame index, if any, is closed before the callback is
+        called.
+        '''
+        if writer in self._writers:
+            self._writers.remove(writer)
+            writer.funbind('activation', self._notify_worker)
+        self._put(('close', writer, callback))
+
+    def attach_index(self, writer, index):
+        '''Attaches the :class:`~vet_cond.frame_index.FrameIndexWriter`
+        ``index`` to ``writer``, so that the frames subsequently added for
+        the writer are recorded in the index. The index is closed by
+        :meth:`close_writer`.
+        '''
+        self._put(('index', writer, index))
+
+    def _bind_writer(self, writer):
+        if writer not in self._writers:
+            self._writers.add(writer)
+            writer.fbind('activation', self._notify_worker)
+
+    def _notify_worker(self, *largs):
+        with self._cond:
+            self._cond.notify_all()
+
+    def _put(self, item):
+        with self._cond:
+            self._queue.append(item)
+            self._cond.notify_all()
+
+    def _call_callback(self, callback, *largs):
+        callback()
+
+    @app_error
+    def _report_error(self, e, *largs):
+        raise e
+
+    def _wait_active(self, writer):
+        '''Waits until the writer is active, or :attr:`writer_timeout`
+        elapsed. The worker is woken up by :meth:`_notify_worker` when the
+        writer's activation changes.
+        '''
+        cond = self._cond
+        end = clock() + self.writer_timeout
+        with cond:
+            while writer.activation != 'active':
+                remaining = end - clock()
+                if remaining <= 0:
+                    break
+                cond.wait(remaining)
+
+    def _run_worker(self):
+        queue = self._queue
+        cond = self._cond
+        schedule = Clock.schedule_once
+        active_writer = None
+        indices = {}
+
+        while True:
+            with cond:
+                while not queue:
+                    cond.wait()
+                item = queue.popleft()
+                if item[0] == 'frame':
+                    self.queue_depth -= 1
+                    cond.notify_all()
+
+            cmd = item[0]
+            if cmd == 'frame':
+                _, writer, frame, pts, host, _, ring, number = item
+                if writer is not active_writer:
+                    self._wait_active(writer)
+                    active_writer = writer
+                try:
+                    index = indices.get(writer)
+                    if index is not None:
+                        index.add_frame(pts, host)
+                    if ring is not None and \
+                            hasattr(writer, 'add_ring_frame'):
+                        writer.add_ring_frame(ring, number, frame, pts)
+                    else:
+                        writer.add_frame(frame, pts)
+                except Exception as e:
+                    schedule(partial(self._report_error, e))
+                else:
+                    self.frames_written += 1
+            elif cmd == 'index':
+                indices[item[1]] = item[2]
+            elif cmd == 'close':
+                index = indices.pop(item[1], None)
+                if index is not None:
+                    try:
+                        index.close()
+                    except Exception as e:
+                        schedule(partial(self._report_error, e))
+                schedule(partial(self._call_callback, item[2]))
+            elif cmd == 'exit':
+                if item[1] is not None:
+                    schedule(partial(self._call_callback, item[1]))
+                return
+
+
+class PrerecordBuffer(object):
+    '''An in-memory ring buffer of the most recent frames that is continuously
+    filled while no trial is recorded, so that when a trial's recording starts
+    the frames preceding it can be retroactively written to the trial's video.
+
+    The buffer holds frames whose pts is within :attr:`duration` seconds of
+    the newest frame and it's additionally bounded by :attr:`max_frames` and
+    :attr:`max_bytes`, so its memory use is bounded no matter for how long it
+    is filled.
+    '''
+
+    duration = 0
+    '''The number of seconds of the most recent frames to keep.
+    '''
+
+    max_frames = 0
+    '''The maximum number of frames to keep. If zero, the number of frames is
+    only bounded by :attr:`duration` and :attr:`max_bytes`.
+    '''
+
+    max_bytes = 0
+    '''The maximum number of bytes of frame data to keep. If zero, it's only
+    bounded by :attr:`duration` and :attr:`max_frames`.
+    '''
+
+    nbytes = 0
+    '''The number of bytes of frame data currently in the buffer.
+    '''
+
+    _frames = None
+    '''A deque of ``(frame, pts, host, nbytes)`` tuples.
+    '''
+
+    _frame_size = None
+    '''A tuple of the size and pixel format of the last frame with its
+    number of bytes.
+    '''
+
+    def __init__(self, duration, max_frames=0, max_bytes=0):
+        super(PrerecordBuffer, self).__init__()
+        self.duration = duration
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self._frames = deque()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def _get_nbytes(self, frame):
+        key = frame.get_size(), frame.get_pixel_format()
+        cached = self._frame_size
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        nbytes = sum(len(p) for p in frame_planes(frame))
+        self._frame_size = key, nbytes
+        return nbytes
+
+    @timed('prerecord.add_frame')
+    def add_frame(self, frame, pts, host=-1):
+        '''Adds the frame, with the host time when it was received, to the
+        buffer and removes the frames that are now beyond the bounds of the
+        buffer.
+        '''
+        frames = self._frames
+        nbytes = self._get_nbytes(frame)
+        frames.append((frame, pts, host, nbytes))
+        self.nbytes += nbytes
+
+        max_frames = self.max_frames
+        max_bytes = self.max_bytes
+        start = pts - self.duration
+        while frames and (
+                frames[0][1] < start or
+                max_frames and len(frames) > max_frames or
+                max_bytes and self.nbytes > max_bytes):
+            self.nbytes -= frames.popleft()[3]
+
+    def pop_frames(self):
+        '''Removes and returns all the frames in the buffer as a list of
+        ``(frame, pts, host)`` tuples, from oldest to newest.
+        '''
+        frames = [item[:3] for item in self._frames]
+        self.clear()
+        return frames
+
+    def clear(self):
+        '''Removes all the frames from the buffer.
+        '''
+        self._frames.clear()
+        self.nbytes = 0
+
+
+class WriterPool(object):
+    '''Creates the trial writers lazily, so that only the writers of the
+    current and next trial are open at any time, rather than the writers of
+    all the trials.
+
+    :meth:`prepare` creates and starts activating the writer of a trial ahead
+    of time, e.g. during the preceding ITI, :meth:`get` returns it when its
+    trial starts and :meth:`release` removes it from the pool once its trial
+    ends so that it can be closed.
+    '''
+
+    identifier = None
+    '''The identifier used to activate the writers.
+    '''
+
+    create_writer = None
+    '''A callable that takes the trial number and returns a new, inactive,
+    :class:`~cplcom.moa.device.ffplayer.FFPyWriterDevice` for that trial.
+    '''
+
+    writers = {}
+    '''A dict mapping trial numbers to the writers currently in the pool.
+    '''
+
+    _trackers = {}
+    '''A dict mapping trial numbers to the
+    :class:`~moa.utils.ObjectStateTracker` waiting for their writer to become
+    active.
+    '''
+
+    def __init__(self, identifier, create_writer):
+        super(WriterPool, self).__init__()
+        self.identifier = identifier
+        self.create_writer = create_writer
+        self.writers = {}
+        self._trackers = {}
+
+    def prepare(self, trial, callback=None):
+        '''Creates the writer for the trial, if it doesn't exist, and starts
+        activating it.
+
+        :Parameters:
+
+            `trial`: int
+                The trial number.
+            `callback`: callable
+                If not None, it's called with no arguments once the writer is
+                active.
+        '''
+        writer = self.writers.get(trial)
+        if writer is None:
+            writer = self.writers[trial] = self.create_writer(trial)
+            writer.activate(self.identifier)
+
+        if callback is None:
+            return writer
+        if writer.activation == 'active':
+            callback()
+        else:
+            tracker = self._trackers[trial] = ObjectStateTracker()
+            tracker.add_func_links(
+                [writer], [partial(self._activated, clock(), callback)],
+                'activation', 'active')
+        return writer
+
+    def _activated(self, ts, callback, *largs):
+        metrics.add_time('writer_pool.activation', clock() - ts)
+        callback()
+
+    def get(self, trial):
+        '''Returns the writer of the trial. If it was not prepared yet,
+        it's created and its activation is started now. The writer may still
+        be activating (see :class:`EncoderPipeline`).
+        '''
+        return self.prepare(trial)
+
+    def release(self, trial):
+        '''Removes the writer of the trial from the pool and returns it, or
+        None if it's not in the pool. The caller is responsible for
+        deactivating it.
+        '''
+        self._trackers.pop(trial, None)
+        return self.writers.pop(trial, None)
+
+    def release_all(self):
+        '''Removes all the writers from the pool and returns them in a list.
+        '''
+        writers = [self.writers[k] for k in sorted(self.writers)]
+        self.writers = {}
+        self._trackers = {}
+        return writers
+
+
+class FrameReducer(EventDispatcher):
+    '''Reduces the frames received from the video device before they are
+    recorded, analyzed, or shown, by cropping them to a region of interest,
+    optionally converting them to gray, and downscaling them.
+
+    Each frame is reduced once, as soon as it's received, so the encoder's CPU
+    use and the size of the videos drop in proportion to the pixels removed.
+    :meth:`output_format` returns the size and pixel format of the reduced
+    frames, e.g. to create the writers.
+
+    When the frames have a subsampled pixel format such as ``yuv420p``, the
+    region of interest is rounded to even pixels.
+    '''
+
+    __settings_attrs__ = ('roi', 'gray', 'scale')
+
+    roi = ListProperty([0, 0, 0, 0])
+    '''The ``(x, y, width, height)`` region of interest, in pixels from the
+    top-left of the frame, to which the frames are cropped. If the width or
+    height is zero, the frames are not cropped.
+    '''
+
+    gray = BooleanProperty(False)
+    '''Whether to convert the frames to ``gray``. E.g. for IR footage, which
+    is effectively monochrome.
+    '''
+
+    scale = NumericProperty(1.)
+    '''The factor by which the (cropped) frames are scaled, e.g. 0.5 halves
+    their width and height.
+    '''
+
+    _sws = None
+    '''A tuple of the parameters and the :class:`ffpyplayer.pic.SWScale` used
+    to convert the frames.
+    '''
+
+    @property
+    def active(self):
+        '''Whether the frames are changed at all.
+        '''
+        return (self.gray or self.scale != 1 or
+                self.roi[2] > 0 and self.roi[3] > 0)
+
+    def get_roi(self, size):
+        '''Returns the ``(x, y, width, height)`` to which a frame of the given
+        size is cropped, clipped to the frame and rounded to even pixels.
+        '''
+        w, h = size
+        x, y, rw, rh = [int(v) for v in self.roi]
+        if rw <= 0 or rh <= 0:
+            return 0, 0, w, h
+
+        x = min(max(0, x), w - 2) // 2 * 2
+        y = min(max(0, y), h - 2) // 2 * 2
+        rw = max(2, min(rw, w - x) // 2 * 2)
+        rh = max(2, min(rh, h - y) // 2 * 2)
+        return x, y, rw, rh
+
+    def output_format(self, size, pix_fmt):
+        '''Returns the ``(width, height)`` and pixel format of the reduced
+        frames given the size and pixel format of the input frames.
+        '''
+        _, _, w, h = self.get_roi(size)
+        scale = self.scale
+        if scale != 1:
+            w = max(2, int(w * scale) // 2 * 2)
+            h = max(2, int(h * scale) // 2 * 2)
+        return (w, h), 'gray' if self.gray else pix_fmt
+
+    def _crop(self, frame, x, y, w, h, luma):
+        import numpy as np
+        from ffpyplayer.pic import Image
+        fw, fh = frame.get_size()
+        planes = frame_planes(frame)
+        linesizes = [s for s in frame.get_linesizes(keep_align=False) if s]
+        pix_fmt = frame.get_pixel_format()
+        if luma:
+            planes = planes[:1]
+            pix_fmt = 'gray'
+
+        buffers = []
+        lines = []
+        for plane, linesize in zip(planes, linesizes):
+            rows = len(plane) // linesize
+            # the plane's bytes per pixel and lines per row of the frame
+            bx = linesize / float(fw)
+            by = rows / float(fh)
+            arr = np.frombuffer(plane, dtype=np.uint8).reshape(
+                (rows, linesize))
+            sub = np.ascontiguousarray(
+                arr[int(y * by):int((y + h) * by),
+                    int(x * bx):int((x + w) * bx)])
+            buffers.append(sub.tobytes())
+            lines.append(sub.shape[1])
+        return Image(plane_buffers=buffers, pix_fmt=pix_fmt, size=(w, h),
+                     linesize=lines)
+
+    @timed('reduce')
+    def reduce(self, frame):
+        '''Returns the reduced :class:`ffpyplayer.pic.Image` frame, or the
+        frame itself if it's not changed.
+        '''
+        if not self.active:
+            return frame
+
+        size = frame.get_size()
+        fmt = frame.get_pixel_format()
+        x, y, w, h = self.get_roi(size)
+        (ow, oh), ofmt = self.output_format(size, fmt)
+
+        # with luma formats, the gray frame is the first plane
+        luma = ofmt == 'gray' and fmt in _luma_fmts
+        if (x, y, w, h) != (0, 0) + tuple(size) or luma and fmt != 'gray':
+            frame = self._crop(frame, x, y, w, h, luma)
+            fmt = frame.get_pixel_format()
+
+        if (ow, oh) != (w, h) or fmt != ofmt:
+            key = w, h, fmt, ow, oh, ofmt
+            sws = self._sws
+            if sws is None or sws[0] != key:
+                from ffpyplayer.pic import SWScale
+                sws = self._sws = key, SWScale(
+                    w, h, fmt, ow=ow, oh=oh, ofmt=ofmt)
+            frame = sws[1].scale(frame)
+        return frame
@@ -0,0 +1,113 @@
+'''Registry
+===========
+
+Lazily imported classes, so that e.g. the hardware device classes, and the
+libraries they depend on, are only imported when a session uses them,
+rather than when the app starts. Looking up a single class only imports that
+class.
+
+Reading or saving the config lists the settings of all the classes. For the
+classes not yet imported, the registry lists a stand-in class made by
+:func:`settings_class` instead, with the section's settings and default
+values from the package's default config, see :func:`default_settings`.
+
+Classes are named by their ``'module:attribute'`` path, e.g.
+``'cplcom.moa.device.rtv:RTVChan'``. The time each import took is logged and
+recorded in :attr:`import_times`, for the startup report of
+:class:`~vet_cond.main.ConditioningApp`.
+'''
+
+import json
+from importlib import import_module
+from os.path import join, dirname
+
+from kivy.logger import Logger
+
+from vet_cond.timing import clock
+
+__all__ = ('ClassRegistry', 'import_class', 'import_times',
+           'default_settings', 'settings_class')
+
+import_times = {}
+'''A dict mapping the paths of the classes imported by :func:`import_class`
+to the number of seconds it took to import them.
+'''
+
+
+def import_class(path):
+    '''Returns the class (or any other attribute of a module) named by the
+    ``'module:attribute'`` ``path``, importing the module if needed.
+    '''
+    module, attr = path.split(':')
+    ts = clock()
+    cls = getattr(import_module(module), attr)
+    if path not in import_times:
+        import_times[path] = clock() - ts
+        Logger.info('VetCond: Imported {} in {:.2f}s'.format(
+            path, import_times[path]))
+    return cls
+
+
+_default_settings = None
+
+
+def default_settings():
+    '''Returns the settings of the package's default ``data/config.json``, a
+    dict mapping each config section to a dict of its settings' default
+    values. It's only read once.
+    '''
+    global _default_settings
+    if _default_settings is None:
+        with open(join(dirname(__file__), 'data', 'config.json')) as fh:
+            _default_settings = json.load(fh)
+    return _default_settings
+
+
+def settings_class(path, defaults):
+    '''Returns a class standing in for the class named by the
+    ``'module:attribute'`` ``path`` when listing the config settings, without
+    importing it. Its ``__settings_attrs__`` are the keys of the
+    ``defaults`` dict, and their values its class attributes.
+    '''
+    attrs = dict(defaults)
+    attrs['__settings_attrs__'] = tuple(sorted(defaults))
+    return type(str(path.split(':')[1]), (object, ), attrs)
+
+
+class ClassRegistry(dict):
+    '''A dict whose values are classes, or ``'module:attribute'`` paths of
+    classes that are imported with :func:`import_class` the first time
+    they are looked up, e.g. with ``registry['rtv']``.
+
+    Iterating over the values or items, e.g. to list the settings of all the
+    classes, doesn't import them. Instead, a class not yet imported is
+    listed as the :func:`settings_class` of its section in
+    :func:`default_settings`, or imported if the section is not there.
+    '''
+
+    def _listed(self, key):
+        value = super(ClassRegistry, self).__getitem__(key)
+        if isinstance(value, str) and key in default_settings():
+            return settings_class(value, default_settings()[key])
+        return self[key]
+
+    def __getitem__(self, key):
+        value = super(ClassRegistry, self).__getitem__(key)
+        if isinstance(value, str):
+            value = import_class(value)
+            self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def values(self):
+        return [self._listed(key) for key in self]
+
+    def items(self):
+        return [(key, self._listed(key)) for key in self]
+
+    def copy(self):
+        return ClassRegistry(self)
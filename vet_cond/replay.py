@@ -0,0 +1,737 @@
+'''Replay
+=========
+
+Replays the trials of a recorded session in the app. A session's CSV log is
+loaded with its trial videos, found next to the log with
+:class:`~vet_cond.indexer.SessionIndex`, and for the selected trial the time
+line is rebuilt from the recorded trial, tone, and shock times while the
+video is scrubbed in the display.
+
+Seeking
+-------
+
+To show any frame without decoding the video from the start, a seek index is
+built the first time a video is replayed and cached in a ``.seek`` file next
+to it. It lists, for every frame, the byte offset and size of the frame's
+data in the AVI file, whether it's a keyframe, its source pts from the
+video's :mod:`~vet_cond.frame_index` (or its video time if it has none), so
+e.g. the frame at the tone onset is found with a binary search, and its slot,
+the number of the frame's interval in the video's time.
+
+When frames are dropped, the AVI muxer fills the gap with empty chunks. They
+are not frames, so they are skipped, and the following frames' slots
+account for the gap. The frame index records are matched to the frames by
+slot, computed from their pts, rather than by position.
+
+For uncompressed (``rawvideo``) videos, the frame's data is then read
+directly from the memory mapped video. Other videos are decoded from the
+keyframe preceding the frame. The index is rebuilt if the video changed
+since it was cached.
+
+The seek index file starts with a :attr:`SEEK_HEADER_SIZE` bytes header::
+
+    8 bytes magic (:attr:`SEEK_MAGIC`), int64 size of the video, float64
+    modification time of the video, int32 width, int32 height, 4 bytes AVI
+    compression fourcc, uint16 bits per pixel, float64 frame rate, int64
+    number of frames,
+
+padded with zeros, followed by a record for every frame::
+
+    int64 byte offset, int64 size, float64 pts, int64 keyframe, int64 slot
+'''
+
+import mmap
+import struct
+from time import sleep
+from os.path import splitext, getsize, getmtime, isfile, dirname, abspath
+
+from kivy.event import EventDispatcher
+from kivy.properties import (
+    NumericProperty, StringProperty, ListProperty, ObjectProperty)
+from kivy.uix.behaviors.knspace import knspace
+from kivy.uix.popup import Popup
+from kivy.factory import Factory
+
+from cplcom.moa.app import app_error
+
+from vet_cond.frame_index import FrameIndex, index_filename
+from vet_cond.indexer import SessionIndex
+
+__all__ = ('SeekIndex', 'VideoSeeker', 'ReplayController', 'seek_filename',
+           'event_slices', 'SEEK_MAGIC', 'SEEK_HEADER_SIZE')
+
+SEEK_MAGIC = b'VCSEEK\x00\x02'
+'''The first bytes of the seek index files.
+'''
+
+SEEK_HEADER_SIZE = 64
+'''The number of bytes of the header preceding the records.
+'''
+
+_header = struct.Struct('<8sqdii4sHdq')
+_record = struct.Struct('<qqdqq')
+_chunk = struct.Struct('<4sI')
+
+_raw_fourccs = {
+    b'Y800': 'gray', b'Y8  ': 'gray', b'GREY': 'gray', b'I420': 'yuv420p',
+    b'IYUV': 'yuv420p', b'Y42B': 'yuv422p', b'444P': 'yuv444p',
+    b'NV12': 'nv12', b'NV21': 'nv21', b'YUY2': 'yuyv422',
+    b'\0\0\0\0': 'bgr24'}
+'''The pixel formats of the uncompressed AVI fourccs, which can be read
+directly from the file. For ``BI_RGB`` (zero), only 24 bits are supported.
+'''
+
+EVENT_NAMES = (
+    ('trial_ts', 'trial_te', 'Trial'), ('tone_ts', 'tone_te', 'Tone'),
+    ('shock_ts', 'shock_te', 'Shock'))
+'''The ``(start key, end key, name)`` of the trial events shown in the time
+line.
+'''
+
+
+def seek_filename(video_filename):
+    '''Returns the filename of the seek index of the video.
+    '''
+    return '{}.seek'.format(splitext(video_filename)[0])
+
+
+def _plane_sizes(pix_fmt, w, h):
+    '''Returns the ``(sizes, linesizes)`` of the planes of an uncompressed
+    frame.
+    '''
+    cw, ch = (w + 1) // 2, (h + 1) // 2
+    if pix_fmt == 'gray':
+        return [w * h], [w]
+    if pix_fmt == 'yuv420p':
+        return [w * h, cw * ch, cw * ch], [w, cw, cw]
+    if pix_fmt == 'yuv422p':
+        return [w * h, cw * h, cw * h], [w, cw, cw]
+    if pix_fmt == 'yuv444p':
+        return [w * h] * 3, [w] * 3
+    if pix_fmt in ('nv12', 'nv21'):
+        return [w * h, 2 * cw * ch], [w, 2 * cw]
+    if pix_fmt == 'yuyv422':
+        return [2 * w * h], [2 * w]
+    if pix_fmt == 'bgr24':
+        stride = (3 * w + 3) // 4 * 4
+        return [stride * h], [stride]
+    raise ValueError('Unsupported pixel format {}'.format(pix_fmt))
+
+
+def _scan_avi(filename):
+    '''Returns a dict describing the first video stream of the AVI file and
+    a list of the ``(offset, size, keyframe, slot)`` of its frames, where
+    ``slot`` is the number of the frame's chunk. Empty chunks, written for
+    dropped frames, are skipped.
+
+    The movi lists are scanned, rather than only reading the ``idx1`` index,
+    so that the frames of a file that wasn't closed, e.g. due to a crash, or
+    of the extended OpenDML RIFF chunks are included. ``idx1`` is only used
+    for the keyframe flags.
+    '''
+    size = getsize(filename)
+    info = {'width': 0, 'height': 0, 'fourcc': b'\0\0\0\0', 'bitcount': 0,
+            'rate': 0.}
+    frames = []
+    keyframes = []
+    streams = []
+
+    with open(filename, 'rb') as fh:
+        def read_chunks(start, end):
+            pos = start
+            while pos + 8 <= end:
+                fh.seek(pos)
+                ckid, length = _chunk.unpack(fh.read(8))
+                data = pos + 8
+                if ckid in (b'RIFF', b'LIST'):
+                    # the length of an unclosed list may not be written yet
+                    kind = fh.read(4)
+                    if kind in (b'AVI ', b'AVIX', b'hdrl', b'strl', b'movi',
+                                b'rec '):
+                        read_chunks(data + 4, min(
+                            data + length if length else size, size))
+                elif data + length > size:
+                    return  # the last chunk was not fully written
+                elif ckid == b'strh':
+                    fcc_type = fh.read(4)
+                    fh.seek(data + 20)
+                    scale, rate = struct.unpack('<II', fh.read(8))
+                    streams.append(fcc_type)
+                    if fcc_type == b'vids' and not info['rate'] and scale:
+                        info['rate'] = rate / float(scale)
+                elif ckid == b'strf' and len(streams) == 1 and \
+                        streams[0] == b'vids':
+                    fh.seek(data + 4)
+                    w, h, _, bitcount, fourcc = struct.unpack(
+                        '<iiHH4s', fh.read(16))
+                    info.update({'width': w, 'height': h,
+                                 'bitcount': bitcount, 'fourcc': fourcc})
+                elif ckid in (b'00dc', b'00db'):
+                    frames.append((data, length))
+                elif ckid == b'idx1':
+                    entries = fh.read(length)
+                    for i in range(0, length - 15, 16):
+                        entry_id, flags = struct.unpack_from(
+                            '<4sI', entries, i)
+                        if entry_id in (b'00dc', b'00db'):
+                            keyframes.append(bool(flags & 0x10))
+                pos = data + length + (length & 1)
+
+        read_chunks(0, size)
+
+    raw = info['fourcc'] in _raw_fourccs
+    if len(keyframes) < len(frames):
+        # without a complete index only the raw frames are known keyframes
+        keyframes.extend(
+            [raw or not i for i in range(len(keyframes), len(frames))])
+    return info, [
+        (offset, length, key, slot)
+        for slot, ((offset, length), key) in enumerate(zip(frames, keyframes))
+        if length]
+
+
+class SeekIndex(object):
+    '''Reads a seek index file by memory mapping it. Use :meth:`build` to
+    create or update the seek index of a video.
+
+    Records are accessed by their frame number, e.g. ``index[10]`` returns
+    the ``(offset, size, pts, keyframe, slot)`` tuple of the 11th frame.
+    '''
+
+    filename = ''
+    '''The filename of the seek index.
+    '''
+
+    video_size = 0
+    '''The size of the video when the index was built.
+    '''
+
+    video_mtime = 0
+    '''The modification time of the video when the index was built.
+    '''
+
+    size = (0, 0)
+    '''The ``(width, height)`` of the frames.
+    '''
+
+    fourcc = b''
+    '''The AVI compression fourcc of the video.
+    '''
+
+    bitcount = 0
+    '''The number of bits per pixel of the video.
+    '''
+
+    rate = 0.
+    '''The frame rate of the video.
+    '''
+
+    count = 0
+    '''The number of frames in the index.
+    '''
+
+    _fh = None
+    '''The open file.
+    '''
+
+    _map = None
+    '''The :class:`mmap.mmap` of the file, or None if it has no records.
+    '''
+
+    def __init__(self, filename):
+        super(SeekIndex, self).__init__()
+        self.filename = filename
+        fh = self._fh = open(filename, 'rb')
+        header = fh.read(SEEK_HEADER_SIZE)
+        if len(header) < _header.size:
+            raise ValueError('"{}" is not a seek index'.format(filename))
+
+        (magic, self.video_size, self.video_mtime, w, h, self.fourcc,
+         self.bitcount, self.rate, self.count) = _header.unpack_from(header)
+        if magic != SEEK_MAGIC:
+            raise ValueError('"{}" is not a seek index'.format(filename))
+        self.size = w, h
+        if self.count > 0:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @classmethod
+    def build(cls, video_filename):
+        '''Returns the :class:`SeekIndex` of the video, reading it from the
+        video's ``.seek`` file if it's up to date, otherwise creating it.
+        '''
+        filename = seek_filename(video_filename)
+        size, mtime = getsize(video_filename), getmtime(video_filename)
+        if isfile(filename):
+            try:
+                index = cls(filename)
+            except ValueError:
+                index = None  # e.g. an older version of the index
+            if index is not None:
+                if index.video_size == size and index.video_mtime == mtime:
+                    return index
+                index.close()
+
+        info, frames = _scan_avi(video_filename)
+        rate = info['rate']
+        pts = [slot / rate if rate else 0. for _, _, _, slot in frames]
+        fidx = index_filename(video_filename)
+        if isfile(fidx) and rate:
+            # use the source pts in which the events are given, matching the
+            # records to the frames by slot because of the dropped frames
+            source = {}
+            with FrameIndex(fidx) as frame_index:
+                if len(frame_index):
+                    first = frame_index.get_pts(0)
+                    for i in range(len(frame_index)):
+                        t = frame_index.get_pts(i)
+                        source[int(round((t - first) * rate))] = t
+            if source:
+                pts = [source.get(slot, first + slot / rate)
+                       for _, _, _, slot in frames]
+
+        header = _header.pack(
+            SEEK_MAGIC, size, mtime, info['width'], info['height'],
+            info['fourcc'], info['bitcount'], rate, len(frames))
+        with open(filename, 'wb') as fh:
+            fh.write(header + b'\0' * (SEEK_HEADER_SIZE - len(header)))
+            for (offset, length, key, slot), t in zip(frames, pts):
+                fh.write(_record.pack(offset, length, t, key, slot))
+        return cls(filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *largs):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('Frame {} is out of range'.format(i))
+        return _record.unpack_from(
+            self._map, SEEK_HEADER_SIZE + i * _record.size)
+
+    def close(self):
+        '''Closes the file.
+        '''
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def get_pts(self, i):
+        '''Returns the pts of frame ``i``.
+        '''
+        return self[i][2]
+
+    def get_slot(self, i):
+        '''Returns the slot of frame ``i``, the number of its interval in the
+        video's time, which is larger than ``i`` after dropped frames.
+        '''
+        return self[i][4]
+
+    def find(self, pts):
+        '''Returns the number of the last frame whose pts is at or before
+        ``pts``, or zero if there's none.
+        '''
+        return self._bisect(self.get_pts, pts)
+
+    def find_slot(self, slot):
+        '''Returns the number of the last frame whose slot is at or before
+        ``slot``, or zero if there's none.
+        '''
+        return self._bisect(self.get_slot, slot)
+
+    def _bisect(self, get_value, value):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if get_value(mid) <= value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return max(0, lo - 1)
+
+    def keyframe_before(self, i):
+        '''Returns the number of the last keyframe at or before frame ``i``.
+        '''
+        while i > 0 and not self[i][3]:
+            i -= 1
+        return max(i, 0)
+
+
+class VideoSeeker(object):
+    '''Returns any frame of a video as a :class:`ffpyplayer.pic.Image`, using
+    its :class:`SeekIndex`. It can be used as a context manager that closes
+    the files on exit.
+    '''
+
+    filename = ''
+    '''The filename of the video.
+    '''
+
+    index = None
+    '''The :class:`SeekIndex` of the video.
+    '''
+
+    pix_fmt = ''
+    '''The pixel format of the frames, if they are read directly from the
+    file, otherwise ``''`` and the frames are decoded.
+    '''
+
+    _fh = None
+    '''The open video file.
+    '''
+
+    _map = None
+    '''The :class:`mmap.mmap` of the video, if read directly.
+    '''
+
+    _player = None
+    '''The :class:`ffpyplayer.player.MediaPlayer` decoding the video, if not
+    read directly.
+    '''
+
+    _next = -1
+    '''The number of the frame the player decodes next, or -1 if unknown.
+    '''
+
+    def __init__(self, filename):
+        super(VideoSeeker, self).__init__()
+        self.filename = filename
+        index = self.index = SeekIndex.build(filename)
+        self.pix_fmt = _raw_fourccs.get(index.fourcc, '')
+        if self.pix_fmt == 'bgr24' and index.bitcount != 24:
+            self.pix_fmt = ''
+        if self.pix_fmt and len(index):
+            self._fh = open(filename, 'rb')
+            self._map = mmap.mmap(
+                self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *largs):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        '''Closes the video and its index.
+        '''
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if self._player is not None:
+            self._player.close_player()
+            self._player = None
+        self.index.close()
+
+    def get_frame(self, i):
+        '''Returns the :class:`ffpyplayer.pic.Image` of frame ``i``.
+        '''
+        if self.pix_fmt:
+            return self._read_frame(i)
+        return self._decode_frame(i)
+
+    def _read_frame(self, i):
+        from ffpyplayer.pic import Image
+        offset, length, _, _, _ = self.index[i]
+        w, h = self.index.size
+        pix_fmt = self.pix_fmt
+        sizes, linesizes = _plane_sizes(pix_fmt, w, abs(h))
+        if length < sum(sizes):
+            raise ValueError('Frame {} of "{}" is truncated'.format(
+                i, self.filename))
+
+        # copy the frame, so the image doesn't hold on to the mapped file
+        data = memoryview(self._map[offset:offset + sum(sizes)])
+        if pix_fmt == 'bgr24' and h > 0:
+            # BI_RGB frames are stored bottom-up
+            import numpy as np
+            arr = np.frombuffer(data, dtype=np.uint8).reshape((h, -1))
+            return Image(plane_buffers=[arr[::-1].tobytes()],
+                         pix_fmt=pix_fmt, size=(w, h), linesize=linesizes)
+
+        planes = []
+        for size in sizes:
+            planes.append(data[:size])
+            data = data[size:]
+        return Image(plane_buffers=planes, pix_fmt=pix_fmt,
+                     size=(w, abs(h)), linesize=linesizes)
+
+    def _get_player_frame(self):
+        '''Returns the next ``(img, pts)`` decoded by the player, or None at
+        the end of the video.
+        '''
+        player = self._player
+        while True:
+            frame, val = player.get_frame(force_refresh=True)
+            if val == 'eof':
+                return None
+            if frame is not None:
+                return frame
+            sleep(.001)
+
+    def _frame_number(self, pts):
+        '''Returns the number of the frame with the player's ``pts``.
+
+        The pts of the :attr:`index` may be the source pts of the
+        :class:`~vet_cond.frame_index.FrameIndex`, so the player's pts, which
+        are in the file's time base, are matched to the frames' slots using
+        the file's frame rate.
+        '''
+        rate = self.index.rate
+        if not rate:
+            return self._next
+        return self.index.find_slot(int(round(pts * rate)))
+
+    def _decode_frame(self, i):
+        index = self.index
+        player = self._player
+        if player is None:
+            from ffpyplayer.player import MediaPlayer
+            player = self._player = MediaPlayer(self.filename, ff_opts={
+                'an': True, 'sn': True, 'framedrop': False,
+                'sync': 'video'})
+            self._next = 0
+
+        key = None
+        if not self._next <= i < self._next + 30:
+            # decode from the keyframe preceding the frame
+            key = index.keyframe_before(i)
+            player.seek(
+                index.get_slot(key) / index.rate if index.rate else 0,
+                relative=False, accurate=False)
+            self._next = key
+
+        # the player decodes asynchronously, so after a seek it may still
+        # return frames queued before the seek. Match the frames by their pts
+        img = None
+        stale = 0
+        while True:
+            frame = self._get_player_frame()
+            if frame is None:
+                return img
+            n = self._frame_number(frame[1])
+            if key is not None and not key <= n <= i and stale < 30:
+                stale += 1
+                continue
+
+            key = None
+            self._next = n + 1
+            if n == i or n > i and img is None:
+                return frame[0]
+            if n > i:
+                # frame i is missing from the video, use the one before it
+                return img
+            img = frame[0]
+
+
+def event_slices(row, start, end):
+    '''Returns a list of ``(name, duration)`` of the time line slices of a
+    trial's video, from the trial's log ``row``, a dict keyed by the
+    :attr:`~vet_cond.trial_log.TRIAL_COLUMNS` keys, and the pts of the first
+    and last frames of the video.
+
+    The video is split at each event's start and end, and each slice is
+    named by the events during it, e.g. ``'Pre'``, ``'Trial'``,
+    ``'Trial+Tone'``, or ``'Post'``.
+    '''
+    times = {start, end}
+    for start_key, end_key, _ in EVENT_NAMES:
+        for key in (start_key, end_key):
+            t = row.get(key)
+            if t is not None and t != -1 and start < t < end:
+                times.add(t)
+
+    times = sorted(times)
+    slices = []
+    for t0, t1 in zip(times[:-1], times[1:]):
+        names = [
+            name for start_key, end_key, name in EVENT_NAMES
+            if row.get(start_key) not in (None, -1) and
+            row[start_key] <= t0 and
+            (row.get(end_key) in (None, -1) or t1 <= row[end_key])]
+        if names:
+            name = '+'.join(names)
+        elif row.get('trial_ts') not in (None, -1) and t0 < row['trial_ts']:
+            name = 'Pre'
+        else:
+            name = 'Post'
+        slices.append((name, t1 - t0))
+    return slices
+
+
+class ReplayController(EventDispatcher):
+    '''Replays the trials of a session log, showing the frames in
+    ``knspace.display`` and the trial's events in ``knspace.time_line``.
+
+    It's created by :meth:`~vet_cond.main.ConditioningApp.open_replay`, and
+    can only be used while no experiment is running, because they share the
+    display and time line.
+    '''
+
+    log_filename = StringProperty('')
+    '''The filename of the loaded log.
+    '''
+
+    trials = ListProperty([])
+    '''The list of the log's trial rows, as returned by
+    :meth:`~vet_cond.indexer.SessionIndex.query`.
+    '''
+
+    trial = NumericProperty(-1)
+    '''The index in :attr:`trials` of the trial being replayed, or -1.
+    '''
+
+    position = NumericProperty(0)
+    '''The number of the frame of the trial's video being shown.
+    '''
+
+    frame_count = NumericProperty(0)
+    '''The number of frames in the trial's video.
+    '''
+
+    pts = NumericProperty(0)
+    '''The source pts of the frame being shown.
+    '''
+
+    event = StringProperty('')
+    '''The start key of the event last jumped to with :meth:`seek_event`,
+    e.g. ``'tone_ts'``. When another trial is selected, the video jumps to
+    the same event of that trial.
+    '''
+
+    seeker = ObjectProperty(None, allownone=True)
+    '''The :class:`VideoSeeker` of the trial's video, or None if the trial
+    has no video.
+    '''
+
+    _slices = []
+    '''The list of ``(name, start, end)`` of the time line slices.
+    '''
+
+    def browse(self):
+        '''Shows a file browser to select the log to load.
+        '''
+        browser = Factory.FileBrowser(select_string='Open',
+                                      filters=['*.csv'])
+        popup = Popup(title='Select a session log', content=browser,
+                      size_hint=(.9, .9))
+
+        def on_success(*largs):
+            popup.dismiss()
+            if browser.selection:
+                self.load(browser.selection[0])
+        browser.bind(on_success=on_success, on_canceled=popup.dismiss)
+        popup.open()
+
+    @app_error
+    def load(self, log_filename):
+        '''Loads the trials of the log and their videos, found in the log's
+        directory (but not its sub-directories), and selects the first trial.
+        '''
+        self.close()
+        log_filename = abspath(log_filename)
+        pattern = knspace.app.app_settings['experiment']['video_name_pat']
+        with SessionIndex(':memory:', video_name_pat=pattern) as index:
+            index.update([dirname(log_filename)], recursive=False)
+            self.trials = index.query(log=log_filename)
+        self.log_filename = log_filename
+        self.event = ''
+        if self.trials:
+            self.select_trial(0)
+
+    def close(self):
+        '''Closes the trial's video.
+        '''
+        if self.seeker is not None:
+            self.seeker.close()
+            self.seeker = None
+        self.frame_count = self.position = 0
+        self.trial = -1
+
+    @app_error
+    def select_trial(self, trial):
+        '''Shows the trial with index ``trial`` in :attr:`trials`, at the
+        :attr:`event` if any, otherwise at the start of the video.
+        '''
+        if not 0 <= trial < len(self.trials):
+            return
+        event = self.event
+        self.close()
+        self.trial = trial
+        row = self.trials[trial]
+        if row['video'] is None or not isfile(row['video']):
+            self._slices = []
+            knspace.time_line.clear_slices()
+            return
+
+        seeker = self.seeker = VideoSeeker(row['video'])
+        count = self.frame_count = len(seeker)
+        if not count:
+            return
+
+        start, end = seeker.index.get_pts(0), seeker.index.get_pts(-1)
+        time_line = knspace.time_line
+        time_line.clear_slices()
+        self._slices = []
+        for i, (name, duration) in enumerate(event_slices(row, start, end)):
+            # the names must be unique, e.g. the trial before and after a tone
+            key = '{}{}'.format(name, i)
+            time_line.add_slice(name=key, duration=duration, text=name)
+            self._slices.append((key, start, start + duration))
+            start += duration
+        time_line.smear_slices()
+
+        self.event = event
+        if event and row.get(event) not in (None, -1):
+            self.seek_event(event)
+        else:
+            self.seek(0)
+
+    @app_error
+    def seek(self, frame):
+        '''Shows frame number ``frame`` of the trial's video.
+        '''
+        seeker = self.seeker
+        if seeker is None or not self.frame_count:
+            return
+        frame = min(max(int(frame), 0), self.frame_count - 1)
+        img = seeker.get_frame(frame)
+        self.position = frame
+        pts = self.pts = seeker.index.get_pts(frame)
+        if img is not None:
+            knspace.display.update_img(img)
+
+        for name, start, end in self._slices:
+            if start <= pts <= end:
+                knspace.time_line.set_active_slice(name)
+                break
+
+    def seek_event(self, key):
+        '''Shows the first frame of the event ``key``, e.g. ``'tone_ts'``, of
+        the trial, and remembers it in :attr:`event`.
+        '''
+        if self.trial < 0 or self.seeker is None:
+            return
+        self.event = key
+        t = self.trials[self.trial].get(key)
+        if t is None or t == -1:
+            return
+        index = self.seeker.index
+        frame = index.find(t)
+        if index.get_pts(frame) < t and frame + 1 < len(index):
+            frame += 1
+        self.seek(frame)
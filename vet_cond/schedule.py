@@ -0,0 +1,222 @@
+'''Schedule
+===========
+
+Compiles the protocol of an animal, an entry of
+:attr:`~vet_cond.stages.RootStage.trial_opts`, into the explicit times of
+all the trials before the animal is started.
+
+The only random part of a protocol are the ITIs, which are drawn from a
+:class:`random.Random` seeded with :attr:`Schedule.seed`, so the same seed
+always gives the same schedule. The schedule is saved next to the log, so a
+session can be reproduced, and the stages run the ITIs from it rather than
+drawing them as they go.
+
+All the times are in seconds from the start of the animal's prehab, and are
+the nominal times, the actual times of the events are in the log.
+'''
+
+import json
+import random
+from os.path import isfile
+
+__all__ = ('Schedule', 'compile_schedule', 'TRIAL_KEYS')
+
+TRIAL_KEYS = (
+    'trial', 'record_start', 'trial_start', 'tone_start', 'tone_end',
+    'shock_start', 'shock_end', 'trial_end', 'record_end', 'iti', 'iti_end')
+'''The keys of the dicts describing each trial in :attr:`Schedule.trials`.
+
+`trial` is the trial number. `record_start` and `record_end` delimit the
+trial's video, including the prerecord and postrecord. `tone_start`,
+`tone_end`, `shock_start`, and `shock_end` are -1 if there's no tone or
+shock. `iti` is the duration of the ITI following the trial, which ends at
+`iti_end`.
+'''
+
+
+class Schedule(object):
+    '''The schedule of an animal, as created by :func:`compile_schedule`.
+    '''
+
+    seed = 0
+    '''The seed from which the ITIs were drawn.
+    '''
+
+    trial_type = ''
+    '''The name of the protocol in
+    :attr:`~vet_cond.stages.RootStage.trial_opts`.
+    '''
+
+    opts = {}
+    '''The protocol, the :attr:`~vet_cond.stages.RootStage.trial_opts` entry
+    of :attr:`trial_type`.
+    '''
+
+    prehab = 0
+    '''The habituation time before the first trial.
+    '''
+
+    posthab = 0
+    '''The habituation time after the last trial's ITI.
+    '''
+
+    prerecord = 0
+    '''The time recorded before each trial.
+    '''
+
+    postrecord = 0
+    '''The time recorded after each trial.
+    '''
+
+    prerecord_buffer = True
+    '''Whether the prerecord is taken from the end of the preceding ITI (or
+    prehab), see :attr:`~vet_cond.stages.RootStage.prerecord_buffer`.
+    '''
+
+    trial_length = 0
+    '''The length of each trial. It's the trial's `duration`, or if it's zero,
+    the time until the tone and shock are done.
+    '''
+
+    trials = []
+    '''A list with a dict for each trial, with the :attr:`TRIAL_KEYS` keys.
+    '''
+
+    duration = 0
+    '''The total duration of the animal's session, including the habituation
+    periods.
+    '''
+
+    def __init__(self, **kwargs):
+        super(Schedule, self).__init__()
+        self.trials = []
+        self.opts = {}
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def get_state(self):
+        '''Returns a json-serializable dict describing the schedule, which can
+        be passed to :meth:`from_state`.
+        '''
+        return {
+            'seed': self.seed, 'trial_type': self.trial_type,
+            'opts': self.opts, 'prehab': self.prehab,
+            'posthab': self.posthab, 'prerecord': self.prerecord,
+            'postrecord': self.postrecord,
+            'prerecord_buffer': self.prerecord_buffer,
+            'trial_length': self.trial_length, 'trials': self.trials,
+            'duration': self.duration}
+
+    @classmethod
+    def from_state(cls, state):
+        '''Returns a :class:`Schedule` from the dict returned by
+        :meth:`get_state`.
+        '''
+        return cls(**state)
+
+    def save(self, filename, **info):
+        '''Appends the schedule to the json file, which holds a list of the
+        schedules of all the animals logged to the same log. ``info`` are
+        additional keys saved with the schedule, e.g. the animal.
+        '''
+        schedules = []
+        if isfile(filename):
+            with open(filename) as fh:
+                schedules = json.load(fh)
+
+        state = self.get_state()
+        state.update(info)
+        schedules.append(state)
+        with open(filename, 'w') as fh:
+            json.dump(schedules, fh, indent=2, sort_keys=True)
+
+    @staticmethod
+    def load(filename):
+        '''Returns the list of :class:`Schedule` saved in the file by
+        :meth:`save`.
+        '''
+        with open(filename) as fh:
+            return [Schedule.from_state(s) for s in json.load(fh)]
+
+
+def _check_event(name, delay, duration, trial_duration):
+    if delay < 0 or duration < 0:
+        raise ValueError('The {} delay and duration cannot be negative'.
+                         format(name))
+    if duration and trial_duration and delay + duration > trial_duration:
+        raise ValueError(
+            'The {} ends at {}s, after the end of the trial at {}s'.format(
+                name, delay + duration, trial_duration))
+
+
+def compile_schedule(trial_type, opts, seed=None, prehab=60, posthab=60,
+                     prerecord=5, postrecord=5, prerecord_buffer=True):
+    '''Returns the :class:`Schedule` of the protocol ``opts``, a
+    :attr:`~vet_cond.stages.RootStage.trial_opts` entry named ``trial_type``.
+
+    If ``seed`` is None, a random seed is used. The other parameters are the
+    :class:`~vet_cond.stages.RootStage` properties of the same name.
+
+    Raises a ValueError if the protocol is invalid, e.g. the tone or shock
+    doesn't fit in the trial, or when ``prerecord_buffer``, the prerecord
+    doesn't fit in the habituation time or ITI preceding a trial.
+    '''
+    if seed is None:
+        seed = random.SystemRandom().randint(0, 2 ** 31 - 1)
+    seed = int(seed)
+    repeat = int(opts['repeat'])
+    duration = float(opts['duration'])
+    shock_delay, shock_duration = map(float, opts['shock'])
+    tone_delay, tone_duration = map(float, opts['tone'])
+    iti_min, iti_max = map(float, opts['iti'])
+
+    if repeat < 0 or duration < 0:
+        raise ValueError('The number of trials and trial duration cannot be '
+                         'negative')
+    if iti_min < 0 or iti_max < iti_min:
+        raise ValueError('The ITI range ({}, {}) is invalid'.format(
+            iti_min, iti_max))
+    if min(prehab, posthab, prerecord, postrecord) < 0:
+        raise ValueError('The habituation and record times cannot be '
+                         'negative')
+    _check_event('shock', shock_delay, shock_duration, duration)
+    _check_event('tone', tone_delay, tone_duration, duration)
+
+    length = duration or max(
+        shock_delay + shock_duration if shock_duration else 0,
+        tone_delay + tone_duration if tone_duration else 0)
+
+    rand = random.Random(seed)
+    trials = []
+    t = gap = float(prehab)
+    for i in range(repeat):
+        if prerecord_buffer:
+            if prerecord > gap:
+                raise ValueError(
+                    'The {}s prerecord of trial {} is longer than the {}s '
+                    'preceding it'.format(prerecord, i, gap))
+            record_start = t - prerecord
+        else:
+            record_start = t
+            t += prerecord
+
+        trial_end = t + length
+        record_end = trial_end + postrecord
+        gap = rand.uniform(iti_min, iti_max)
+        trials.append({
+            'trial': i, 'record_start': record_start, 'trial_start': t,
+            'tone_start': t + tone_delay if tone_duration else -1,
+            'tone_end': t + tone_delay + tone_duration
+            if tone_duration else -1,
+            'shock_start': t + shock_delay if shock_duration else -1,
+            'shock_end': t + shock_delay + shock_duration
+            if shock_duration else -1,
+            'trial_end': trial_end, 'record_end': record_end, 'iti': gap,
+            'iti_end': record_end + gap})
+        t = record_end + gap
+
+    return Schedule(
+        seed=seed, trial_type=trial_type, opts=dict(opts), prehab=prehab,
+        posthab=posthab, prerecord=prerecord, postrecord=postrecord,
+        prerecord_buffer=prerecord_buffer, trial_length=length,
+        trials=trials, duration=t + posthab)
@@ -0,0 +1,484 @@
+'''Segments
+===========
+
+Segmented recording of the trial videos. A single trial video is only a
+valid file once it's closed, so if the app or the Barst server crashes during
+a trial, the video of that trial may be unreadable. :class:`SegmentedWriter`
+instead writes each trial as a sequence of short videos, segments, of
+:attr:`SegmentedWriter.segment_duration` seconds, each closed as soon as it's
+done, so at most the segment being written is lost in a crash.
+
+Every segment opened and closed is appended to a running segment index,
+``<video>_segments.txt`` next to the video, which is flushed to disk on each
+change. Each line of the index is a json dict. The first describes the
+video with the `filename` of the final video and its `size`, `rate`, `ofmt`,
+and `codec`. It's followed by an ``{"open": segment, "start": pts}`` line
+when a segment is opened, with the pts of its first frame, and a ``{"close":
+segment, "end": pts, "frames": count}`` line once it's closed. A final
+``{"done": true}`` line is written once the trial ended.
+
+After the session, a :class:`SegmentMerger` joins the segments of each trial,
+in a background thread, into the trial's video and removes the segments and
+their index. When the app is closed, it waits for the mergers to finish with
+:func:`join_mergers`. Segments that were never merged, e.g. after a crash or
+when the app was closed before they were merged, can be merged from the
+command line, e.g.::
+
+    python -m vet_cond.segments data/*_segments.txt
+
+With the default ``rawvideo`` :attr:`SegmentedWriter.codec`, the merged
+video is identical to the video that would have been written directly.
+'''
+
+import os
+import sys
+import json
+import argparse
+from threading import Thread, Condition
+from fractions import Fraction
+from functools import partial
+from time import sleep
+from timeit import default_timer as clock
+from os.path import splitext, exists, dirname, join, basename
+
+from kivy.clock import Clock
+from kivy.properties import NumericProperty, StringProperty, BooleanProperty
+
+from moa.device import Device
+
+from cplcom.moa.app import app_error
+
+from vet_cond.metrics import timed
+
+__all__ = ('SegmentedWriter', 'SegmentMerger', 'merge_segments',
+           'join_mergers', 'segment_index_filename', 'main')
+
+_mergers = []
+'''The :class:`SegmentMerger` instances that were started.
+'''
+
+
+def segment_index_filename(video_filename):
+    '''Returns the filename of the segment index of the video.
+    '''
+    return '{}_segments.txt'.format(splitext(video_filename)[0])
+
+
+def _frame_rate(rate):
+    rate = Fraction(rate).limit_denominator(1001)
+    return rate.numerator, rate.denominator
+
+
+def _create_media_writer(filename, size, ifmt, ofmt, rate, codec):
+    from ffpyplayer.writer import MediaWriter
+    w, h = size
+    return MediaWriter(filename, [{
+        'pix_fmt_in': ifmt, 'width_in': w, 'height_in': h,
+        'pix_fmt_out': ofmt or ifmt, 'codec': codec,
+        'frame_rate': _frame_rate(rate)}])
+
+
+class SegmentedWriter(Device):
+    '''A video writer with the same interface as
+    :class:`~cplcom.moa.device.ffplayer.FFPyWriterDevice`, which writes the
+    video as segments of :attr:`segment_duration` seconds, as described in
+    :mod:`~vet_cond.segments`.
+
+    :meth:`add_frame` is called from the
+    :class:`~vet_cond.recording.EncoderPipeline` worker thread, which
+    therefore also closes and opens the segments. Once deactivated, the last
+    segment is closed in a background thread, so the Kivy thread never waits
+    for a video to be finalized, and the segment index is passed to
+    :attr:`merger`, if not None.
+    '''
+
+    __settings_attrs__ = ('segment_duration', 'codec', 'keep_segments')
+
+    filename = StringProperty('')
+    '''The filename of the final, merged, video.
+    '''
+
+    rate = NumericProperty(30.)
+    '''The frame rate of the video.
+    '''
+
+    size = (0, 0)
+    '''The ``(width, height)`` of the frames.
+    '''
+
+    ifmt = ''
+    '''The pixel format of the frames passed to :meth:`add_frame`.
+    '''
+
+    ofmt = ''
+    '''The pixel format of the video. If empty, it's :attr:`ifmt`.
+    '''
+
+    segment_duration = NumericProperty(10.)
+    '''The duration, in seconds, of each segment. At most this much video is
+    lost if the app crashes during a trial.
+    '''
+
+    codec = StringProperty('rawvideo')
+    '''The codec used to encode the segments and the merged video.
+    '''
+
+    keep_segments = BooleanProperty(False)
+    '''Whether to keep the segments and their index once they were merged.
+    '''
+
+    merger = None
+    '''The :class:`SegmentMerger` to which the segment index is passed once
+    the last segment was closed, or None.
+    '''
+
+    index_filename = ''
+    '''The filename of the segment index.
+    '''
+
+    segments = []
+    '''The list of the filenames of the segments written so far.
+    '''
+
+    frames_written = 0
+    '''The number of frames written.
+    '''
+
+    _writer = None
+    '''The :class:`ffpyplayer.writer.MediaWriter` of the current segment.
+    '''
+
+    _index = None
+    '''The open segment index file.
+    '''
+
+    _segment_start = 0
+    '''The pts of the first frame of the current segment.
+    '''
+
+    _segment_pts = 0
+    '''The pts of the last frame of the current segment.
+    '''
+
+    _segment_frames = 0
+    '''The number of frames in the current segment.
+    '''
+
+    def __init__(self, filename='', rate=30., size=(0, 0), ifmt='',
+                 ofmt='', merger=None, **kwargs):
+        super(SegmentedWriter, self).__init__(
+            filename=filename, rate=rate, **kwargs)
+        self.size = tuple(size)
+        self.ifmt = ifmt
+        self.ofmt = ofmt
+        self.merger = merger
+        self.segments = []
+        self.index_filename = segment_index_filename(filename)
+
+    def activate(self, *largs, **kwargs):
+        if self.activation == 'inactive' and exists(self.filename):
+            raise Exception('"{}" already exists'.format(self.filename))
+        if not super(SegmentedWriter, self).activate(*largs, **kwargs):
+            return False
+
+        self.segments = []
+        self.frames_written = 0
+        self._index = open(self.index_filename, 'w')
+        self._write_index({
+            'filename': basename(self.filename), 'size': list(self.size),
+            'rate': self.rate, 'ofmt': self.ofmt or self.ifmt,
+            'codec': self.codec})
+        self.activation = 'active'
+        return True
+
+    def deactivate(self, *largs, **kwargs):
+        if not super(SegmentedWriter, self).deactivate(*largs, **kwargs):
+            return False
+        thread = Thread(target=self._finish, name='SegmentedWriter')
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _write_index(self, item):
+        index = self._index
+        index.write(json.dumps(item) + '\n')
+        index.flush()
+        os.fsync(index.fileno())
+
+    def _open_segment(self, pts):
+        root, ext = splitext(self.filename)
+        fname = '{}_seg{:04d}{}'.format(root, len(self.segments), ext)
+        self._writer = _create_media_writer(
+            fname, self.size, self.ifmt, self.ofmt, self.rate, self.codec)
+        self.segments.append(fname)
+        self._segment_start = self._segment_pts = pts
+        self._segment_frames = 0
+        self._write_index({'open': basename(fname), 'start': pts})
+
+    def _close_segment(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+        self._write_index({
+            'close': basename(self.segments[-1]), 'end': self._segment_pts,
+            'frames': self._segment_frames})
+
+    @timed('segments.add_frame')
+    def add_frame(self, frame, pts):
+        '''Writes the frame to the current segment, first closing it and
+        opening the next one if it's already :attr:`segment_duration` long.
+        '''
+        if self._writer is None or \
+                pts - self._segment_start >= self.segment_duration:
+            self._close_segment()
+            self._open_segment(pts)
+        self._writer.write_frame(img=frame, pts=pts - self._segment_start)
+        self._segment_pts = pts
+        self._segment_frames += 1
+        self.frames_written += 1
+
+    def _finish(self):
+        try:
+            self._close_segment()
+            self._write_index({'done': True})
+            self._index.close()
+            self._index = None
+        except Exception as e:
+            Clock.schedule_once(partial(self._report_error, e))
+        Clock.schedule_once(self._finished)
+
+    def _finished(self, *largs):
+        self.activation = 'inactive'
+        if self.merger is not None and self.segments:
+            self.merger.add(self.index_filename, self.keep_segments)
+
+    @app_error
+    def _report_error(self, e, *largs):
+        raise e
+
+
+def _read_images(filename, pix_fmt):
+    '''A generator that decodes the video and yields ``(img, pts)`` for every
+    frame, where img is a :class:`ffpyplayer.pic.Image` in ``pix_fmt``.
+    '''
+    from ffpyplayer.player import MediaPlayer
+    player = MediaPlayer(filename, ff_opts={
+        'out_fmt': pix_fmt, 'an': True, 'sn': True, 'framedrop': False,
+        'sync': 'video'})
+    try:
+        last_pts = None
+        while True:
+            frame, val = player.get_frame(force_refresh=True)
+            if val == 'eof':
+                break
+            if frame is None:
+                sleep(.001)
+                continue
+
+            img, pts = frame
+            if last_pts is not None and pts <= last_pts:
+                continue
+            last_pts = pts
+            yield img, pts
+    finally:
+        player.close_player()
+
+
+def merge_segments(index_filename, keep_segments=False):
+    '''Joins the segments listed in the segment index into the final video
+    and returns its filename. Segments that were opened but not closed, e.g.
+    due to a crash, are included as far as they can be decoded.
+
+    The video is first written to a temporary file that is renamed once
+    done, so an interrupted merge can be repeated; the temporary file left by
+    an interrupted merge is removed first. Unless ``keep_segments``, the
+    segments and the index are removed once merged.
+    '''
+    with open(index_filename) as fh:
+        items = [json.loads(line) for line in fh if line.strip()]
+    if not items:
+        raise ValueError('"{}" is not a segment index'.format(index_filename))
+
+    info = items[0]
+    directory = dirname(index_filename)
+    filename = join(directory, info['filename'])
+    if exists(filename):
+        raise Exception('"{}" already exists'.format(filename))
+
+    segments = [(item['open'], item['start'])
+                for item in items[1:] if 'open' in item]
+
+    root, ext = splitext(filename)
+    temp = '{}_merging{}'.format(root, ext)
+    if exists(temp):
+        os.remove(temp)
+    ofmt = info['ofmt']
+    writer = _create_media_writer(
+        temp, info['size'], ofmt, ofmt, info['rate'], info['codec'])
+    first = segments[0][1] if segments else 0
+    try:
+        for segment, start in segments:
+            fname = join(directory, segment)
+            if not exists(fname):
+                continue
+            # the pts of each segment start at zero
+            for img, pts in _read_images(fname, ofmt):
+                writer.write_frame(img=img, pts=start - first + pts)
+    finally:
+        writer.close()
+
+    os.rename(temp, filename)
+    if not keep_segments:
+        for segment, _ in segments:
+            fname = join(directory, segment)
+            if exists(fname):
+                os.remove(fname)
+        os.remove(index_filename)
+    return filename
+
+
+class SegmentMerger(object):
+    '''Merges the segments of the trial videos with :func:`merge_segments`
+    in a background thread.
+
+    The segment indices added with :meth:`add` are only merged once
+    :meth:`start` is called, e.g. when the session ended, so the merging
+    doesn't compete with the recording. Those added afterwards are merged as
+    they are added.
+    '''
+
+    merged = []
+    '''The list of the filenames of the videos merged so far.
+    '''
+
+    _queue = []
+    '''The list of ``(index_filename, keep_segments)`` waiting to be merged.
+    '''
+
+    _cond = None
+    '''The :class:`~threading.Condition` guarding :attr:`_queue`.
+    '''
+
+    _thread = None
+    '''The merging thread, once started.
+    '''
+
+    _current = None
+    '''The segment index being merged, or None.
+    '''
+
+    def __init__(self):
+        super(SegmentMerger, self).__init__()
+        self.merged = []
+        self._queue = []
+        self._cond = Condition()
+
+    def add(self, index_filename, keep_segments=False):
+        '''Adds the segment index to be merged.
+        '''
+        with self._cond:
+            self._queue.append((index_filename, keep_segments))
+            self._cond.notify_all()
+
+    def start(self):
+        '''Starts merging.
+        '''
+        if self._thread is not None:
+            return
+        thread = self._thread = Thread(
+            target=self._run_worker, name='SegmentMerger')
+        thread.daemon = True
+        thread.start()
+        _mergers.append(self)
+
+    def get_pending(self):
+        '''Returns the list of the segment indices that were not merged yet,
+        including the one being merged.
+        '''
+        with self._cond:
+            pending = [index for index, _ in self._queue]
+            if self._current is not None:
+                pending.insert(0, self._current)
+            return pending
+
+    def join(self, timeout=None):
+        '''Waits until all the segment indices added were merged, or up to
+        ``timeout`` seconds if not None. Returns :meth:`get_pending`.
+        '''
+        end = None if timeout is None else clock() + timeout
+        with self._cond:
+            while self._queue or self._current is not None:
+                if end is None:
+                    self._cond.wait()
+                elif clock() >= end:
+                    break
+                else:
+                    self._cond.wait(end - clock())
+        return self.get_pending()
+
+    @app_error
+    def _report_error(self, e, *largs):
+        raise e
+
+    def _run_worker(self):
+        cond = self._cond
+        queue = self._queue
+        while True:
+            with cond:
+                while not queue:
+                    cond.wait()
+                index_filename, keep = queue.pop(0)
+                self._current = index_filename
+
+            try:
+                self.merged.append(merge_segments(index_filename, keep))
+            except Exception as e:
+                Clock.schedule_once(partial(self._report_error, e))
+            finally:
+                with cond:
+                    self._current = None
+                    cond.notify_all()
+
+
+def join_mergers(timeout=None):
+    '''Waits until the :class:`SegmentMerger` instances that were started
+    merged all their segment indices, for up to ``timeout`` seconds in total
+    if not None. Returns the list of the segment indices that were not merged
+    yet.
+    '''
+    end = None if timeout is None else clock() + timeout
+    pending = []
+    for merger in _mergers:
+        if end is None:
+            pending.extend(merger.join())
+        else:
+            pending.extend(merger.join(max(0., end - clock())))
+    return pending
+
+
+def main(args=None):
+    '''The command line entry point, which merges the segments of the given
+    segment indices. It returns a non-zero exit code if any merge failed.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Merges the segments of segmented trial videos.')
+    parser.add_argument('indices', nargs='+',
+                        help='The segment index files, *_segments.txt.')
+    parser.add_argument('--keep', action='store_true',
+                        help='Keep the segments once merged.')
+    opts = parser.parse_args(args)
+
+    failed = False
+    for index_filename in opts.indices:
+        try:
+            print('Merged {}'.format(
+                merge_segments(index_filename, opts.keep)))
+        except Exception as e:
+            failed = True
+            print('Failed merging {}: {}'.format(index_filename, e))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,286 @@
+'''Shared Frames
+================
+
+A ring of preallocated shared memory frame slots into which the frames
+acquired from the video device are copied once, so that consumers running in
+other processes, e.g. encoders or analysis, can read them without the frames
+having to be copied or pickled again.
+
+The ring is created from the Kivy process and passed to the consumer
+processes as an argument when they are created, e.g.::
+
+    ring = SharedFrameRing.from_frame(frame, 30)
+    process = Process(target=consumer, args=(ring, queue))
+    ...
+    # in the Kivy process, for every frame
+    n = ring.put(frame, pts)
+    queue.put(n)
+    ...
+    # in the consumer process
+    n = queue.get()
+    planes = ring.get_planes(n)
+    if planes is not None:
+        process_planes(planes)
+        if not ring.is_valid(n):
+            # the slot was overwritten while we were reading it
+            discard()
+'''
+
+import ctypes
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+__all__ = ('SharedFrameRing', 'frame_planes')
+
+
+def frame_planes(frame):
+    '''Returns a list of the buffers of the non-empty planes of the
+    :class:`ffpyplayer.pic.Image` ``frame``, without the line alignment
+    padding.
+
+    When supported by the installed ffpyplayer the buffers are memoryviews of
+    the frame's data, otherwise they are copies.
+    '''
+    if hasattr(frame, 'to_memoryview'):
+        planes = frame.to_memoryview(keep_align=False)
+    else:
+        planes = frame.to_bytearray()
+    return [p for p in planes if p is not None and len(p)]
+
+
+_has_cast = hasattr(memoryview, 'cast')
+'''Whether memoryviews can be cast, which they can't on Python 2, in which
+case the ring is accessed through ctypes.
+'''
+
+
+def _byte_view(obj):
+    view = memoryview(obj)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
+
+class SharedFrameRing(object):
+    '''A ring buffer of ``count`` frame slots in shared memory.
+
+    Each frame put in the ring gets a frame number, starting from zero, that
+    increments for every frame and the frame is copied into the slot
+    ``number % count``. Consumers refer to the frames by their number, and
+    can use :meth:`find` to look up the number of the frame with a given pts.
+
+    Every slot has a sequence number that is odd while the slot is being
+    written to, so a consumer can detect when a slot was overwritten by a newer
+    frame while it was being read (:meth:`is_valid`) without any locking
+    between the processes.
+
+    All the frames must have the same size and pixel format as the frame used
+    to create the ring. :meth:`fits` can be used to check whether a frame
+    matches the ring.
+    '''
+
+    count = 0
+    '''The number of slots in the ring.
+    '''
+
+    size = (0, 0)
+    '''The ``(width, height)`` of the frames in the ring.
+    '''
+
+    pix_fmt = ''
+    '''The pixel format of the frames in the ring.
+    '''
+
+    plane_sizes = []
+    '''The number of bytes of each of the frame planes.
+    '''
+
+    linesizes = []
+    '''The number of bytes in a line of each of the frame planes.
+    '''
+
+    slot_size = 0
+    '''The total number of bytes of a frame slot.
+    '''
+
+    _buffer = None
+    '''The shared array holding the frame data of all the slots.
+    '''
+
+    _pts = None
+    '''The shared array holding the pts of the frame in each slot.
+    '''
+
+    _seq = None
+    '''The shared array holding the sequence number of each slot.
+    '''
+
+    _head = None
+    '''A shared value holding the number of frames put in the ring.
+    '''
+
+    _view = None
+    '''A memoryview of :attr:`_buffer`, created lazily in each process.
+    '''
+
+    def __init__(self, count, size, pix_fmt, plane_sizes, linesizes):
+        super(SharedFrameRing, self).__init__()
+        self.count = count = int(count)
+        if count < 1:
+            raise ValueError('The ring must have at least one slot')
+
+        self.size = tuple(size)
+        self.pix_fmt = pix_fmt
+        self.plane_sizes = list(plane_sizes)
+        self.linesizes = list(linesizes)
+        self.slot_size = sum(plane_sizes)
+
+        self._buffer = RawArray(ctypes.c_ubyte, count * self.slot_size)
+        self._pts = RawArray(ctypes.c_double, count)
+        self._seq = RawArray(ctypes.c_longlong, count)
+        self._head = RawValue(ctypes.c_longlong, 0)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_view', None)
+        return state
+
+    @classmethod
+    def from_frame(cls, frame, count):
+        '''Creates a ring with ``count`` slots for frames with the size and
+        pixel format of the :class:`ffpyplayer.pic.Image` ``frame``.
+        '''
+        planes = frame_planes(frame)
+        linesizes = [s for s in frame.get_linesizes(keep_align=False) if s]
+        return cls(count, frame.get_size(), frame.get_pixel_format(),
+                   [len(p) for p in planes], linesizes[:len(planes)])
+
+    def fits(self, frame):
+        '''Returns whether the frame has the size and pixel format of the
+        frames in this ring.
+        '''
+        return (tuple(frame.get_size()) == self.size and
+                frame.get_pixel_format() == self.pix_fmt)
+
+    @property
+    def frame_count(self):
+        '''The number of frames put in the ring so far. The number of the
+        most recent frame is one less than this.
+        '''
+        return self._head.value
+
+    def _get_view(self):
+        view = self._view
+        if view is None:
+            view = self._view = _byte_view(self._buffer)
+        return view
+
+    def put(self, frame, pts):
+        '''Copies the :class:`ffpyplayer.pic.Image` ``frame`` with its ``pts``
+        into the next slot and returns the frame number.
+
+        Only a single process/thread may put frames in the ring.
+        '''
+        n = self._head.value
+        slot = n % self.count
+        seq = self._seq
+
+        seq[slot] = 2 * n + 1
+        offset = slot * self.slot_size
+        planes = zip(frame_planes(frame), self.plane_sizes)
+        if _has_cast:
+            view = self._get_view()
+            for plane, size in planes:
+                view[offset:offset + size] = _byte_view(plane)[:size]
+                offset += size
+        else:
+            base = ctypes.addressof(self._buffer)
+            for plane, size in planes:
+                ctypes.memmove(
+                    base + offset, memoryview(plane).tobytes()[:size], size)
+                offset += size
+        self._pts[slot] = pts
+        seq[slot] = 2 * n + 2
+        self._head.value = n + 1
+        return n
+
+    def is_valid(self, n):
+        '''Returns whether the frame number ``n`` is (still) in the ring and
+        fully written.
+        '''
+        return n >= 0 and self._seq[n % self.count] == 2 * n + 2
+
+    def get_pts(self, n):
+        '''Returns the pts of frame number ``n``, or None if the frame is not
+        in the ring anymore.
+        '''
+        pts = self._pts[n % self.count]
+        if not self.is_valid(n):
+            return None
+        return pts
+
+    def get_planes(self, n):
+        '''Returns a list of memoryviews (ctypes arrays on Python 2), one for
+        each plane, of the data of frame number ``n`` in the shared memory,
+        without copying it. Returns None if the frame is not in the ring
+        anymore.
+
+        Because the slot will be overwritten once the ring wraps around,
+        :meth:`is_valid` should be checked after the data was used to ensure
+        it was not overwritten while being read.
+        '''
+        if not self.is_valid(n):
+            return None
+
+        offset = (n % self.count) * self.slot_size
+        planes = []
+        if _has_cast:
+            view = self._get_view()
+            for size in self.plane_sizes:
+                planes.append(view[offset:offset + size])
+                offset += size
+        else:
+            for size in self.plane_sizes:
+                planes.append((ctypes.c_ubyte * size).from_buffer(
+                    self._buffer, offset))
+                offset += size
+        return planes
+
+    def get_image(self, n):
+        '''Returns a :class:`ffpyplayer.pic.Image` backed by the shared data
+        of frame number ``n``, or None if it's not in the ring anymore.
+        '''
+        from ffpyplayer.pic import Image
+        planes = self.get_planes(n)
+        if planes is None:
+            return None
+        return Image(plane_buffers=planes, pix_fmt=self.pix_fmt,
+                     size=self.size, linesize=self.linesizes)
+
+    def get_array(self, n, plane=0):
+        '''Returns a 2-dim ``(height, linesize)`` numpy array view of the
+        given plane of frame number ``n``, without copying, or None if it's
+        not in the ring anymore.
+        '''
+        import numpy as np
+        planes = self.get_planes(n)
+        if planes is None:
+            return None
+        linesize = self.linesizes[plane]
+        arr = np.frombuffer(planes[plane], dtype=np.uint8)
+        return arr.reshape((-1, linesize))
+
+    def find(self, pts):
+        '''Returns the number of the frame in the ring whose pts is closest to
+        ``pts``, or None if the ring is empty.
+        '''
+        head = self._head.value
+        best = None
+        best_diff = None
+        for n in range(max(0, head - self.count), head):
+            val = self.get_pts(n)
+            if val is None:
+                continue
+            diff = abs(val - pts)
+            if best is None or diff < best_diff:
+                best, best_diff = n, diff
+        return best
@@ -6,23 +6,35 @@ The stages of the experiment.
 '''
 
 from time import strftime
-from os.path import isfile
 from functools import partial
+from os.path import splitext
 
-from moa.utils import ObjectStateTracker
-
+from kivy.clock import Clock
+from kivy.logger import Logger
 from kivy.properties import (
     ObjectProperty, ListProperty, ConfigParserProperty, NumericProperty,
     BooleanProperty, StringProperty, OptionProperty, DictProperty)
 from kivy.uix.behaviors.knspace import knspace
 
-from cplcom.moa.device.ffplayer import FFPyPlayerDevice, FFPyWriterDevice
-from cplcom.moa.device.barst_server import Server
-from cplcom.moa.device.rtv import RTVChan
 from cplcom.moa.stages import ConfigStageBase
 from cplcom.moa.app import app_error
 
-from vet_cond.devices import DAQOutDevice, DAQOutDeviceSim
+from vet_cond.chambers import get_chamber, get_chamber_settings
+from vet_cond.devices import DAQOutDeviceSim
+from vet_cond.device_graph import DeviceGraph
+from vet_cond.frame_index import FrameIndexWriter, index_filename
+from vet_cond.metrics import Metrics, metrics, timed
+from vet_cond.monitor import LiveMonitor, live_monitor
+from vet_cond.display import PreviewController
+from vet_cond.online_analysis import OnlineAnalyzer
+from vet_cond.recording import (
+    EncoderPipeline, PrerecordBuffer, WriterPool, FrameReducer)
+from vet_cond.registry import ClassRegistry
+from vet_cond.schedule import compile_schedule
+from vet_cond.segments import SegmentMerger
+from vet_cond.shared_frames import SharedFrameRing
+from vet_cond.timing import FrameClock, FrameMonitor
+from vet_cond.trial_log import TrialLogWriter
 
 __all__ = ('RootStage', )
 
@@ -33,7 +45,10 @@ class RootStage(ConfigStageBase):
 
     __settings_attrs__ = (
         'prehab', 'prerecord', 'posthab', 'postrecord', 'trial_opts',
-        'video_name_pat', 'log_name_pat', 'record_video')
+        'video_name_pat', 'log_name_pat', 'record_video', 'frame_ring_slots',
+        'prerecord_buffer', 'prerecord_max_bytes', 'log_frames',
+        'log_checkpoint', 'video_index', 'schedule_seed', 'chambers',
+        'segment_video', 'record_profiles')
 
     server = ObjectProperty(None, allownone=True)
     '''The Barst server instance,
@@ -42,10 +57,10 @@ class RootStage(ConfigStageBase):
     '''
 
     mcdaq = ObjectProperty(None, allownone=True)
-    '''The Switch and Sense device, :class:`~vet_cond.devices.DAQOutDevice`
-    when using actual hardware, or a
-    :class:`~vet_cond.devices.DAQOutDeviceSim` when :attr:`simulate` the
-    hardware.
+    '''The Switch and Sense device,
+    :class:`~vet_cond.switch_and_sense.DAQOutDevice` when using actual
+    hardware, or a :class:`~vet_cond.devices.DAQOutDeviceSim` when
+    :attr:`simulate` the hardware.
     '''
 
     rtv = ObjectProperty(None, allownone=True)
@@ -55,15 +70,75 @@ class RootStage(ConfigStageBase):
     :attr:`simulate` the hardware.
     '''
 
+    frame_ring = ObjectProperty(None, allownone=True)
+    '''The :class:`~vet_cond.shared_frames.SharedFrameRing` into which each
+    frame from :attr:`rtv` is copied once, so that consumers in other
+    processes, i.e. the :attr:`analyzer` and the video profiles' encoders
+    (see :class:`~vet_cond.recording.EncoderPipeline`), can read it without
+    copying. It's created when the first frame
+    is received and recreated if the frame size or format changes, so
+    consumers should bind to it. None when :attr:`frame_ring_slots` is zero.
+    '''
+
+    frame_ring_slots = NumericProperty(30)
+    '''The number of frames that :attr:`frame_ring` holds. Consumers must
+    read a frame before that many newer frames are received. If zero, frames
+    are not copied to shared memory.
+    '''
+
+    prerecord_frames = None
+    '''The :class:`~vet_cond.recording.PrerecordBuffer` that holds the most
+    recent frames while not recording a trial, when :attr:`prerecord_buffer`.
+    '''
+
+    frame_number = -1
+    '''The number of the most recent frame in :attr:`frame_ring`.
+    '''
+
+    preview = None
+    '''The :class:`~vet_cond.display.PreviewController` that throttles and
+    downscales the frames shown in the GUI.
+    '''
+
+    reducer = None
+    '''The :class:`~vet_cond.recording.FrameReducer` that crops, converts,
+    and downscales the frames as they are received, before they are
+    recorded, analyzed, or shown.
+    '''
+
+    analyzer = ObjectProperty(None, allownone=True)
+    '''The :class:`~vet_cond.online_analysis.OnlineAnalyzer` that scores the
+    animal's freezing from the frames in :attr:`frame_ring` while the
+    experiment runs.
+    '''
+
+    _trial_bouts = {}
+    '''A dict mapping the trial numbers to their freezing bouts from
+    :attr:`analyzer`, until the trial's log row is written.
+    '''
+
+    encoder = None
+    '''The :class:`~vet_cond.recording.EncoderPipeline` that passes the frames
+    to :attr:`ffwriter` from a worker thread so that a slow encoder doesn't
+    delay the experiment.
+    '''
+
     ffwriter = None
-    '''The :attr:`ffwriters` instance used in the current trial.
+    '''The :class:`~cplcom.moa.device.ffplayer.FFPyWriterDevice` from
+    :attr:`writer_pool` used in the current trial.
     '''
 
-    ffwriters = []
-    '''A list of :class:`~cplcom.moa.device.ffplayer.FFPyWriterDevice`
-    instances equal to the number of trials, with each instance being a writer
-    for the corresponding trial. They are all created at once at the start of
-    running the subject.
+    frame_index = None
+    '''The :class:`~vet_cond.frame_index.FrameIndexWriter` of
+    :attr:`ffwriter`, if :attr:`video_index`.
+    '''
+
+    writer_pool = None
+    '''The :class:`~vet_cond.recording.WriterPool` that creates the writers of
+    the trials of the current subject. Only the writer of the first trial is
+    activated before the subject is started, the writer of each following
+    trial is activated during the preceding ITI, and each writer is closed
+    following its trial.
     '''
 
     video_name_pat = StringProperty(
@@ -72,12 +147,13 @@ class RootStage(ConfigStageBase):
     trial. It is generated as follows::
 
         name = strftime(video_name_pat.format(**{'trial': trial_number,
-                        'animal': animal_id}))
+                        'animal': animal_id, 'chamber': chamber}))
 
     Which basically means that all instances of ``{trial}`` is replaced by
-    the current trial number and ``{animal}`` is replaced by the animal
-    name given in the GUI. Then, it's is passed to `strftime` that formats
-    any time parameters to get the name used for that trial/animal.
+    the current trial number, ``{animal}`` is replaced by the animal
+    name given in the GUI, and ``{chamber}`` by the :attr:`chamber`. Then,
+    it's is passed to `strftime` that formats any time parameters to get the
+    name used for that trial/animal.
 
     If the filename already exists an error will be raised.
     '''
@@ -86,14 +162,31 @@ class RootStage(ConfigStageBase):
     '''The pattern that will be used to generate the log filenames for each
     trial. It is generated as follows::
 
-        strftime(log_name_pat.format(**{'animal': animal_id}))
+        strftime(log_name_pat.format(**{'animal': animal_id,
+                                        'chamber': chamber}))
 
     Which basically means that all instances of ``{animal}`` is replaced by the
-    animal name given in the GUI. Then, it's is passed to `strftime` that
-    formats any time parameters to get the log name used for that animal.
+    animal name given in the GUI and ``{chamber}`` by the :attr:`chamber`.
+    Then, it's is passed to `strftime` that formats any time parameters to
+    get the log name used for that animal.
 
     If the filename matches an existing file, the new data will be appended to
     that file.
+
+    In addition to this CSV file, a ``_events`` CSV file with the stamps of
+    the trial events and a binary ``.vlog`` file with the same base name are
+    written, see :mod:`~vet_cond.trial_log`.
+    '''
+
+    log_frames = BooleanProperty(True)
+    '''Whether the binary log also records the pts, host time, and trial of
+    every frame received.
+    '''
+
+    log_checkpoint = NumericProperty(1.)
+    '''How often, in seconds, the log rows are written and flushed to disk in
+    the background. At most this many seconds of the log are lost if the app
+    crashes.
     '''
 
     prehab = NumericProperty(60)
@@ -108,7 +201,26 @@ class RootStage(ConfigStageBase):
 
     prerecord = NumericProperty(5)
     '''The amount of time before each trial when video should be started
-    being recorded. It is in addition to any ITI.
+    being recorded. When :attr:`prerecord_buffer` is False, it is in addition
+    to any ITI. Otherwise, it's the last part of the ITI.
+    '''
+
+    prerecord_buffer = BooleanProperty(True)
+    '''Whether the :attr:`prerecord` video is taken from a
+    :class:`~vet_cond.recording.PrerecordBuffer` holding the most recent
+    frames, rather than from waiting :attr:`prerecord` seconds before each
+    trial.
+
+    When True, the frames of the last :attr:`prerecord` seconds before the
+    trial are retroactively written to the trial's video when the trial
+    starts, so the trial starts immediately following the ITI.
+    '''
+
+    prerecord_max_bytes = NumericProperty(256 * 1024 * 1024)
+    '''The maximum number of bytes of frame data that the
+    :attr:`prerecord_buffer` may hold. If :attr:`prerecord` seconds of video
+    takes more memory, less prerecord video will be available. If zero, it's
+    only bounded by :attr:`prerecord`.
     '''
 
     postrecord = NumericProperty(5)
@@ -120,6 +232,35 @@ class RootStage(ConfigStageBase):
     '''Whether video should be recorded for this experiment.
     '''
 
+    segment_video = BooleanProperty(False)
+    '''Whether to record each trial's video as short segments with a
+    :class:`~vet_cond.segments.SegmentedWriter`, so that at most a segment is
+    lost if the app crashes, rather than with a single
+    :class:`~cplcom.moa.device.ffplayer.FFPyWriterDevice`.
+
+    The segments are merged into the trial videos by :attr:`segment_merger`
+    once the session ends. The byte offsets in the frame index of a segmented
+    video are -1, because the video only exists once merged.
+    '''
+
+    record_profiles = BooleanProperty(False)
+    '''Whether to record each trial's video with a
+    :class:`~vet_cond.multi_writer.MultiWriter`, to a video for each of the
+    encoder profiles in the ``video_profiles`` settings, each encoded in its
+    own process. When True, :attr:`segment_video` is ignored.
+    '''
+
+    segment_merger = None
+    '''The :class:`~vet_cond.segments.SegmentMerger` that merges the segments
+    of the trial videos when :attr:`segment_video`.
+    '''
+
+    video_index = BooleanProperty(True)
+    '''Whether to write a frame index next to each trial video, mapping each
+    frame of the video to its source pts, host time, and byte offset, along
+    with the trial's event times. See :mod:`~vet_cond.frame_index`.
+    '''
+
     trial_opts = ObjectProperty({
         'control': {'repeat': 3, 'shock': (0, 0), 'tone': (0, 0),
                     'duration': 15, 'iti': (45, 60)},
@@ -147,11 +288,40 @@ class RootStage(ConfigStageBase):
             after that delay. A duration of zero will disable the tone.
         `iti`: 2-tuple of floats
             The minimum and maximum duration of the ITI. A value will be chosen
-            uniformly at random from that range.
+            uniformly at random from that range for each trial, when the
+            animal's :attr:`schedule` is compiled.
         `duration`: float
             The duration of the trial.
     '''
 
+    chamber = StringProperty(get_chamber())
+    '''The name of the chamber run by this app, when several chambers are run
+    from the same computer by :mod:`~vet_cond.chambers`, otherwise ``''``.
+    '''
+
+    chambers = ObjectProperty({})
+    '''A dict mapping the names of the chambers to the settings that
+    override the rest of the settings for each chamber, when
+    several chambers are run from the same computer. See
+    :mod:`~vet_cond.chambers`.
+    '''
+
+    app_settings = None
+    '''The app's settings, updated with the settings of :attr:`chamber`.
+    '''
+
+    schedule_seed = NumericProperty(-1)
+    '''The seed from which the ITIs of the animals' :attr:`schedule` are
+    drawn. If negative, a new random seed is used for each animal. Either
+    way, the seed is saved with the schedule.
+    '''
+
+    schedule = None
+    '''The :class:`~vet_cond.schedule.Schedule` of the current animal. It's
+    compiled before the animal is started and saved to
+    ``<log>_schedule.json`` next to the log.
+    '''
+
     def on_trial_opts(self, *largs):
         for _, opts in self.trial_opts.items():
             opts['repeat'] = max(1, int(opts['repeat']))
@@ -203,25 +373,95 @@ class RootStage(ConfigStageBase):
     '''The ITI range from :attr:`trial_opts` for this animal.
     '''
 
-    tracker = None
-    '''The :class:`~moa.utils.ObjectStateTracker` instance used to
-    process the device activation and deactivation during startup and
-    shutdown.
+    iti = NumericProperty(0)
+    '''The duration of the ITI of the current trial from :attr:`schedule`.
+    '''
+
+    device_graph = None
+    '''The :class:`~vet_cond.device_graph.DeviceGraph` instance used to
+    activate and deactivate the devices in parallel during startup and
+    shutdown. Its ``activation_times`` and ``deactivation_times`` list how
+    long each device took.
     '''
 
     frame_ts = 0
     '''The video time at the most recent frame.
     '''
 
+    frame_clock = None
+    '''The :class:`~vet_cond.timing.FrameClock` that tracks the received frames
+    and is used to stamp the trial events.
+    '''
+
     trial_stats = DictProperty({
         'shock_ts': -1, 'shock_te': -1, 'tone_ts': -1, 'tone_te': -1,
-        'trial_ts': -1, 'trial_end': -1})
+        'trial_ts': -1, 'trial_te': -1, 'freezing': -1,
+        'freezing_fraction': -1, 'tone_freezing': -1})
     '''Trials stats of the tone, shock, and trial start and end times in video
     time use for the log.
+
+    The times are interpolated from the host time when the event occurred
+    using :attr:`frame_clock`, so they are more accurate than the pts of the
+    frame received last.
+
+    `freezing` and `freezing_fraction` are the time and fraction of the trial
+    the animal was freezing and `tone_freezing` is the fraction of the tone
+    it was freezing, as scored by :attr:`analyzer`. They are only computed
+    for the trial's log row, so they are always -1 here.
+    '''
+
+    frame_monitor = None
+    '''The :class:`~vet_cond.timing.FrameMonitor` that checks the received
+    frames for dropped frames and jitter.
+    '''
+
+    frame_rate = NumericProperty(0)
+    '''The measured frame rate of the video device. It's updated
+    periodically from :attr:`frame_monitor`.
+    '''
+
+    frames_dropped = NumericProperty(0)
+    '''The number of frames dropped by the video device (or the computer
+    reading it) in this session. It's updated periodically from
+    :attr:`frame_monitor`.
+    '''
+
+    encoder_frames_dropped = NumericProperty(0)
+    '''The number of frames dropped by :attr:`encoder` in this session because
+    its queue was full. It's updated periodically.
     '''
 
-    _fd = None
-    '''The log file handle.
+    trial_frame_stats = {}
+    '''A dict of the frame statistics of the last recorded trial that is
+    written to the log. The keys are those of
+    :meth:`~vet_cond.timing.FrameMonitor.trial_summary`, and
+    ``'encoder_dropped'``, the number of frames dropped by the
+    :attr:`encoder` during the trial.
+    '''
+
+    _encoder_dropped_start = 0
+    '''The encoder's dropped frame count at the start of the trial.
+    '''
+
+    _frame_stats_event = None
+    '''The clock event that periodically updates the frame statistics
+    properties.
+    '''
+
+    trial_stamps = {}
+    '''A dict mapping the :attr:`trial_stats` keys of the events that occurred
+    in the current trial to their stamps as returned by
+    :meth:`~vet_cond.timing.FrameClock.stamp`.
+    '''
+
+    log_writer = None
+    '''The :class:`~vet_cond.trial_log.TrialLogWriter` writing the log of the
+    current animal.
+    '''
+
+    _log_trial = -1
+    '''The number of the trial being recorded, or -1 between trials. It's
+    logged with each frame.
     '''
 
     _log_filename = ''
@@ -234,10 +474,26 @@ class RootStage(ConfigStageBase):
 
     @classmethod
     def get_config_classes(cls):
-        d = {
-            'barst_server': Server, 'switch_and_sense_8-8': DAQOutDevice,
-            'rtv': RTVChan, 'rtv_simulate': FFPyPlayerDevice,
-            'experiment': RootStage, 'video_record': FFPyWriterDevice}
+        '''Returns a :class:`~vet_cond.registry.ClassRegistry` of the classes
+        configured by each section of the settings. The device classes that
+        depend on the hardware or ffpyplayer are only imported when looked
+        up, e.g. by :meth:`init_devices` or :meth:`_create_writer`, not when
+        the config is read or saved.
+        '''
+        d = ClassRegistry({
+            'barst_server': 'cplcom.moa.device.barst_server:Server',
+            'switch_and_sense_8-8':
+                'vet_cond.switch_and_sense:DAQOutDevice',
+            'rtv': 'cplcom.moa.device.rtv:RTVChan',
+            'rtv_simulate': 'cplcom.moa.device.ffplayer:FFPyPlayerDevice',
+            'experiment': RootStage,
+            'video_record': 'cplcom.moa.device.ffplayer:FFPyWriterDevice',
+            'video_segments': 'vet_cond.segments:SegmentedWriter',
+            'video_profiles': 'vet_cond.multi_writer:MultiWriter',
+            'encoder_queue': EncoderPipeline, 'preview': PreviewController,
+            'online_analysis': OnlineAnalyzer,
+            'frame_reduction': FrameReducer, 'metrics': Metrics,
+            'monitor': LiveMonitor})
         d.update(ConfigStageBase.get_config_classes())
         return d
 
@@ -245,22 +501,32 @@ class RootStage(ConfigStageBase):
         super(RootStage, self).clear(recurse=recurse, loop=loop, **kwargs)
         self._shutting_down_devs = False
         if not loop:
-            self.tracker = self.server = self.mcdaq = self.rtv = None
-            self.ffwriters = []
-            self.ffwriter = None
+            self.device_graph = self.server = self.mcdaq = self.rtv = None
+            self.encoder = self.frame_ring = self.prerecord_frames = None
+            self.preview = self.analyzer = self.reducer = None
+            self.writer_pool = self.ffwriter = self.frame_index = None
+            self.segment_merger = None
 
     @app_error
     def init_devices(self):
         '''Called to start the devices during the init stage.
         '''
-        settings = knspace.app.app_settings
+        settings = self.app_settings = get_chamber_settings(
+            knspace.app.app_settings, self.chamber)
         for k, v in settings['experiment'].items():
             setattr(self, k, v)
+        for k, v in settings['metrics'].items():
+            setattr(metrics, k, v)
+        metrics.watch_delays(self)
+        for k, v in settings['monitor'].items():
+            setattr(live_monitor, k, v)
+        live_monitor.start(self)
 
         time_line = knspace.time_line
         time_line.clear_slices()
         elems = (
-            (0, 'Init'), (self.prehab, 'Prehab'), (self.prerecord, 'Pre'),
+            (0, 'Init'), (self.prehab, 'Prehab'),
+            (0 if self.prerecord_buffer else self.prerecord, 'Pre'),
             (self.trial_duration, 'Trial'), (self.postrecord, 'Post'),
             (max((d['iti'][1] for d in self.trial_opts.values())), 'ITI'),
             (self.posthab, 'Posthab'))
@@ -268,34 +534,48 @@ class RootStage(ConfigStageBase):
             time_line.add_slice(name=name, duration=t)
         time_line.smear_slices()
 
+        self.frame_clock = FrameClock()
+        self.frame_monitor = FrameMonitor()
+        self.frame_rate = self.frames_dropped = 0
+        self.encoder_frames_dropped = 0
+        self._frame_stats_event = Clock.schedule_interval(
+            self._update_frame_stats, .5)
         sim = self.simulate = knspace.gui_simulate.state == 'down'
-        tracker = self.tracker = ObjectStateTracker()
+        graph = self.device_graph = DeviceGraph(self)
         attr_map = {
             'shocker': knspace.gui_shocker, 'ir_leds': knspace.gui_ir_leds,
             'tone': knspace.gui_tone}
 
+        classes = self.get_config_classes()
         if sim:
             daq = self.mcdaq = DAQOutDeviceSim(
                 knsname='mcdaq', attr_map=attr_map)
-            rtv = self.rtv = FFPyPlayerDevice(
+            rtv = self.rtv = classes['rtv_simulate'](
                 knsname='player', **settings['rtv_simulate'])
-            devs = [daq, rtv]
+            graph.add_device('mcdaq', daq)
+            graph.add_device('rtv', rtv)
         else:
-            server = self.server = Server(
+            server = self.server = classes['barst_server'](
                 knsname='barst_server', **settings['barst_server'])
-            daq = self.mcdaq = DAQOutDevice(
+            daq = self.mcdaq = classes['switch_and_sense_8-8'](
                 knsname='mcdaq', attr_map=attr_map, server=server,
                 **settings['switch_and_sense_8-8'])
-            rtv = self.rtv = RTVChan(knsname='player', server=server,
-                                     **settings['rtv'])
-            devs = [server, daq, rtv]
-
+            rtv = self.rtv = classes['rtv'](
+                knsname='player', server=server, **settings['rtv'])
+            graph.add_device('server', server)
+            graph.add_device('mcdaq', daq, ['server'])
+            graph.add_device('rtv', rtv, ['server'])
+
+        self.reducer = FrameReducer(**settings['frame_reduction'])
+        encoder = self.encoder = EncoderPipeline(**settings['encoder_queue'])
+        encoder.start()
+        preview = self.preview = PreviewController(**settings['preview'])
+        preview.start()
+        self.analyzer = OnlineAnalyzer(**settings['online_analysis'])
+        self._trial_bouts = {}
+        self.segment_merger = SegmentMerger() if self.segment_video else None
         rtv.fbind('on_data_update', self.video_callback)
-
-        callbacks = [partial(d.activate, self) for d in devs[1:]]
-        callbacks.append(knspace.exp_dev_init.ask_step_stage)
-        tracker.add_func_links(devs, callbacks, 'activation', 'active')
-        devs[0].activate(self)
+        graph.activate(knspace.exp_dev_init.ask_step_stage)
 
     def step_stage(self, source=None, **kwargs):
         if not self.started or (source is not None and source != self) or \
@@ -303,26 +583,65 @@ class RootStage(ConfigStageBase):
             return super(RootStage, self).step_stage(source=source, **kwargs)
 
         self._shutting_down_devs = True
-        self.ffwriter = None
-        if self._fd:
-            self._fd.close()
-            self._fd = None
+        self.ffwriter = self.frame_index = None
+        if self._frame_stats_event is not None:
+            self._frame_stats_event.cancel()
+            self._frame_stats_event = None
+        if self.frame_clock is not None:
+            # write any log rows still waiting for a frame
+            self.frame_clock.flush()
+        self._close_log()
+        self._log_filename = ''
+        metrics.unwatch_delays()
         if self.rtv:
             self.rtv.funbind('on_data_update', self.video_callback)
-
-        devs = [self.rtv, self.mcdaq, self.server] + self.ffwriters
-        devs = [d for d in devs if d is not None]
-        self.ffwriters = []
-
-        if not devs:
+        if self.preview is not None:
+            self.preview.stop()
+        if self.analyzer is not None:
+            self.analyzer.stop()
+        if self.segment_merger is not None:
+            # the videos closed from now on are merged right away
+            self.segment_merger.start()
+
+        encoder = self.encoder
+        self.encoder = None
+        if encoder is not None:
+            # let the queued frames reach the writers before closing them
+            encoder.stop(partial(self._stop_devices, source, kwargs))
+            return False
+
+        if self._stop_devices(source, kwargs, step=False):
             return super(RootStage, self).step_stage(source=source, **kwargs)
+        return False
 
-        tracker = self.tracker = ObjectStateTracker()
-        callbacks = [partial(d.deactivate, self, clear=True) for d in devs[1:]]
-        callbacks.append(partial(self.ask_step_stage, source=source, **kwargs))
-        tracker.add_func_links(devs, callbacks, 'activation', 'inactive',
-                               timeout=5.)
-        devs[0].deactivate(self, clear=True)
+    def _stop_devices(self, source, kwargs, step=True):
+        '''Deactivates all the devices and then steps the stage. Returns True
+        if there were no devices to deactivate, in which case the stage is
+        only stepped when ``step`` is True.
+        '''
+        graph = self.device_graph = DeviceGraph(self)
+        deps = []
+        # a chamber's server is shared and closed by the chambers launcher
+        if self.server is not None and not self.chamber:
+            graph.add_device('server', self.server)
+            deps = ['server']
+        if self.mcdaq is not None:
+            graph.add_device('mcdaq', self.mcdaq, deps)
+        if self.rtv is not None:
+            graph.add_device('rtv', self.rtv, deps)
+        if self.writer_pool is not None:
+            for i, w in enumerate(self.writer_pool.release_all()):
+                graph.add_device('writer{}'.format(i), w)
+        self.writer_pool = None
+
+        if not graph.devices:
+            if step:
+                self.ask_step_stage(source=source, **kwargs)
+            return True
+
+        graph.deactivate(
+            partial(self.ask_step_stage, source=source, **kwargs),
+            clear=True, timeout=5.)
         return False
 
     @app_error
@@ -334,61 +653,154 @@ class RootStage(ConfigStageBase):
         trial_type = self.trial_type = knspace.gui_trial_type.text
         opts = self.trial_opts[trial_type]
 
-        fname = strftime(self.log_name_pat.format(**{'animal': animal_id}))
+        fname = strftime(self.log_name_pat.format(**{
+            'animal': animal_id, 'chamber': self.chamber}))
         filename = self._log_filename
 
         if filename != fname:
-            fd = self._fd
-            if fd is not None:
-                fd.close()
-                self._fd = None
+            self._close_log()
+            self._log_filename = fname
 
             if fname:
-                ex = isfile(fname)
-                fd = self._fd = open(fname, 'a')
-                if not ex:
-                    fd.write('Date,ID,Type,Trial,TrialStart,TrialEnd,'
-                             'ToneStart,ToneEnd,ShockStart,ShockEnd\n')
+                writer = self.log_writer = TrialLogWriter(
+                    fname, log_frames=self.log_frames,
+                    checkpoint_interval=self.log_checkpoint)
+                writer.open()
+                metrics.start()
 
-        self.trial_repeat = repeat = opts['repeat']
+        self.trial_repeat = opts['repeat']
         self.trial_duration = opts['duration']
         self.shock_delay, self.shock_duration = opts['shock']
         self.tone_delay, self.tone_duration = opts['tone']
         self.iti_range = opts['iti']
 
+        seed = self.schedule_seed
+        schedule = self.schedule = compile_schedule(
+            trial_type, opts, seed=None if seed < 0 else seed,
+            prehab=self.prehab, posthab=self.posthab,
+            prerecord=self.prerecord, postrecord=self.postrecord,
+            prerecord_buffer=self.prerecord_buffer)
+        if schedule.trials:
+            self.iti = schedule.trials[0]['iti']
+        if self.log_writer is not None:
+            schedule.save(
+                '{}_schedule.json'.format(
+                    splitext(self.log_writer.filename)[0]),
+                animal=animal_id, chamber=self.chamber,
+                date=strftime('%m/%d/%Y %I:%M:%S %p'))
+        self._update_time_line()
+
+        self.prerecord_frames = None
+        if self.record_video and self.prerecord_buffer:
+            self.prerecord_frames = PrerecordBuffer(
+                self.prerecord, max_bytes=self.prerecord_max_bytes)
+
+        if self.writer_pool is not None:
+            for w in self.writer_pool.release_all():
+                w.deactivate(self)
+            self.writer_pool = None
+
         if self.record_video:
-            ofmt = knspace.app.app_settings['video_record'].get('ofmt', '')
-            rate = self.rtv.rate
-            size = self.rtv.size
+            ofmt = self.app_settings['video_record'].get('ofmt', '')
             ifmt = getattr(
                 self.rtv,
                 'display_img_fmt' if self.simulate else 'ff_output_img_fmt')
-
-            w = []
-            for i in range(repeat):
-                fname = strftime(self.video_name_pat.format(**{
-                    'trial': i, 'animal': animal_id}))
-                writer = FFPyWriterDevice(
-                    filename=fname, rate=rate, size=size, ifmt=ifmt, ofmt=ofmt)
-                w.append(writer)
-            self.ffwriters = w
-
-            tracker = self.tracker = ObjectStateTracker()
-            callbacks = [partial(d.activate, self) for d in w[1:]]
-            callbacks.append(knspace.exp_animal_init.ask_step_stage)
-            tracker.add_func_links(w, callbacks, 'activation', 'active')
-            w[0].activate(self)
+            size, ifmt = self.reducer.output_format(self.rtv.size, ifmt)
+            pool = self.writer_pool = WriterPool(self, partial(
+                self._create_writer, animal_id, self.rtv.rate, size, ifmt,
+                ofmt))
+            pool.prepare(0, knspace.exp_animal_init.ask_step_stage)
         else:
             knspace.exp_animal_init.ask_step_stage()
 
+    def _update_time_line(self):
+        '''Sets the durations of the time line slices from :attr:`schedule`.
+        '''
+        schedule = self.schedule
+        trials = schedule.trials
+        time_line = knspace.time_line
+        for name, t in (
+                ('Prehab', schedule.prehab),
+                ('Pre',
+                 0 if schedule.prerecord_buffer else schedule.prerecord),
+                ('Trial', schedule.trial_length),
+                ('Post', schedule.postrecord),
+                ('ITI', trials[0]['iti'] if trials else 0),
+                ('Posthab', schedule.posthab)):
+            time_line.update_slice_attrs(name, duration=t)
+
+    def _close_log(self):
+        '''Closes the log of the current animal, if open, and writes the
+        :attr:`~vet_cond.metrics.metrics` collected since it was opened to
+        ``<log>_metrics.json`` next to it.
+        '''
+        if self.log_writer is None:
+            return
+        root = splitext(self.log_writer.filename)[0]
+        self.log_writer.close()
+        self.log_writer = None
+
+        metrics.stop('{}_metrics.json'.format(root),
+                     '{}_profile.txt'.format(root))
+
+    def _create_writer(self, animal_id, rate, size, ifmt, ofmt, trial):
+        '''Creates the writer of the trial for :attr:`writer_pool`.
+        '''
+        fname = strftime(self.video_name_pat.format(**{
+            'trial': trial, 'animal': animal_id, 'chamber': self.chamber}))
+        if self.record_profiles:
+            return self.get_config_classes()['video_profiles'](
+                filename=fname, rate=rate, size=size, ifmt=ifmt, ofmt=ofmt,
+                source_ring=self.frame_ring,
+                **self.app_settings['video_profiles'])
+        if self.segment_video:
+            return self.get_config_classes()['video_segments'](
+                filename=fname, rate=rate, size=size, ifmt=ifmt, ofmt=ofmt,
+                merger=self.segment_merger,
+                **self.app_settings['video_segments'])
+        return self.get_config_classes()['video_record'](
+            filename=fname, rate=rate, size=size, ifmt=ifmt, ofmt=ofmt)
+
+    @timed('video_callback')
     def video_callback(self, *largs):
         '''Called for each frame read from the viceo device.
         '''
         pts, frame = self.rtv.last_img
         self.frame_ts = pts
+        frame = self.reducer.reduce(frame)
+        clock = self.frame_clock
+        index = clock.add_frame(pts)
+        missing = self.frame_monitor.add_frame(pts, self.rtv.rate)
+        if missing:
+            metrics.count('frames_missing', missing)
+        if self.log_writer is not None:
+            self.log_writer.add_frame(
+                index, pts, clock.last_host, self._log_trial, missing)
+
+        if self.frame_ring_slots > 0:
+            ring = self.frame_ring
+            if ring is None or not ring.fits(frame):
+                ring = self.frame_ring = SharedFrameRing.from_frame(
+                    frame, self.frame_ring_slots)
+            self.frame_number = ring.put(frame, pts)
+            self.analyzer.add_frame(ring, self.frame_number)
+
         if self.ffwriter:
-            self.ffwriter.add_frame(frame, pts)
-        knspace.display.update_img(frame)
+            self.encoder.add_frame(
+                self.ffwriter, frame, pts, clock.last_host, self.frame_ring,
+                self.frame_number)
+        elif self.prerecord_frames is not None:
+            self.prerecord_frames.add_frame(frame, pts, clock.last_host)
+        self.preview.add_frame(frame)
+        live_monitor.add_frame(frame)
+
+    def _update_frame_stats(self, *largs):
+        monitor = self.frame_monitor
+        if monitor is not None:
+            self.frame_rate = monitor.rate
+            self.frames_dropped = monitor.dropped
+        if self.encoder is not None:
+            self.encoder_frames_dropped = self.encoder.frames_dropped
 
     def record_start(self):
         '''Called at the start of each recording to init the recorders.
@@ -396,36 +808,135 @@ class RootStage(ConfigStageBase):
         stats = self.trial_stats
         for k in stats:
             stats[k] = -1
+        self.trial_stamps = {}
+        self.frame_monitor.start_trial()
+        self._encoder_dropped_start = self.encoder.frames_dropped
+        self._log_trial = knspace.exp_trial_root.count
+        self.iti = self.schedule.trials[self._log_trial]['iti']
 
-        if not self.ffwriters:
+        if self.writer_pool is None:
             return
-        self.ffwriter = self.ffwriters[knspace.exp_trial_root.count]
+        count = knspace.exp_trial_root.count
+        w = self.ffwriter = self.writer_pool.get(count)
+        if self.video_index:
+            index = self.frame_index = FrameIndexWriter(
+                index_filename(w.filename), w.filename, trial=count)
+            self.encoder.attach_index(w, index)
+        if self.prerecord_frames is not None:
+            self.encoder.add_frames(w, self.prerecord_frames.pop_frames())
 
     def update_time(self, key):
         '''Updates trial stats when an event occurs.
+
+        The event is initially given the time of the last frame, and it's
+        updated with the interpolated time once the next frame is received.
         '''
         self.trial_stats[key] = self.frame_ts
+        self.trial_stamps[key] = self.frame_clock.stamp(
+            partial(self._update_stamp_time, key))
+
+        if key == 'trial_ts':
+            self.analyzer.start_trial()
+        elif key == 'trial_te':
+            self.analyzer.end_trial(
+                knspace.exp_trial_root.count, self._set_trial_bouts)
+
+    def _set_trial_bouts(self, trial, bouts):
+        self._trial_bouts[trial] = bouts
+
+    def _update_freezing_stats(self, stats, bouts):
+        '''Sets the freezing stats in ``stats``, a copy of the trial's
+        :attr:`trial_stats` with the final event times, from the trial's
+        freezing ``bouts``.
+        '''
+        from vet_cond.analysis import epoch_freezing
+        if bouts is None or stats['trial_ts'] == -1 or \
+                stats['trial_te'] == -1:
+            return
+
+        trial = epoch_freezing(bouts, stats['trial_ts'], stats['trial_te'])
+        stats['freezing'] = trial['freezing']
+        stats['freezing_fraction'] = trial['fraction']
+        if stats['tone_ts'] != -1 and stats['tone_te'] > stats['tone_ts']:
+            stats['tone_freezing'] = epoch_freezing(
+                bouts, stats['tone_ts'], stats['tone_te'])['fraction']
+
+    def _update_stamp_time(self, key, stamp):
+        if self.trial_stamps.get(key) is stamp and stamp['pts'] != -1:
+            self.trial_stats[key] = stamp['pts']
 
     def record_stop(self):
         '''Called at the end of each recording to stop the recorders.
         '''
+        stats = self.trial_frame_stats = self.frame_monitor.trial_summary()
+        stats['encoder_dropped'] = \
+            self.encoder.frames_dropped - self._encoder_dropped_start
+        self._log_trial = -1
+
         w = self.ffwriter
-        if w:
-            self.ffwriter = self.ffwriters[knspace.exp_trial_root.count] = None
-            w.deactivate(self)
+        if not w:
+            return
+
+        count = knspace.exp_trial_root.count
+        index = self.frame_index
+        self.ffwriter = self.frame_index = None
+        self.writer_pool.release(count)
+        # the stamp of the trial end may wait for the next frame
+        self.frame_clock.call_after_frame(
+            partial(self._close_writer, w, index))
+        # warm up the next trial's writer during the ITI
+        if count + 1 < self.trial_repeat:
+            self.writer_pool.prepare(count + 1)
+
+    def _close_writer(self, writer, index):
+        if index is not None:
+            index.set_events(self.trial_stats)
+            events = index.events
+            if events['trial_ts'] != -1 and events['trial_te'] == -1:
+                Logger.warning(
+                    'VetCond: The frame index "{}" was closed without the '
+                    'trial end time'.format(index.filename))
+        self.encoder.close_writer(writer, partial(writer.deactivate, self))
 
     @app_error
     def write_log(self):
         '''Called after each trial to dump the trial stats to the log.
         '''
-        fd = self._fd
-        if fd is None:
+        if self.log_writer is None:
+            return
+
+        # the stamps of the last events may wait for the next frame, and the
+        # freezing bouts for the analyzer, by which time the next trial may
+        # have reset the stats, so use a copy
+        self.frame_clock.call_after_frame(partial(
+            self.analyzer.call_when_done, partial(
+                self._write_log_row, strftime('%m/%d/%Y %I:%M:%S %p'),
+                self.animal_id, self.trial_type, knspace.exp_trial_root.count,
+                dict(self.trial_stats), self.trial_stamps,
+                self.trial_frame_stats)))
+
+    @app_error
+    def _write_log_row(self, date, animal_id, trial_type, count, stats,
+                       stamps, frame_stats):
+        writer = self.log_writer
+        if writer is None:
             return
 
-        val = ('{},{},{},{},{trial_ts},{trial_te},{tone_ts},{tone_te},'
-               '{shock_ts},{shock_te}\n'.format(
-                strftime('%m/%d/%Y %I:%M:%S %p'), self.animal_id,
-                self.trial_type, knspace.exp_trial_root.count,
-                **self.trial_stats))
-        fd.write(val)
-        fd.flush()
+        for key, stamp in stamps.items():
+            if stamp['pts'] != -1:
+                stats[key] = stamp['pts']
+        self._update_freezing_stats(stats, self._trial_bouts.pop(count, None))
+        row = dict(stats)
+        row.update(frame_stats)
+        row.update({'date': date, 'animal': animal_id, 'type': trial_type,
+                    'trial': count})
+        writer.add_trial(row)
+
+        for key in ('trial_ts', 'tone_ts', 'tone_te', 'shock_ts', 'shock_te',
+                    'trial_te'):
+            if key not in stamps:
+                continue
+            row = dict(stamps[key])
+            row.update({'date': date, 'animal': animal_id,
+                        'type': trial_type, 'trial': count, 'event': key})
+            writer.add_event(row)
@@ -0,0 +1,43 @@
+'''Switch & Sense
+==================
+
+The device of the Barst Switch & Sense 8/8 hardware. It's in its own module,
+rather than in :mod:`~vet_cond.devices`, so that the hardware libraries are
+only imported when the hardware is used, and not e.g. when simulating it.
+'''
+
+from kivy.properties import NumericProperty
+
+from cplcom.moa.device.mcdaq import MCDAQDevice
+
+from vet_cond.devices import DAQOutDeviceBase
+
+__all__ = ('DAQOutDevice', )
+
+
+class DAQOutDevice(DAQOutDeviceBase, MCDAQDevice):
+    '''Device used when using the Barst Switch & Sense 8/8 output device.
+    '''
+    __settings_attrs__ = (
+        'shocker_pin', 'ir_leds_pin', 'tone_pin', 'coalesce_writes')
+
+    def __init__(self, **kwargs):
+        super(DAQOutDevice, self).__init__(direction='o', **kwargs)
+        self.dev_map = {
+            'shocker': self.shocker_pin, 'ir_leds': self.ir_leds_pin,
+            'tone': self.tone_pin}
+
+    shocker_pin = NumericProperty(4)
+    '''The pin number on the Switch and Sense 8/8 that is connected to and
+    controls the shocker.
+    '''
+
+    ir_leds_pin = NumericProperty(6)
+    '''The pin number on the Switch and Sense 8/8 that is connected to and
+    controls the IR LEDs.
+    '''
+
+    tone_pin = NumericProperty(5)
+    '''The pin number on the Switch and Sense 8/8 that is connected to and
+    controls the tone.
+    '''
@@ -0,0 +1,95 @@
+import pytest
+
+from vet_cond.frame_index import FrameIndexWriter, FrameIndex, \
+    index_filename, EVENT_KEYS, HEADER_SIZE
+
+
+def write_index(tmpdir, count=10, close=True):
+    video = str(tmpdir.join('video.avi'))
+    filename = index_filename(video)
+    writer = FrameIndexWriter(filename, video, trial=3)
+    with open(video, 'wb') as fh:
+        for i in range(count):
+            fh.write(b'\0' * 100)
+            fh.flush()
+            writer.add_frame(10 + i / 10., 1000 + i)
+    writer.set_events({'tone_ts': 10.25, 'tone_te': 10.55, 'other': 1})
+    if close:
+        writer.close()
+    else:
+        writer._fh.flush()
+    return writer
+
+
+def test_index_filename():
+    assert index_filename('data/video.avi') == 'data/video.fidx'
+
+
+def test_round_trip(tmpdir):
+    writer = write_index(tmpdir)
+    with FrameIndex(writer.filename) as index:
+        assert len(index) == 10
+        assert index.trial == 3
+        assert sorted(index.events) == sorted(EVENT_KEYS)
+        assert index.events['tone_ts'] == 10.25
+        assert index.events['shock_ts'] == -1
+
+        for i in range(10):
+            frame, pts, host, offset = index[i]
+            assert frame == i
+            assert pts == pytest.approx(10 + i / 10.)
+            assert host == 1000 + i
+            assert offset == index.get_offset(i) == (i + 1) * 100
+        assert index[-1][0] == 9
+        with pytest.raises(IndexError):
+            index[10]
+
+
+def test_find(tmpdir):
+    writer = write_index(tmpdir)
+    with FrameIndex(writer.filename) as index:
+        assert index.find(0) == 0
+        assert index.find(10.25) == 3
+        assert index.find(10.35) == 4
+        assert index.find(100) == 10
+
+        assert index.window('tone_ts', 'tone_te') == (3, 6)
+        assert index.window('tone_ts', 'tone_te', before=.1) == (2, 6)
+        assert index.window(10., 10.15) == (0, 2)
+        assert index.window('shock_ts', 'shock_te') is None
+
+
+def test_not_closed(tmpdir):
+    writer = write_index(tmpdir, close=False)
+    # a crash in the middle of writing a record
+    writer._fh.write(b'\0' * 5)
+    writer._fh.flush()
+
+    index = FrameIndex(writer.filename)
+    assert len(index) == 10
+    assert index.get_pts(9) == pytest.approx(10.9)
+    assert index.events['tone_ts'] == -1
+    index.close()
+    writer.close()
+
+
+def test_empty(tmpdir):
+    writer = write_index(tmpdir, count=0)
+    with FrameIndex(writer.filename) as index:
+        assert len(index) == 0
+        assert index.find(10) == 0
+        with pytest.raises(IndexError):
+            index[0]
+
+
+def test_not_an_index(tmpdir):
+    filename = str(tmpdir.join('video.fidx'))
+    with open(filename, 'wb') as fh:
+        fh.write(b'\0' * HEADER_SIZE)
+    with pytest.raises(ValueError):
+        FrameIndex(filename)
+
+    with open(filename, 'wb') as fh:
+        fh.write(b'\0' * 10)
+    with pytest.raises(ValueError):
+        FrameIndex(filename)
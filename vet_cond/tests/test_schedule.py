@@ -0,0 +1,104 @@
+import pytest
+
+from vet_cond.schedule import Schedule, compile_schedule, TRIAL_KEYS
+
+
+def get_opts(**kwargs):
+    opts = {'repeat': 3, 'duration': 30, 'shock': (28, 2),
+            'tone': (0, 30), 'iti': (60, 120)}
+    opts.update(kwargs)
+    return opts
+
+
+def test_same_seed():
+    a = compile_schedule('tone', get_opts(), seed=42)
+    b = compile_schedule('tone', get_opts(), seed=42)
+    assert a.get_state() == b.get_state()
+    assert a.seed == 42
+
+    c = compile_schedule('tone', get_opts(), seed=43)
+    assert [t['iti'] for t in a.trials] != [t['iti'] for t in c.trials]
+
+
+def test_random_seed():
+    a = compile_schedule('tone', get_opts())
+    assert isinstance(a.seed, int)
+    b = compile_schedule('tone', get_opts(), seed=a.seed)
+    assert a.get_state() == b.get_state()
+
+
+def test_trial_times():
+    schedule = compile_schedule(
+        'tone', get_opts(), seed=0, prehab=100, posthab=50, prerecord=5,
+        postrecord=10)
+    assert len(schedule.trials) == 3
+    assert schedule.trial_length == 30
+
+    t = 100
+    for i, trial in enumerate(schedule.trials):
+        assert sorted(trial) == sorted(TRIAL_KEYS)
+        assert trial['trial'] == i
+        assert trial['trial_start'] == t
+        assert trial['record_start'] == t - 5
+        assert trial['tone_start'] == t
+        assert trial['tone_end'] == t + 30
+        assert trial['shock_start'] == t + 28
+        assert trial['shock_end'] == t + 30
+        assert trial['trial_end'] == t + 30
+        assert trial['record_end'] == t + 40
+        assert 60 <= trial['iti'] <= 120
+        assert trial['iti_end'] == trial['record_end'] + trial['iti']
+        t = trial['iti_end']
+    assert schedule.duration == t + 50
+
+
+def test_no_prerecord_buffer():
+    schedule = compile_schedule(
+        'tone', get_opts(repeat=1), seed=0, prehab=0, prerecord=5,
+        postrecord=0, prerecord_buffer=False)
+    trial, = schedule.trials
+    assert trial['record_start'] == 0
+    assert trial['trial_start'] == 5
+
+
+def test_no_events():
+    schedule = compile_schedule(
+        'tone', get_opts(duration=0, shock=(0, 0), tone=(5, 10)), seed=0)
+    assert schedule.trial_length == 15
+    for trial in schedule.trials:
+        assert trial['shock_start'] == trial['shock_end'] == -1
+        assert trial['tone_end'] - trial['tone_start'] == 10
+
+
+@pytest.mark.parametrize('opts,kwargs', [
+    (get_opts(repeat=-1), {}),
+    (get_opts(duration=-1), {}),
+    (get_opts(iti=(-1, 10)), {}),
+    (get_opts(iti=(20, 10)), {}),
+    (get_opts(tone=(-1, 10)), {}),
+    (get_opts(tone=(25, 10)), {}),
+    (get_opts(shock=(28, 5)), {}),
+    (get_opts(), {'prehab': -1}),
+    (get_opts(), {'postrecord': -1}),
+    (get_opts(), {'prehab': 2, 'prerecord': 5}),
+    (get_opts(iti=(1, 2)), {'prerecord': 5}),
+])
+def test_invalid(opts, kwargs):
+    with pytest.raises(ValueError):
+        compile_schedule('tone', opts, seed=0, **kwargs)
+
+
+def test_save_load(tmpdir):
+    filename = str(tmpdir.join('schedule.json'))
+    a = compile_schedule('tone', get_opts(), seed=1)
+    b = compile_schedule('shock', get_opts(repeat=1), seed=2)
+    a.save(filename, animal='a')
+    b.save(filename, animal='b')
+
+    schedules = Schedule.load(filename)
+    assert [s.animal for s in schedules] == ['a', 'b']
+    for orig, loaded in zip((a, b), schedules):
+        state = loaded.get_state()
+        assert state['trials'] == orig.trials
+        assert state['seed'] == orig.seed
+        assert state['duration'] == orig.duration
@@ -0,0 +1,143 @@
+import csv
+
+import pytest
+
+from vet_cond.trial_log import TrialLogWriter, read_log, export_csv, \
+    LOG_MAGIC, TRIAL_COLUMNS, CSV_TRIAL_COLUMNS, EVENT_COLUMNS
+
+
+def trial_row(trial):
+    row = {key: float(trial) for _, key, t in TRIAL_COLUMNS if t == 'd'}
+    row.update({key: trial for _, key, t in TRIAL_COLUMNS if t == 'q'})
+    row.update({'date': '2016-02-04', 'animal': u'rat \xe9', 'type': 'a'})
+    return row
+
+
+def event_row(trial):
+    return {'date': '2016-02-04', 'animal': 'rat', 'type': 'a',
+            'trial': trial, 'event': 'tone_ts', 'pts': 1.5, 'host': 2.5,
+            'frame_before': 3, 'pts_before': 1.25, 'frame_after': 4,
+            'pts_after': 1.75}
+
+
+def write_log(filename, n_trials=3, n_frames=10):
+    writer = TrialLogWriter(filename, checkpoint_interval=.01)
+    writer.open()
+    for i in range(n_trials):
+        writer.add_trial(trial_row(i))
+        writer.add_event(event_row(i))
+    for i in range(n_frames):
+        writer.add_frame(i, i / 30., i / 30. + 100, i // 4, 0)
+    writer.close()
+    writer._thread.join(10)
+    assert not writer._thread.is_alive()
+    return writer
+
+
+def read_log_data(data, tmpdir):
+    filename = str(tmpdir.join('copy.vlog'))
+    with open(filename, 'wb') as fh:
+        fh.write(data)
+    return read_log(filename)
+
+
+def read_csv(filename):
+    with open(filename) as fh:
+        return list(csv.reader(fh))
+
+
+def test_round_trip(tmpdir):
+    writer = write_log(str(tmpdir.join('log.csv')))
+    data = read_log(writer.binary_filename)
+    assert sorted(data) == ['events', 'frames', 'trials']
+
+    trials = data['trials']
+    assert sorted(trials) == sorted(key for _, key, _ in TRIAL_COLUMNS)
+    assert trials['trial'] == [0, 1, 2]
+    assert trials['freezing'] == [0., 1., 2.]
+    assert trials['animal'] == [u'rat \xe9'] * 3
+    assert data['events']['pts_after'] == [1.75] * 3
+    assert data['frames']['frame'] == list(range(10))
+    assert data['frames']['trial'] == [i // 4 for i in range(10)]
+
+
+def test_append(tmpdir):
+    filename = str(tmpdir.join('log.csv'))
+    write_log(filename, n_trials=2)
+    writer = write_log(filename, n_trials=1)
+    assert writer.filename == filename
+    assert read_log(writer.binary_filename)['trials']['trial'] == [0, 1, 0]
+
+    rows = read_csv(filename)
+    assert rows[0] == [name for name, _, _ in CSV_TRIAL_COLUMNS]
+    assert len(rows) == 4
+    assert all(len(row) == len(CSV_TRIAL_COLUMNS) for row in rows)
+
+
+def test_export_csv(tmpdir):
+    writer = write_log(str(tmpdir.join('log.csv')))
+    filename = str(tmpdir.join('export.csv'))
+
+    export_csv(writer.binary_filename, filename)
+    assert read_csv(filename) == read_csv(writer.filename)
+
+    export_csv(writer.binary_filename, filename, all_columns=True)
+    rows = read_csv(filename)
+    assert rows[0] == [name for name, _, _ in TRIAL_COLUMNS]
+    assert [float(row[-1]) for row in rows[1:]] == [0., 1., 2.]
+
+    export_csv(writer.binary_filename, filename, table='events')
+    assert read_csv(filename) == read_csv(writer.events_filename)
+
+
+@pytest.mark.parametrize('cut', [1, 4, 12, 30])
+def test_torn_chunk(tmpdir, cut):
+    filename = str(tmpdir.join('log.csv'))
+    writer = write_log(filename, n_trials=2)
+    with open(writer.binary_filename, 'rb') as fh:
+        complete = fh.read()
+
+    write_log(filename, n_trials=1, n_frames=0)
+    with open(writer.binary_filename, 'rb') as fh:
+        data = fh.read()
+    # a crash while the last chunk was written
+    with open(writer.binary_filename, 'wb') as fh:
+        fh.write(data[:len(complete) + cut])
+    assert read_log(writer.binary_filename) == read_log_data(complete, tmpdir)
+
+
+def test_corrupt_chunk(tmpdir):
+    writer = write_log(str(tmpdir.join('log.csv')), n_trials=2)
+    with open(writer.binary_filename, 'rb') as fh:
+        complete = fh.read()
+
+    write_log(writer.filename, n_trials=1, n_frames=0)
+    with open(writer.binary_filename, 'rb') as fh:
+        data = bytearray(fh.read())
+    # flip a byte in the payload of the first appended chunk
+    data[len(complete) + 20] ^= 0xff
+    with open(writer.binary_filename, 'wb') as fh:
+        fh.write(data)
+
+    tables = read_log(writer.binary_filename)
+    assert tables == read_log_data(complete, tmpdir)
+    assert tables['trials']['trial'] == [0, 1]
+
+
+def test_not_a_log(tmpdir):
+    filename = str(tmpdir.join('log.vlog'))
+    with open(filename, 'wb') as fh:
+        fh.write(LOG_MAGIC[:-1] + b'\xff')
+    with pytest.raises(ValueError):
+        read_log(filename)
+
+
+def test_other_columns(tmpdir):
+    filename = str(tmpdir.join('log.csv'))
+    with open(filename, 'w') as fh:
+        fh.write('Date,ID\n')
+    writer = write_log(filename, n_trials=1)
+    assert writer.filename == str(tmpdir.join('log_1.csv'))
+    assert read_csv(filename) == [['Date', 'ID']]
+    assert read_csv(writer.events_filename)[0] == \
+        [name for name, _, _ in EVENT_COLUMNS]
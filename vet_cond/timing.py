@@ -0,0 +1,450 @@
+'''Timing
+==========
+
+Tools for relating the host clock to the video frames' time and for
+measuring latencies.
+'''
+
+from collections import deque
+from math import log10
+from timeit import default_timer as clock
+
+__all__ = ('clock', 'FrameClock', 'LatencyHistogram', 'FrameMonitor',
+           'IntervalStats')
+
+
+class FrameClock(object):
+    '''Tracks the frames as they are received and maps host times to the
+    video time (pts) of the frames.
+
+    :meth:`add_frame` is called for every frame with its pts and the host
+    time when it was received. A linear host-to-pts mapping is fitted, by
+    least squares, over the last :attr:`window` frames, so the video time of
+    an event can be interpolated from the host time when it happened, at a
+    better accuracy than the frame interval.
+
+    :meth:`stamp` records an event at the current host time. The stamp is
+    completed when the next frame is received.
+
+    Note that the host times are the times the frames were received, so the
+    interpolated video time includes the (roughly constant) latency between
+    the acquisition of a frame and when it's received.
+    '''
+
+    window = 60
+    '''The number of most recent frames used to fit the host-to-pts mapping.
+    '''
+
+    frame_count = 0
+    '''The number of frames received so far. The index of the most recent
+    frame is one less than this.
+    '''
+
+    last_pts = None
+    '''The pts of the most recent frame, or None if no frame was received.
+    '''
+
+    last_host = None
+    '''The host time when the most recent frame was received, or None.
+    '''
+
+    _history = None
+    '''A deque of the ``(host, pts)`` of the last :attr:`window` frames.
+    '''
+
+    _pending = []
+    '''The list of ``(stamp, callback)`` for the stamps waiting for the next
+    frame.
+    '''
+
+    _after_frame = []
+    '''The list of callbacks to call after the next frame.
+    '''
+
+    def __init__(self, window=60):
+        super(FrameClock, self).__init__()
+        self.window = window
+        self._history = deque(maxlen=max(2, int(window)))
+        self._pending = []
+        self._after_frame = []
+
+    def add_frame(self, pts, host=None):
+        '''Adds a frame and returns its index. ``host`` is the host time when
+        it was received, if None, the current time is used.
+        '''
+        if host is None:
+            host = clock()
+        index = self.frame_count
+        self.frame_count = index + 1
+        self.last_pts = pts
+        self.last_host = host
+        self._history.append((host, pts))
+
+        if self._pending or self._after_frame:
+            self._complete(index, pts)
+        return index
+
+    def _complete(self, index, pts):
+        pending = self._pending
+        after = self._after_frame
+        self._pending = []
+        self._after_frame = []
+
+        for stamp, callback in pending:
+            stamp['frame_after'] = index
+            stamp['pts_after'] = pts
+            if index != -1:
+                stamp['pts'] = self.host_to_pts(stamp['host'])
+            if callback is not None:
+                callback(stamp)
+        for callback in after:
+            callback()
+
+    def call_after_frame(self, callback):
+        '''Calls ``callback``, with no arguments, after the next frame is
+        received and all the pending stamps were completed. If there are no
+        pending stamps, it's called immediately.
+        '''
+        if self._pending:
+            self._after_frame.append(callback)
+        else:
+            callback()
+
+    def flush(self):
+        '''Completes all the pending stamps and callbacks without waiting for
+        the next frame, leaving their ``frame_after`` and ``pts_after`` at -1.
+        E.g. when no more frames will be received.
+        '''
+        self._complete(-1, -1)
+
+    def host_to_pts(self, host):
+        '''Returns the interpolated video time at the given host time, using
+        the mapping fitted over the recent frames. Returns None if no frames
+        were received.
+        '''
+        history = self._history
+        n = len(history)
+        if not n:
+            return None
+
+        last_host, last_pts = history[-1]
+        if n < 2:
+            return last_pts + host - last_host
+
+        # least squares fit of pts = a + b * host, relative to the last frame
+        # to keep the sums numerically small
+        sx = sy = sxx = sxy = 0.
+        for h, p in history:
+            x = h - last_host
+            y = p - last_pts
+            sx += x
+            sy += y
+            sxx += x * x
+            sxy += x * y
+        denom = n * sxx - sx * sx
+        if not denom:
+            return last_pts + host - last_host
+        b = (n * sxy - sx * sy) / denom
+        a = (sy - b * sx) / n
+        return last_pts + a + b * (host - last_host)
+
+    def stamp(self, callback=None):
+        '''Records an event at the current host time and returns its stamp.
+
+        The stamp is a dict with the following keys:
+
+            `host`: The host time of the event.
+            `frame_before`, `pts_before`: The index and pts of the most recent
+                frame received before the event, or -1 if there's none.
+            `frame_after`, `pts_after`: The index and pts of the first frame
+                received after the event. They are -1 until that frame is
+                received.
+            `pts`: The interpolated video time of the event. Until the next
+                frame is received it's an estimate from the frames so far.
+
+        ``callback``, if not None, is called with the stamp once it's complete
+        with the following frame.
+        '''
+        host = clock()
+        pts = self.host_to_pts(host)
+        stamp = {
+            'host': host, 'frame_before': self.frame_count - 1,
+            'pts_before': -1 if self.last_pts is None else self.last_pts,
+            'frame_after': -1, 'pts_after': -1,
+            'pts': -1 if pts is None else pts}
+        self._pending.append((stamp, callback))
+        return stamp
+
+
+class LatencyHistogram(object):
+    '''A histogram of durations, e.g. latencies, with logarithmically spaced
+    bins, so that adding a value is cheap and the memory is fixed.
+
+    Values are in seconds. There are :attr:`bins_per_decade` bins for every
+    factor of 10 between :attr:`min_value` and :attr:`max_value`, plus a bin
+    for smaller and one for larger values.
+    '''
+
+    min_value = 1e-5
+    '''The lower edge of the first bin.
+    '''
+
+    max_value = 10.
+    '''The upper edge of the last bin.
+    '''
+
+    bins_per_decade = 10
+    '''The number of bins for every factor of 10.
+    '''
+
+    counts = []
+    '''The number of values in each bin. The first element is the number of
+    values smaller than :attr:`min_value` and the last is the number of values
+    larger than :attr:`max_value`.
+    '''
+
+    count = 0
+    '''The number of values added.
+    '''
+
+    total = 0
+    '''The sum of the values added.
+    '''
+
+    minimum = None
+    '''The smallest value added, or None.
+    '''
+
+    maximum = None
+    '''The largest value added, or None.
+    '''
+
+    def __init__(self, min_value=1e-5, max_value=10., bins_per_decade=10):
+        super(LatencyHistogram, self).__init__()
+        self.min_value = min_value
+        self.max_value = max_value
+        self.bins_per_decade = bins_per_decade
+        self._n_bins = int(round(
+            log10(max_value / float(min_value)) * bins_per_decade))
+        self.reset()
+
+    def reset(self):
+        '''Removes all the values.
+        '''
+        self.counts = [0] * (self._n_bins + 2)
+        self.count = 0
+        self.total = 0
+        self.minimum = self.maximum = None
+
+    def add(self, value):
+        '''Adds the value to the histogram.
+        '''
+        if value < self.min_value:
+            i = 0
+        elif value >= self.max_value:
+            i = self._n_bins + 1
+        else:
+            i = 1 + int(
+                log10(value / self.min_value) * self.bins_per_decade)
+            i = min(i, self._n_bins)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+
+    def merge(self, other):
+        '''Adds all the values of the histogram ``other``, which must have the
+        same bins, e.g. a histogram recorded in another process.
+        '''
+        if len(other.counts) != len(self.counts) or \
+                other.min_value != self.min_value:
+            raise ValueError('The histograms have different bins')
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        for value in (other.minimum, other.maximum):
+            if value is None:
+                continue
+            if self.minimum is None or value < self.minimum:
+                self.minimum = value
+            if self.maximum is None or value > self.maximum:
+                self.maximum = value
+
+    def bin_edges(self):
+        '''Returns the list of the edges of the bins, starting with
+        :attr:`min_value` and ending with :attr:`max_value`.
+        '''
+        return [self.min_value * 10 ** (i / float(self.bins_per_decade))
+                for i in range(self._n_bins + 1)]
+
+    def percentile(self, q):
+        '''Returns an estimate of the ``q`` (0-100) percentile of the values
+        from the bins, or None if empty.
+        '''
+        if not self.count:
+            return None
+
+        target = q / 100. * self.count
+        edges = self.bin_edges()
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n:
+                if i == 0:
+                    return self.minimum
+                if i == len(self.counts) - 1:
+                    return self.maximum
+                # the bin's geometric center, within the range seen
+                value = (edges[i - 1] * edges[i]) ** .5
+                return min(max(value, self.minimum), self.maximum)
+        return self.maximum
+
+    def summary(self):
+        '''Returns a dict with the `count`, `mean`, `min`, `max`, `p50`,
+        `p90` and `p99` of the values.
+        '''
+        count = self.count
+        return {
+            'count': count, 'mean': self.total / count if count else None,
+            'min': self.minimum, 'max': self.maximum,
+            'p50': self.percentile(50), 'p90': self.percentile(90),
+            'p99': self.percentile(99)}
+
+
+class IntervalStats(object):
+    '''Running statistics of the intervals between frames, computed in
+    constant memory.
+    '''
+
+    count = 0
+    '''The number of intervals.
+    '''
+
+    mean = 0.
+    '''The mean interval.
+    '''
+
+    maximum = 0.
+    '''The largest interval.
+    '''
+
+    _m2 = 0.
+    '''The running sum of squared differences from the mean.
+    '''
+
+    def add(self, value):
+        '''Adds an interval.
+        '''
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+        if value > self.maximum:
+            self.maximum = value
+
+    @property
+    def std(self):
+        '''The standard deviation of the intervals, i.e. the jitter.
+        '''
+        if self.count < 2:
+            return 0.
+        return (self._m2 / (self.count - 1)) ** .5
+
+
+class FrameMonitor(object):
+    '''Monitors the pts of the received frames for gaps, i.e. dropped
+    frames, and for the inter-frame jitter.
+
+    A gap between consecutive frames longer than 1.5 frame intervals at the
+    expected rate is counted as ``round(gap * rate) - 1`` dropped frames.
+    The counts and the interval statistics are kept both for the whole session
+    and for the current trial, which is started with :meth:`start_trial`.
+    '''
+
+    frames = 0
+    '''The number of frames received.
+    '''
+
+    dropped = 0
+    '''The number of frames missing from the received frames.
+    '''
+
+    intervals = None
+    '''The :class:`IntervalStats` of the session.
+    '''
+
+    trial_frames = 0
+    '''The number of frames received since :meth:`start_trial`.
+    '''
+
+    trial_dropped = 0
+    '''The number of frames missing since :meth:`start_trial`.
+    '''
+
+    trial_intervals = None
+    '''The :class:`IntervalStats` since :meth:`start_trial`.
+    '''
+
+    last_pts = None
+    '''The pts of the last frame.
+    '''
+
+    def __init__(self):
+        super(FrameMonitor, self).__init__()
+        self.intervals = IntervalStats()
+        self.trial_intervals = IntervalStats()
+
+    def add_frame(self, pts, rate):
+        '''Adds a frame and returns the number of frames missing between it
+        and the previous frame. ``rate`` is the expected frame rate, if it's
+        zero, the mean interval so far is used instead.
+        '''
+        last = self.last_pts
+        self.last_pts = pts
+        self.frames += 1
+        self.trial_frames += 1
+        if last is None:
+            return 0
+
+        interval = pts - last
+        self.intervals.add(interval)
+        self.trial_intervals.add(interval)
+
+        if rate > 0:
+            period = 1. / rate
+        elif self.intervals.count >= 10:
+            period = self.intervals.mean
+        else:
+            return 0
+
+        if interval <= 1.5 * period:
+            return 0
+        missing = int(round(interval / period)) - 1
+        self.dropped += missing
+        self.trial_dropped += missing
+        return missing
+
+    def start_trial(self):
+        '''Resets the trial counts and statistics.
+        '''
+        self.trial_frames = self.trial_dropped = 0
+        self.trial_intervals = IntervalStats()
+
+    def trial_summary(self):
+        '''Returns a dict with the `frames`, `dropped`, `jitter` (the interval
+        standard deviation), and `max_interval` since :meth:`start_trial`.
+        '''
+        intervals = self.trial_intervals
+        return {
+            'frames': self.trial_frames, 'dropped': self.trial_dropped,
+            'jitter': intervals.std, 'max_interval': intervals.maximum}
+
+    @property
+    def rate(self):
+        '''The measured frame rate of the session.
+        '''
+        mean = self.intervals.mean
+        return 1. / mean if mean > 0 else 0.
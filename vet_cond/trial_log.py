@@ -0,0 +1,432 @@
+'''Trial Log
+=============
+
+Writes the experiment log from a background thread. The log is written both
+as the CSV files people read, and as a compact binary columnar file that
+also holds the per-frame records, which would be too slow to write as text.
+
+The CSV log keeps its original layout, :attr:`CSV_TRIAL_COLUMNS`, so
+existing logs are appended to, while the per-trial frame and freezing
+statistics are only written to the binary log, see :attr:`TRIAL_COLUMNS`.
+
+Binary log format
+-----------------
+
+The binary log (``.vlog``) starts with the 8 byte :attr:`LOG_MAGIC` header,
+followed by any number of chunks. Each chunk holds some rows of a single
+table, e.g. ``'trials'`` or ``'frames'``, stored column by column, and is
+structured as follows (all integers are little endian)::
+
+    b'CHNK', uint32 payload length, uint32 crc32 of the payload, payload
+
+where the payload is::
+
+    uint16 table name length, table name (utf8), uint16 number of columns,
+    uint32 number of rows, and for each column:
+        uint16 column name length, column name (utf8), 1 byte type code,
+        uint32 data length, data
+
+The type code is ``b'd'`` for float64, ``b'q'`` for int64, and ``b's'`` for
+strings, which are stored as a uint32 length followed by the utf8 bytes for
+each row.
+
+Chunks are only appended, and the file is flushed to disk after every
+checkpoint, so if the app crashes at most the rows since the last checkpoint
+are lost and :func:`read_log` ignores a partially written final chunk.
+'''
+
+import os
+import struct
+import zlib
+import csv
+from threading import Thread, Condition
+from functools import partial
+from os.path import isfile, splitext
+from io import open as io_open
+
+from kivy.clock import Clock
+from kivy.logger import Logger
+
+from cplcom.moa.app import app_error
+
+from vet_cond.metrics import timed
+
+__all__ = ('TrialLogWriter', 'read_log', 'export_csv', 'LOG_MAGIC',
+           'TRIAL_COLUMNS', 'CSV_TRIAL_COLUMNS', 'EVENT_COLUMNS',
+           'FRAME_COLUMNS')
+
+LOG_MAGIC = b'VCLOG\x00\x01\x00'
+'''The header of the binary log files.
+'''
+
+TRIAL_COLUMNS = (
+    ('Date', 'date', 's'), ('ID', 'animal', 's'), ('Type', 'type', 's'),
+    ('Trial', 'trial', 'q'), ('TrialStart', 'trial_ts', 'd'),
+    ('TrialEnd', 'trial_te', 'd'), ('ToneStart', 'tone_ts', 'd'),
+    ('ToneEnd', 'tone_te', 'd'), ('ShockStart', 'shock_ts', 'd'),
+    ('ShockEnd', 'shock_te', 'd'), ('Frames', 'frames', 'q'),
+    ('DroppedFrames', 'dropped', 'q'),
+    ('EncoderDropped', 'encoder_dropped', 'q'),
+    ('FrameJitter', 'jitter', 'd'), ('Freezing', 'freezing', 'd'),
+    ('FreezingFraction', 'freezing_fraction', 'd'),
+    ('ToneFreezing', 'tone_freezing', 'd'))
+'''The columns of the trials table of the binary log as ``(CSV header,
+key, type)`` tuples. The CSV log only has the first of these columns, see
+:attr:`CSV_TRIAL_COLUMNS`.
+'''
+
+CSV_TRIAL_COLUMNS = TRIAL_COLUMNS[:10]
+'''The columns of the CSV log, in this order, from `Date` to `ShockEnd`.
+It's the layout the log always had.
+'''
+
+EVENT_COLUMNS = (
+    ('Date', 'date', 's'), ('ID', 'animal', 's'), ('Type', 'type', 's'),
+    ('Trial', 'trial', 'q'), ('Event', 'event', 's'), ('Time', 'pts', 'd'),
+    ('HostTime', 'host', 'd'), ('FrameBefore', 'frame_before', 'q'),
+    ('PtsBefore', 'pts_before', 'd'), ('FrameAfter', 'frame_after', 'q'),
+    ('PtsAfter', 'pts_after', 'd'))
+'''The columns of the events table, similar to :attr:`TRIAL_COLUMNS`.
+'''
+
+FRAME_COLUMNS = (
+    ('Frame', 'frame', 'q'), ('Time', 'pts', 'd'), ('HostTime', 'host', 'd'),
+    ('Trial', 'trial', 'q'), ('Dropped', 'dropped', 'q'))
+'''The columns of the frames table, similar to :attr:`TRIAL_COLUMNS`. It
+only exists in the binary log. ``trial`` is -1 for frames outside a trial
+recording and ``dropped`` is the number of frames missing just before this
+frame.
+'''
+
+_chunk_header = struct.Struct('<4sII')
+
+
+def _to_bytes(typecode, values):
+    # struct rather than array, because Python 2's array has no int64 type
+    return struct.pack('<{}{}'.format(len(values), typecode), *values)
+
+
+def _from_bytes(typecode, data):
+    return struct.unpack('<{}{}'.format(len(data) // 8, typecode), data)
+
+
+def _encode_column(name, typecode, values):
+    if typecode == 's':
+        parts = []
+        for val in values:
+            val = u'{}'.format(val).encode('utf8')
+            parts.append(struct.pack('<I', len(val)))
+            parts.append(val)
+        data = b''.join(parts)
+    else:
+        data = _to_bytes(typecode, values)
+
+    name = name.encode('utf8')
+    return b''.join((
+        struct.pack('<H', len(name)), name, typecode.encode('ascii'),
+        struct.pack('<I', len(data)), data))
+
+
+def _encode_chunk(table, columns, rows):
+    name = table.encode('utf8')
+    parts = [struct.pack('<H', len(name)), name,
+             struct.pack('<HI', len(columns), len(rows))]
+    for i, (col, typecode) in enumerate(columns):
+        parts.append(_encode_column(col, typecode, [r[i] for r in rows]))
+    payload = b''.join(parts)
+    return _chunk_header.pack(
+        b'CHNK', len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+
+def _decode_chunk(payload):
+    pos = 0
+    n, = struct.unpack_from('<H', payload, pos)
+    pos += 2
+    table = payload[pos:pos + n].decode('utf8')
+    pos += n
+    n_cols, n_rows = struct.unpack_from('<HI', payload, pos)
+    pos += 6
+
+    columns = []
+    for _ in range(n_cols):
+        n, = struct.unpack_from('<H', payload, pos)
+        pos += 2
+        name = payload[pos:pos + n].decode('utf8')
+        pos += n
+        typecode = payload[pos:pos + 1].decode('ascii')
+        size, = struct.unpack_from('<I', payload, pos + 1)
+        pos += 5
+        data = payload[pos:pos + size]
+        pos += size
+
+        if typecode == 's':
+            values = []
+            i = 0
+            while i < size:
+                k, = struct.unpack_from('<I', data, i)
+                values.append(data[i + 4:i + 4 + k].decode('utf8'))
+                i += 4 + k
+        else:
+            values = list(_from_bytes(typecode, data))
+        if len(values) != n_rows:
+            raise ValueError('Corrupt column "{}"'.format(name))
+        columns.append((name, values))
+    return table, columns
+
+
+def read_log(filename):
+    '''Reads a binary log file and returns a dict whose keys are the table
+    names and whose values are dicts mapping column names to the list of the
+    column's values.
+
+    Reading stops at the first truncated or corrupted chunk, e.g. when the
+    app crashed while writing it.
+    '''
+    tables = {}
+    with open(filename, 'rb') as fh:
+        if fh.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError('"{}" is not a log file'.format(filename))
+
+        while True:
+            header = fh.read(_chunk_header.size)
+            if len(header) < _chunk_header.size:
+                break
+            magic, size, crc = _chunk_header.unpack(header)
+            payload = fh.read(size)
+            if magic != b'CHNK' or len(payload) < size or \
+                    zlib.crc32(payload) & 0xffffffff != crc:
+                break
+
+            table, columns = _decode_chunk(payload)
+            data = tables.setdefault(table, {})
+            for name, values in columns:
+                data.setdefault(name, []).extend(values)
+    return tables
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return value
+
+
+def export_csv(filename, csv_filename, table='trials', all_columns=False):
+    '''Exports a table of the binary log file ``filename`` to a CSV file with
+    the layout of the CSV log, e.g. :attr:`CSV_TRIAL_COLUMNS` for the
+    ``'trials'`` table. If ``all_columns``, the ``'trials'`` table is
+    exported with all the :attr:`TRIAL_COLUMNS` instead.
+    '''
+    columns = {'trials': TRIAL_COLUMNS if all_columns else CSV_TRIAL_COLUMNS,
+               'events': EVENT_COLUMNS, 'frames': FRAME_COLUMNS}[table]
+    data = read_log(filename).get(table, {})
+    n = max([len(v) for v in data.values()] + [0])
+    values = [data.get(key, [''] * n) for _, key, _ in columns]
+
+    with open(csv_filename, 'w') as fh:
+        writer = csv.writer(fh, lineterminator='\n')
+        writer.writerow([header for header, _, _ in columns])
+        for i in range(n):
+            writer.writerow([_format_value(col[i]) for col in values])
+
+
+def _has_columns(filename, columns):
+    '''Returns whether the CSV file ``filename`` doesn't exist or has the
+    header of ``columns``, so it can be appended to.
+    '''
+    if not isfile(filename):
+        return True
+    with io_open(filename, encoding='utf8') as fh:
+        header = fh.readline().rstrip(u'\r\n')
+    return not header or \
+        header == u','.join(name for name, _, _ in columns)
+
+
+class TrialLogWriter(object):
+    '''Writes the trial log from a background thread.
+
+    The methods adding rows are called from the Kivy thread, and only add
+    the rows to a buffer. The worker thread writes the buffered rows every
+    :attr:`checkpoint_interval` seconds, to the CSV log :attr:`filename` and
+    the events CSV log, and to the binary log (see the module docs), and then
+    flushes the files to disk.
+
+    The files are appended to if they exist with the same columns.
+    '''
+
+    filename = ''
+    '''The filename of the CSV log with a row per trial. It's the filename
+    passed to the writer, unless that CSV log, or its events log, exists with
+    different columns, in which case the first free ``<root>_<n><ext>``
+    filename is used instead.
+    '''
+
+    events_filename = ''
+    '''The filename of the CSV log with the stamps of the trial events.
+    '''
+
+    binary_filename = ''
+    '''The filename of the binary columnar log.
+    '''
+
+    log_frames = True
+    '''Whether to write the per-frame records to the binary log.
+    '''
+
+    checkpoint_interval = 1.
+    '''How often, in seconds, the buffered rows are written and flushed to
+    disk.
+    '''
+
+    _buffers = {}
+    '''A dict mapping table names to the list of rows not yet written.
+    '''
+
+    _cond = None
+    '''The condition guarding :attr:`_buffers`.
+    '''
+
+    _thread = None
+    '''The worker thread.
+    '''
+
+    _closing = False
+    '''Whether the worker should write the remaining rows and exit.
+    '''
+
+    _callbacks = []
+    '''The callbacks to call once the worker exits.
+    '''
+
+    def __init__(self, filename, log_frames=True, checkpoint_interval=1.):
+        super(TrialLogWriter, self).__init__()
+        root, ext = splitext(filename)
+        i = 0
+        while not _has_columns(filename, CSV_TRIAL_COLUMNS) or \
+                not _has_columns('{}_events{}'.format(root, ext),
+                                 EVENT_COLUMNS):
+            i += 1
+            filename = '{}_{}{}'.format(root, i, ext)
+        if i:
+            Logger.warning(
+                'VetCond: The existing log "{}{}" has different columns, '
+                'writing to "{}" instead'.format(root, ext, filename))
+
+        self.filename = filename
+        root, ext = splitext(filename)
+        self.events_filename = '{}_events{}'.format(root, ext)
+        self.binary_filename = '{}.vlog'.format(root)
+        self.log_frames = log_frames
+        self.checkpoint_interval = checkpoint_interval
+        self._buffers = {'trials': [], 'events': [], 'frames': []}
+        self._callbacks = []
+        self._cond = Condition()
+
+    def open(self):
+        '''Starts the worker thread that opens the files and writes to them.
+        '''
+        thread = self._thread = Thread(
+            target=self._run_worker, name='TrialLogWriter')
+        thread.daemon = True
+        thread.start()
+
+    def close(self, callback=None):
+        '''Makes the worker thread write the remaining rows, close the files,
+        and exit. It does not block. ``callback``, if not None, is called from
+        the Kivy thread, with no arguments, once the files were closed.
+        '''
+        with self._cond:
+            if callback is not None:
+                self._callbacks.append(callback)
+            self._closing = True
+            self._cond.notify_all()
+
+    def add_trial(self, row):
+        '''Adds a trial row, a dict with the keys of :attr:`TRIAL_COLUMNS`.
+        '''
+        row = tuple(row[key] for _, key, _ in TRIAL_COLUMNS)
+        with self._cond:
+            self._buffers['trials'].append(row)
+
+    def add_event(self, row):
+        '''Adds an event row, a dict with the keys of :attr:`EVENT_COLUMNS`.
+        '''
+        row = tuple(row[key] for _, key, _ in EVENT_COLUMNS)
+        with self._cond:
+            self._buffers['events'].append(row)
+
+    @timed('log.add_frame')
+    def add_frame(self, frame, pts, host, trial, dropped):
+        '''Adds a frame record, see :attr:`FRAME_COLUMNS`. It's cheap enough
+        to be called for every frame.
+        '''
+        if not self.log_frames:
+            return
+        with self._cond:
+            self._buffers['frames'].append((frame, pts, host, trial, dropped))
+
+    def _open_csv(self, filename, columns):
+        ex = isfile(filename)
+        fd = io_open(filename, 'a', encoding='utf8')
+        if not ex:
+            fd.write(u','.join(header for header, _, _ in columns) + u'\n')
+        return fd
+
+    def _write_csv(self, fd, rows):
+        for row in rows:
+            fd.write(u','.join(
+                u'{}'.format(_format_value(v)) for v in row) + u'\n')
+        fd.flush()
+
+    @app_error
+    def _report_error(self, e, *largs):
+        raise e
+
+    def _call_callbacks(self, callbacks, *largs):
+        for callback in callbacks:
+            callback()
+
+    def _run_worker(self):
+        cond = self._cond
+        files = []
+        try:
+            csv_fd = self._open_csv(self.filename, CSV_TRIAL_COLUMNS)
+            files.append(csv_fd)
+            events_fd = self._open_csv(self.events_filename, EVENT_COLUMNS)
+            files.append(events_fd)
+            ex = isfile(self.binary_filename)
+            bin_fd = open(self.binary_filename, 'ab')
+            files.append(bin_fd)
+            if not ex:
+                bin_fd.write(LOG_MAGIC)
+
+            done = False
+            while not done:
+                with cond:
+                    if not self._closing:
+                        cond.wait(self.checkpoint_interval)
+                    done = self._closing
+                    buffers = self._buffers
+                    self._buffers = {k: [] for k in buffers}
+
+                n = len(CSV_TRIAL_COLUMNS)
+                self._write_csv(csv_fd, [r[:n] for r in buffers['trials']])
+                self._write_csv(events_fd, buffers['events'])
+                for table, columns in (
+                        ('trials', TRIAL_COLUMNS), ('events', EVENT_COLUMNS),
+                        ('frames', FRAME_COLUMNS)):
+                    if buffers[table]:
+                        bin_fd.write(_encode_chunk(
+                            table, [(key, t) for _, key, t in columns],
+                            buffers[table]))
+                bin_fd.flush()
+                os.fsync(bin_fd.fileno())
+        except Exception as e:
+            Clock.schedule_once(partial(self._report_error, e))
+        finally:
+            for fd in files:
+                fd.close()
+            with cond:
+                callbacks = self._callbacks
+                self._callbacks = []
+            if callbacks:
+                Clock.schedule_once(partial(self._call_callbacks, callbacks))
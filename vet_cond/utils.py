@@ -0,0 +1,38 @@
+'''Utils
+=======
+
+Small helpers shared by the recording and the analysis modules, which don't
+depend on Kivy or the devices.
+'''
+
+import re
+from os.path import basename
+
+__all__ = ('name_pattern_regex', )
+
+
+def name_pattern_regex(pattern):
+    '''Returns a compiled regex matching the filenames generated from a name
+    pattern such as :attr:`~vet_cond.stages.RootStage.video_name_pat`.
+
+    ``{animal}`` and ``{trial}`` become the named groups ``animal`` and
+    ``trial``, and the `strftime` codes match anything. Only the basename of
+    the pattern is used.
+    '''
+    parts = []
+    pos = 0
+    pattern = basename(pattern)
+    for m in re.finditer(r'\{(\w+)\}|%[-#]?[a-zA-Z%]', pattern):
+        parts.append(re.escape(pattern[pos:m.start()]))
+        pos = m.end()
+        name = m.group(1)
+        if name == 'trial':
+            parts.append(r'(?P<trial>\d+)')
+        elif name is not None:
+            parts.append(r'(?P<{}>.+?)'.format(name))
+        elif m.group(0) == '%%':
+            parts.append('%')
+        else:
+            parts.append('.+?')
+    parts.append(re.escape(pattern[pos:]))
+    return re.compile('^{}$'.format(''.join(parts)))